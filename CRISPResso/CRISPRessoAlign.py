@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+'''
+CRISPResso - Luca Pinello 2015
+In-process global aligner (Needleman-Wunsch with affine gaps, Gotoh) used as a
+replacement for the EMBOSS needle subprocess.
+https://github.com/lucapinello/CRISPResso
+'''
+
+import re
+import numpy as np
+
+#same scores of the EDNAFULL matrix used by needle for the A,C,G,T,N alphabet
+_NT_CODES=np.zeros(256,dtype=np.uint8)+4
+for _idx,_nt in enumerate('ACGTN'):
+    _NT_CODES[ord(_nt)]=_idx
+    _NT_CODES[ord(_nt.lower())]=_idx
+
+_NT_LETTERS=np.fromstring('ACGTN',dtype=np.uint8)
+
+EDNAFULL_ACGTN=np.array([[ 5,-4,-4,-4,-2],
+                         [-4, 5,-4,-4,-2],
+                         [-4,-4, 5,-4,-2],
+                         [-4,-4,-4, 5,-2],
+                         [-2,-2,-2,-2,-1]],dtype=np.float32)
+
+#alignment operations
+OP_MATCH=0
+OP_INSERTION=1 #gap in the reference
+OP_DELETION=2  #gap in the read
+OP_PAD=3
+
+#max number of cells of the traceback matrix kept in memory for a batch (1 byte each)
+MAX_CELLS_PER_BATCH=5*10**7
+
+_GAP_CHAR=ord('-')
+_MATCH_CHAR=ord('|')
+_MISMATCH_CHAR=ord('.')
+_SIMILAR_CHAR=ord(':')
+_SPACE_CHAR=ord(' ')
+
+
+def parse_needle_options(needle_options_string,gap_open=10.0,gap_extend=0.5):
+    '''
+    Extract gap open and gap extend penalties from a needle options string
+    (e.g. '-gapopen=10 -gapextend=0.5  -awidth3=5000'), the other options are ignored.
+    '''
+    m=re.search(r'-gapopen[=\s]+([0-9.]+)',needle_options_string)
+    if m:
+        gap_open=float(m.group(1))
+
+    m=re.search(r'-gapextend[=\s]+([0-9.]+)',needle_options_string)
+    if m:
+        gap_extend=float(m.group(1))
+
+    return gap_open,gap_extend
+
+
+def encode_sequence(seq):
+    return _NT_CODES[np.fromstring(seq,dtype=np.uint8)]
+
+
+def _fill_batch(ref_codes,reads_codes,reads_len,gap_open,gap_extend,band=None):
+    '''
+    Fill the dynamic programming matrices for a batch of reads against the same reference.
+    The reference is on the rows, the reads (right padded) on the columns, all the reads are
+    processed at once one reference position at a time. End gaps are not penalized like in needle.
+    If band=(d_min,d_max) is specified only the cells with d_min<=j-i<=d_max are computed and the
+    traceback matrix keeps only the band (column j-i-d_min).
+    Returns the traceback matrix, the best end cell and its score for each read and, for a band, an upper
+    bound of the score of the alignments leaving the band (-1e9 without a band).
+    '''
+    n_reads,max_len=reads_codes.shape
+    len_ref=len(ref_codes)
+
+    NEG_INF=np.float32(-1e9)
+    go=np.float32(gap_open)
+    ge=np.float32(gap_extend)
+
+    #score of each read position against each possible reference nucleotide
+    score_rows=[EDNAFULL_ACGTN[c][reads_codes] for c in range(5)]
+
+    #an alignment leaving the band crosses its edge or starts outside it, the score of the rest of the alignment
+    #is at most the best match score for each pair of bases left
+    max_score=np.float32(EDNAFULL_ACGTN.max())
+    out_of_band_bound=np.zeros(n_reads,dtype=np.float32)+NEG_INF
+    if band:
+        #free leading gaps longer than the band
+        out_of_band_bound=np.where(reads_len>band[1],max_score*np.minimum(len_ref,reads_len-band[1]-1),NEG_INF).astype(np.float32)
+        if -band[0]+1<=len_ref:
+            out_of_band_bound=np.maximum(out_of_band_bound,max_score*np.minimum(len_ref+band[0]-1,reads_len))
+
+    #offsets to compute the horizontal gaps with a running maximum
+    cols=np.arange(max_len,dtype=np.float32)
+    e_offset=cols*ge
+    e_penalty=go+cols*ge
+
+    H_prev=np.zeros((n_reads,max_len+1),dtype=np.float32)
+    F_prev=np.zeros((n_reads,max_len+1),dtype=np.float32)+NEG_INF
+
+    if band:
+        traceback=np.empty((n_reads,len_ref,band[1]-band[0]+1),dtype=np.uint8)
+    else:
+        traceback=np.empty((n_reads,len_ref,max_len),dtype=np.uint8)
+
+    rows_idx=np.arange(n_reads)
+    last_col_scores=np.empty((n_reads,len_ref+1),dtype=np.float32)
+    last_col_scores[:,0]=0
+
+    H=np.empty((n_reads,max_len+1),dtype=np.float32)
+    E=np.empty((n_reads,max_len+1),dtype=np.float32)
+
+    F=np.empty((n_reads,max_len),dtype=np.float32)
+    F_is_ext=np.empty((n_reads,max_len),dtype=bool)
+    diag=np.empty((n_reads,max_len),dtype=np.float32)
+    running_max=np.empty((n_reads,max_len),dtype=np.float32)
+    E_is_ext=np.empty((n_reads,max_len),dtype=bool)
+    tmp=np.empty((n_reads,max_len),dtype=np.float32)
+    E[:,0]=NEG_INF
+
+    #columns of the read computed for each row, all of them without a band
+    st,en=0,max_len
+
+    for i in range(len_ref):
+
+        if band:
+            st=min(max(0,i+band[0]),max_len)
+            en=max(min(max_len,i+1+band[1]),st)
+
+            #cells on the left of the band are not reachable (the first column is the free leading gap)
+            H[:,st]=0 if st==0 else NEG_INF
+            E[:,st]=NEG_INF
+
+        w=en-st
+
+        #vertical gaps (deletions in the read)
+        np.subtract(H_prev[:,st+1:en+1],go,out=tmp[:,:w])
+        np.subtract(F_prev[:,st+1:en+1],ge,out=F[:,:w])
+        np.greater(F[:,:w],tmp[:,:w],out=F_is_ext[:,:w])
+        np.maximum(F[:,:w],tmp[:,:w],out=F[:,:w])
+
+        np.add(H_prev[:,st:en],score_rows[ref_codes[i]][:,st:en],out=diag[:,:w])
+        np.maximum(diag[:,:w],F[:,:w],out=H[:,st+1:en+1])
+
+        #horizontal gaps (insertions in the read) with a running maximum, first column is the free leading gap
+        H[:,0]=0
+        np.add(H[:,st:en],e_offset[st:en],out=running_max[:,:w])
+        np.maximum.accumulate(running_max[:,:w],axis=1,out=running_max[:,:w])
+        np.subtract(running_max[:,:w],e_penalty[st:en],out=E[:,st+1:en+1])
+
+        H_cur=H[:,st+1:en+1]
+        np.maximum(H_cur,E[:,st+1:en+1],out=H_cur)
+
+        np.subtract(E[:,st:en],ge,out=running_max[:,:w])
+        np.subtract(H[:,st:en],go,out=tmp[:,:w])
+        np.greater(running_max[:,:w],tmp[:,:w],out=E_is_ext[:,:w])
+
+        #0: diagonal, 1: insertion, 2: deletion, bit 2 and 3 flag gap extensions
+        if band:
+            direction=traceback[:,i,st-(i+band[0]):en-(i+band[0])]
+        else:
+            direction=traceback[:,i,:]
+        np.not_equal(H_cur,diag[:,:w],out=direction)
+        direction+=(direction.view(bool)&(H_cur==F[:,:w])).view(np.uint8)
+        direction|=E_is_ext[:,:w].view(np.uint8)<<2
+        direction|=F_is_ext[:,:w].view(np.uint8)<<3
+
+        if band:
+            #cells on the edges of the band, from where an alignment can leave it
+            j_left,j_right=i+1+band[0],i+1+band[1]
+            if 1<=j_left<=max_len and i+1<len_ref:
+                out_of_band_bound=np.maximum(out_of_band_bound,np.where(reads_len>=j_left,
+                                             H[:,j_left]+max_score*np.minimum(len_ref-i-1,reads_len-j_left),NEG_INF))
+            if j_right<max_len:
+                out_of_band_bound=np.maximum(out_of_band_bound,np.where(reads_len>j_right,
+                                             H[:,j_right]+max_score*np.minimum(len_ref-i-1,reads_len-j_right),NEG_INF))
+
+            #the last column of a read can be outside the band
+            in_band=(reads_len==0)|((reads_len>st)&(reads_len<=en))
+            last_col_scores[:,i+1]=np.where(in_band,H[rows_idx,reads_len],NEG_INF)
+
+            #cells on the right of the band are not reachable from the next row
+            if en<max_len:
+                H[:,en+1]=NEG_INF
+                F_prev[:,en+1]=NEG_INF
+        else:
+            last_col_scores[:,i+1]=H[rows_idx,reads_len]
+
+        H_prev,H=H,H_prev
+        F_prev[:,st+1:en+1]=F[:,:w]
+
+    #end gaps are free, the best alignment ends in the last row or in the last column of each read
+    last_row_scores=H_prev.copy()
+    last_row_scores[np.arange(max_len+1)[None,:]>reads_len[:,None]]=NEG_INF
+    if band:
+        last_row_scores[:,1:st+1]=NEG_INF
+        last_row_scores[:,en+1:]=NEG_INF
+
+    best_j=np.argmax(last_row_scores[:,::-1],axis=1)
+    best_j=max_len-best_j #prefer the longest path in case of ties
+    best_row_score=last_row_scores[rows_idx,best_j]
+
+    best_i=len_ref-np.argmax(last_col_scores[:,::-1],axis=1)
+    best_col_score=last_col_scores[rows_idx,best_i]
+
+    end_on_row=best_row_score>=best_col_score
+    end_i=np.where(end_on_row,len_ref,best_i)
+    end_j=np.where(end_on_row,best_j,reads_len)
+
+    return traceback,end_i,end_j,np.maximum(best_row_score,best_col_score),out_of_band_bound
+
+
+def _traceback_batch(traceback,end_i,end_j,len_ref,reads_len,band=None):
+    '''
+    Walk back the traceback matrix for all the reads of the batch at once.
+    Returns a matrix with the operations (right aligned) and the start of each alignment.
+    '''
+    n_reads=traceback.shape[0]
+    max_len=max(1,reads_len.max()) if n_reads else 1
+    max_aln_len=len_ref+max_len
+
+    ops=np.zeros((n_reads,max_aln_len),dtype=np.uint8)+OP_PAD
+    pos=np.zeros(n_reads,dtype=np.int64)+max_aln_len-1
+
+    i=np.full(n_reads,len_ref,dtype=np.int64)
+    j=reads_len.astype(np.int64).copy()
+
+    #0: H matrix, 1: E matrix (insertion), 2: F matrix (deletion)
+    state=np.zeros(n_reads,dtype=np.uint8)
+
+    rows_idx=np.arange(n_reads)
+
+    active=(i>0)|(j>0)
+    while active.any():
+        op=np.zeros(n_reads,dtype=np.uint8)+OP_PAD
+
+        #trailing end gaps
+        tail_ins=active&(j>end_j)
+        tail_del=active&~tail_ins&(i>end_i)
+        #leading end gaps
+        lead_ins=active&~tail_ins&~tail_del&(i==0)
+        lead_del=active&~tail_ins&~tail_del&(j==0)&(i>0)
+
+        inner=active&~tail_ins&~tail_del&~lead_ins&~lead_del
+
+        direction=np.zeros(n_reads,dtype=np.uint8)
+        if band:
+            direction[inner]=traceback[rows_idx[inner],i[inner]-1,j[inner]-i[inner]-band[0]]
+        else:
+            direction[inner]=traceback[rows_idx[inner],i[inner]-1,j[inner]-1]
+
+        #resolve the H state to the matrix that generated it
+        in_h=inner&(state==0)
+        state[in_h]=direction[in_h]&3
+
+        do_match=inner&(state==0)
+        do_ins=(inner&(state==1))|tail_ins|lead_ins
+        do_del=(inner&(state==2))|tail_del|lead_del
+
+        op[do_match]=OP_MATCH
+        op[do_ins]=OP_INSERTION
+        op[do_del]=OP_DELETION
+
+        #next state, extension keeps the same gap matrix
+        ins_inner=inner&(state==1)
+        del_inner=inner&(state==2)
+        state[ins_inner]=np.where((direction[ins_inner]>>2)&1,1,0)
+        state[del_inner]=np.where((direction[del_inner]>>3)&1,2,0)
+
+        ops[rows_idx[active],pos[active]]=op[active]
+        pos[active]-=1
+
+        i[do_match|do_del]-=1
+        j[do_match|do_ins]-=1
+
+        active=(i>0)|(j>0)
+
+    return ops,pos+1
+
+
+def _render_batch(ref_codes,reads_codes,ops,starts):
+    '''
+    Build the aligned sequences in the same format produced by needle.
+    '''
+    n_reads=ops.shape[0]
+
+    valid=ops!=OP_PAD
+    ref_idx=np.cumsum(valid&(ops!=OP_INSERTION),axis=1)-1
+    read_idx=np.cumsum(valid&(ops!=OP_DELETION),axis=1)-1
+
+    ref_letters=_NT_LETTERS[ref_codes]
+    ref_chars=ref_letters[np.clip(ref_idx,0,len(ref_codes)-1)]
+
+    rows_idx=np.arange(n_reads)[:,None]
+    read_chars=_NT_LETTERS[reads_codes[rows_idx,np.clip(read_idx,0,reads_codes.shape[1]-1)]]
+
+    is_match=ops==OP_MATCH
+    identical=is_match&(ref_chars==read_chars)
+
+    ref_chars[ops==OP_INSERTION]=_GAP_CHAR
+    read_chars[ops==OP_DELETION]=_GAP_CHAR
+
+    pair_scores=EDNAFULL_ACGTN[_NT_CODES[ref_chars],_NT_CODES[read_chars]]
+    aln_str=np.where(identical,_MATCH_CHAR,np.where(is_match&(pair_scores>0),_SIMILAR_CHAR,
+                     np.where(is_match,_MISMATCH_CHAR,_SPACE_CHAR))).astype(np.uint8)
+
+    n_identical=identical.sum(axis=1)
+    aln_len=ops.shape[1]-starts
+
+    results=[]
+    for idx in range(n_reads):
+        st=starts[idx]
+        identity=round(100.0*n_identical[idx]/aln_len[idx],1) if aln_len[idx] else 0.0
+        results.append((identity,
+                        ref_chars[idx,st:].tostring(),
+                        aln_str[idx,st:].tostring(),
+                        read_chars[idx,st:].tostring()))
+    return results
+
+
+def get_band(reads_len,len_ref,band_width):
+    '''
+    Diagonals (j-i) of the band containing the alignments of reads starting or ending together with the
+    reference, plus band_width on each side. None if the band is not narrower than the full matrix.
+    '''
+    d_min=min(0,reads_len.min()-len_ref)-band_width
+    d_max=max(0,reads_len.max()-len_ref)+band_width
+    if d_max-d_min+1>=reads_len.max():
+        return None
+    return (int(d_min),int(d_max))
+
+
+def _align_batches(ref_codes,reads,gap_open,gap_extend,band_width=None):
+    '''
+    Align the reads in batches limited by MAX_CELLS_PER_BATCH
+    '''
+    len_ref=len(ref_codes)
+
+    results=[]
+    batch=[]
+    batch_max_len=0
+
+    def align_current_batch():
+        reads_len=np.array([len(r) for r in batch],dtype=np.int64)
+        reads_codes=np.zeros((len(batch),max(1,reads_len.max())),dtype=np.uint8)+4
+        for idx,read in enumerate(batch):
+            reads_codes[idx,:len(read)]=encode_sequence(read)
+
+        band=get_band(reads_len,len_ref,band_width) if band_width is not None else None
+
+        traceback,end_i,end_j,best_scores,out_of_band_bound=_fill_batch(ref_codes,reads_codes,reads_len,gap_open,gap_extend,band)
+        ops,starts=_traceback_batch(traceback,end_i,end_j,len_ref,reads_len,band)
+        batch_results=_render_batch(ref_codes,reads_codes,ops,starts)
+
+        #fallback to the full matrix when an alignment leaving the band could score as well as the best one inside it
+        may_leave_band=out_of_band_bound>=best_scores
+
+        if may_leave_band.any():
+            unbanded_idxs=np.nonzero(may_leave_band)[0]
+            for idx,result in zip(unbanded_idxs,_align_batches(ref_codes,[batch[idx] for idx in unbanded_idxs],gap_open,gap_extend)):
+                batch_results[idx]=result
+
+        return batch_results
+
+    for read in reads:
+        read_max_len=max(batch_max_len,len(read))
+        if batch and (len(batch)+1)*len_ref*read_max_len>MAX_CELLS_PER_BATCH:
+            results+=align_current_batch()
+            batch=[]
+            read_max_len=len(read)
+
+        batch.append(read)
+        batch_max_len=read_max_len
+
+    if batch:
+        results+=align_current_batch()
+
+    return results
+
+
+def global_align(reference_seq,reads,gap_open=10.0,gap_extend=0.5,band_width=None):
+    '''
+    Globally align each read to the reference sequence with affine gap penalties
+    (a gap of length k costs gap_open+(k-1)*gap_extend) and free end gaps, as needle does.
+
+    If band_width is specified only a band of diagonals around the alignments without indels is
+    computed (see get_band), the reads for which an alignment leaving the band could score as well
+    as the best alignment inside it are aligned again without the band.
+
+    Returns a list of (identity %, aligned reference, alignment string, aligned read)
+    in the same order of the reads.
+    '''
+    ref_codes=encode_sequence(reference_seq.upper())
+
+    if band_width is None:
+        return _align_batches(ref_codes,reads,gap_open,gap_extend)
+
+    #the reads are aligned sorted by length, so the band of each batch is narrower
+    reads=list(reads)
+    order=sorted(range(len(reads)),key=lambda idx: len(reads[idx]))
+
+    results=[None]*len(reads)
+    for idx,result in zip(order,_align_batches(ref_codes,[reads[idx] for idx in order],gap_open,gap_extend,band_width)):
+        results[idx]=result
+
+    return results
@@ -17,8 +17,10 @@ import subprocess as sb
 import argparse
 import re
 import gzip
-from collections import defaultdict
+import heapq
+from collections import defaultdict,OrderedDict
 import multiprocessing as mp
+import threading
 import cPickle as cp
 import unicodedata
 
@@ -102,99 +104,248 @@ def find_wrong_nt(sequence):
     return list(set(sequence.upper()).difference(set(['A','T','C','G','N'])))
 
 
-def get_ids_reads_to_remove(fastq_filename,min_bp_quality=20,min_single_bp_quality=0):
-    ids_to_remove=set()
+def get_reads_from_fastq(fastq_filename,fastq_stats=None):
     if fastq_filename.endswith('.gz'):
         fastq_handle=gzip.open(fastq_filename)
     else:
         fastq_handle=open(fastq_filename)
 
-    for record in SeqIO.parse(fastq_handle, "fastq"):
-        if np.array(record.letter_annotations["phred_quality"]).mean()<min_bp_quality \
-        or np.array(record.letter_annotations["phred_quality"]).min()<min_single_bp_quality:
-            ids_to_remove.add(record.id)
-
-    return ids_to_remove
-
-
-def filter_pe_fastq_by_qual(fastq_r1,fastq_r2,output_filename_r1=None,output_filename_r2=None,min_bp_quality=20,min_single_bp_quality=0):
-
-    ids_to_remove_s1=get_ids_reads_to_remove(fastq_r1,min_bp_quality=min_bp_quality,min_single_bp_quality=min_single_bp_quality)
-    ids_to_remove_s2=get_ids_reads_to_remove(fastq_r2,min_bp_quality=min_bp_quality,min_single_bp_quality=min_single_bp_quality)
-
-    ids_to_remove=ids_to_remove_s1.union(ids_to_remove_s2)
+    stats=FastqStats()
+
+    #same id used by needle, the first word of the header
+    for batch in get_fastq_records_batches(fastq_handle):
+        stats.add_records(batch)
+        for header,seq,_,_ in batch:
+            yield header.split()[0],seq.strip()
+
+    fastq_handle.close()
+
+    if fastq_stats is not None:
+        fastq_stats.set(fastq_filename,stats)
+
+def collapse_reads(reads):
+    '''
+    Collapse identical sequences, returns the id of the first read with each sequence,
+    the unique sequences and how many times they were observed (in order of first appearance).
+    The ids of all the reads are checked for duplicates, also the ones of the collapsed reads.
+    '''
+    seq_to_idx=dict()
+    seen_ids=set()
+    ids=[]
+    seqs=[]
+    counts=[]
+    for id_seq,seq in reads:
+        if id_seq in seen_ids:
+            raise DuplicateSequenceIdException('The .fastq file/s contain/s duplicate sequence IDs')
+        seen_ids.add(id_seq)
+
+        idx=seq_to_idx.get(seq)
+        if idx is None:
+            seq_to_idx[seq]=len(seqs)
+            ids.append(id_seq)
+            seqs.append(seq)
+            counts.append(1)
+        else:
+            counts[idx]+=1
+
+    return ids,seqs,counts
+
+def align_reads_native(reads,reference_seq,name='seq',just_score=False,gap_open=10.0,gap_extend=0.5,band_width=None):
+    '''
+    Align (id,sequence) pairs with the in-process aligner, the dataframe returned has the same
+    format of the one obtained parsing the needle output.
+    '''
+    ids=[]
+    seqs=[]
+    for id_seq,seq in reads:
+        ids.append(id_seq)
+        seqs.append(seq)
+
+    needle_data=[]
+    for id_seq,seq,(identity_seq,aln_ref_seq,aln_str,aln_query_seq) in \
+        zip(ids,seqs,global_align(reference_seq,seqs,gap_open=gap_open,gap_extend=gap_extend,band_width=band_width)):
+        if just_score:
+            needle_data.append([id_seq,identity_seq])
+        else:
+            needle_data.append([id_seq,identity_seq,len(seq),aln_ref_seq,aln_str,aln_query_seq])
 
-    if fastq_r1.endswith('.gz'):
-        fastq_handle_r1=gzip.open(fastq_r1)
+    if just_score:
+        return pd.DataFrame(needle_data,columns=['ID','score_'+name]).set_index('ID')
     else:
-        fastq_handle_r1=open(fastq_r1)
-
-    if fastq_r2.endswith('.gz'):
-        fastq_handle_r2=gzip.open(fastq_r2)
+        return pd.DataFrame(needle_data,columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']).set_index('ID')
+
+def get_exact_match_alignments(reads,name='seq',just_score=False):
+    '''
+    Alignments of reads identical to the reference, in the same format of the ones of the aligner
+    '''
+    if just_score:
+        return pd.DataFrame([[id_seq,100.0] for id_seq,seq in reads],columns=['ID','score_'+name]).set_index('ID')
     else:
-        fastq_handle_r2=open(fastq_r2)
-
-    if not output_filename_r1:
-        output_filename_r1=fastq_r1.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
-
-    if not output_filename_r2:
-        output_filename_r2=fastq_r2.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
-
-    #we cannot use with on gzip with python 2.6 :(
-    try:
-        fastq_filtered_outfile_r1=gzip.open(output_filename_r1,'w+')
-
-        for record in SeqIO.parse(fastq_handle_r1, "fastq"):
-            if not record.id in ids_to_remove:
-                fastq_filtered_outfile_r1.write(record.format('fastq'))
-    except:
-        raise Exception('Error handling the fastq_filtered_outfile_r1')
+        return pd.DataFrame([[id_seq,100.0,len(seq),seq,'|'*len(seq),seq] for id_seq,seq in reads],
+                            columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']).set_index('ID')
 
-    try:
-        fastq_filtered_outfile_r2=gzip.open(output_filename_r2,'w+')
+#max number of parsed alignments kept as lists before being converted to a dataframe
+NEEDLE_RECORDS_BUFFER_SIZE=100000
 
-        for record in SeqIO.parse(fastq_handle_r2, "fastq"):
-            if not record.id in ids_to_remove:
-                fastq_filtered_outfile_r2.write(record.format('fastq'))
-    except:
-        raise Exception('Error handling the fastq_filtered_outfile_r2')
+def parse_needle_records(needle_lines,just_score=False):
+    '''
+    Generator of the alignments parsed from the needle output lines (consumed incrementally, e.g. from a pipe)
+    '''
+    needle_lines=iter(needle_lines)
+    readline=lambda: next(needle_lines,'')
 
+    line=readline()
+    while line:
 
-    return output_filename_r1,output_filename_r2
+            while line and ('# Aligned_sequences' not  in line):
+                    line=readline()
 
+            if line:
+                    readline() #skip another line
 
-def filter_se_fastq_by_qual(fastq_filename,output_filename=None,min_bp_quality=20,min_single_bp_quality=0):
+                    line=readline()
+                    id_seq=line.split()[-1].replace('_',':')
 
-        if fastq_filename.endswith('.gz'):
-                fastq_handle=gzip.open(fastq_filename)
-        else:
-                fastq_handle=open(fastq_filename)
+                    for _ in range(5):
+                            readline()
 
-        if not output_filename:
-                output_filename=fastq_filename.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
+                    line=readline()
 
-        try:
-            fastq_filtered_outfile=gzip.open(output_filename,'w+')
+                    identity_seq=eval(line.strip().split(' ')[-1].replace('%','').replace(')','').replace('(',''))
 
-            for record in SeqIO.parse(fastq_handle, "fastq"):
-                if np.array(record.letter_annotations["phred_quality"]).mean()>=min_bp_quality \
-                and np.array(record.letter_annotations["phred_quality"]).min()>=min_single_bp_quality:
-                    fastq_filtered_outfile.write(record.format('fastq'))
-        except:
-                raise Exception('Error handling the fastq_filtered_outfile')
+                    if just_score:
+                            yield [id_seq,identity_seq]
+                    else:
+                            for _ in range(7):
+                                    readline()
 
+                            line=readline()
+                            aln_ref_seq=line.split()[2]
 
-        return output_filename
 
-def get_avg_read_lenght_fastq(fastq_filename):
-     cmd=('z' if fastq_filename.endswith('.gz') else '' ) +('cat < %s' % fastq_filename)+\
-                  r''' | awk 'BN {n=0;s=0;} NR%4 == 2 {s+=length($0);n++;} END { printf("%d\n",s/n)}' '''
-     p = sb.Popen(cmd, shell=True,stdout=sb.PIPE)
-     return int(p.communicate()[0].strip())
+                            aln_str=readline()[21:].rstrip('\n')
+                            line=readline()
+                            aln_query_seq=line.split()[2]
+                            aln_query_len=line.split()[3]
+                            yield [id_seq,identity_seq,aln_query_len,aln_ref_seq,aln_str,aln_query_seq]
 
-def get_n_reads_fastq(fastq_filename):
-     p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
-     return int(float(p.communicate()[0])/4.0)
+def needle_records_to_dataframe(needle_records,name='seq',just_score=False,buffer_size=NEEDLE_RECORDS_BUFFER_SIZE):
+    if just_score:
+        columns=['ID','score_'+name]
+    else:
+        columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']
+
+    df_chunks=[]
+    buffer_records=[]
+    for record in needle_records:
+        buffer_records.append(record)
+        if len(buffer_records)>=buffer_size:
+            df_chunks.append(pd.DataFrame(buffer_records,columns=columns))
+            buffer_records=[]
+    df_chunks.append(pd.DataFrame(buffer_records,columns=columns))
+
+    return pd.concat(df_chunks,ignore_index=True).set_index('ID')
+
+def tee_lines(lines,outfile):
+    for line in lines:
+        outfile.write(line)
+        yield line
+
+def align_reads_native_shard(shard_args):
+    #used to align a shard of the reads against all the references in a separate process
+    reads,references,gap_open,gap_extend,band_width=shard_args
+    return [align_reads_native(reads,reference_seq,name,just_score,gap_open,gap_extend,band_width) for name,reference_seq,just_score in references]
+
+def combine_alignments(df_alignments):
+    '''
+    Put side by side the alignments of the same reads (in the same order) against different references
+    '''
+    df_combined=df_alignments[0]
+    for df_alignment in df_alignments[1:]:
+        for column in df_alignment.columns:
+            df_combined[column]=df_alignment[column].values
+    return df_combined
+
+def get_interleaved_shards(items,n_shards):
+    return [items[idx_shard::n_shards] for idx_shard in range(n_shards)]
+
+def merge_interleaved_shards(df_shards,shard_sizes):
+    '''
+    Restore the original order of the rows of the concatenated shards obtained with get_interleaved_shards
+    '''
+    n_shards=len(shard_sizes)
+    original_positions=np.hstack([np.arange(shard_size)*n_shards+idx_shard for idx_shard,shard_size in enumerate(shard_sizes)])
+    return df_shards.iloc[np.argsort(original_positions)]
+
+#default k-mer size and number of reads processed at once by the k-mer strand classifier and prefilter
+KMER_SIZE=10
+KMER_BATCH_SIZE=10000
+
+#flags of the k-mer table
+_KMER_IN_FORWARD=1
+_KMER_IN_RC=2
+
+def get_kmer_codes(seqs,k=KMER_SIZE):
+    '''
+    Matrix with the 2 bits encoding of all the k-mers of each sequence (right padded),
+    k-mers with other characters than ACGT or past the end of a sequence are -1
+    '''
+    nt_codes=np.zeros(256,dtype=np.int64)+4
+    for idx,nt in enumerate('ACGT'):
+        nt_codes[ord(nt)]=idx
+        nt_codes[ord(nt.lower())]=idx
+
+    max_len=max([len(seq) for seq in seqs]+[k])
+    seqs_codes=nt_codes[np.array(seqs,dtype='S%d' % max_len).view(np.uint8).reshape(len(seqs),max_len)]
+    n_kmers=max_len-k+1
+
+    kmer_codes=np.zeros((len(seqs),n_kmers),dtype=np.int64)
+    invalid=np.zeros((len(seqs),n_kmers),dtype=bool)
+    for j in range(k):
+        window=seqs_codes[:,j:j+n_kmers]
+        kmer_codes=kmer_codes*4+(window&3)
+        invalid|=window>3
+
+    kmer_codes[invalid]=-1
+    return kmer_codes
+
+def build_kmer_table(reference_seqs,k=KMER_SIZE):
+    '''
+    Flags for each k-mer if it is found in the reference sequences and/or in their reverse complement
+    '''
+    forward_kmers=get_kmer_codes([seq.upper() for seq in reference_seqs],k)
+    rc_kmers=get_kmer_codes([reverse_complement(seq) for seq in reference_seqs],k)
+
+    kmer_table=np.zeros(4**k,dtype=np.uint8)
+    kmer_table[forward_kmers[forward_kmers>=0]]|=_KMER_IN_FORWARD
+    kmer_table[rc_kmers[rc_kmers>=0]]|=_KMER_IN_RC
+
+    return kmer_table
+
+def count_shared_kmers(seqs,kmer_table,k=KMER_SIZE,batch_size=KMER_BATCH_SIZE):
+    '''
+    For each read the number of k-mers found in the reference sequences, in their reverse complement
+    and the total number of k-mers (only ACGT)
+    '''
+    n_forward=np.zeros(len(seqs),dtype=int)
+    n_rc=np.zeros(len(seqs),dtype=int)
+    n_kmers=np.zeros(len(seqs),dtype=int)
+    for st in range(0,len(seqs),batch_size):
+        kmer_codes=get_kmer_codes(seqs[st:st+batch_size],k)
+        flags=np.where(kmer_codes>=0,kmer_table[np.maximum(kmer_codes,0)],0)
+        n_forward[st:st+batch_size]=(flags&_KMER_IN_FORWARD>0).sum(axis=1)
+        n_rc[st:st+batch_size]=(flags&_KMER_IN_RC>0).sum(axis=1)
+        n_kmers[st:st+batch_size]=(kmer_codes>=0).sum(axis=1)
+    return n_forward,n_rc,n_kmers
+
+def get_min_shared_kmers_fraction(min_identity_score,k=KMER_SIZE):
+    '''
+    Fraction of the k-mers of a read expected in the reference when each base matches with probability
+    min_identity_score/100, independently of the others (random errors). It is only a loose threshold: about 0.6%
+    (roughly one shared k-mer per read) with the default values, while mismatches evenly spaced every k bp or less
+    leave no shared k-mers also at identities higher than min_identity_score
+    '''
+    return (min(max(min_identity_score,0.0),100.0)/100.0)**k
 
 matplotlib=check_library('matplotlib')
 from matplotlib import font_manager as fm
@@ -211,16 +362,14 @@ pd=check_library('pandas')
 np=check_library('numpy')
 Bio=check_library('Bio')
 
-check_program('java')
-check_program('flash')
-check_program('needle')
-
 sns=check_library('seaborn')
 sns.set_context('poster')
 sns.set(font_scale=2.2)
 sns.set_style('white')
 
-from Bio import SeqIO,pairwise2
+from Bio import pairwise2
+from CRISPResso.CRISPRessoAlign import global_align,parse_needle_options
+from CRISPResso.CRISPRessoFastq import get_fastq_records_batches,filter_pe_fastq_by_qual,filter_se_fastq_by_qual,FastqStats,RunFastqStats
 #########################################
 
 
@@ -265,10 +414,290 @@ class DuplicateSequenceIdException(Exception):
 class NoReadsAfterQualityFiltering(Exception):
     pass
 
+class PlotDataVersionException(Exception):
+    pass
+
 #########################################
 
 
-def process_df_chunk(df_needle_alignment_chunk):
+#number of alignments encoded at once as fixed width arrays during the quantification
+QUANTIFICATION_BLOCK_SIZE=20000
+
+_ALN_GAP=ord('-')
+_ALN_SUBSTITUTION=ord('.')
+
+def encode_alignments(aligned_seqs):
+    '''
+    Encode aligned sequences as a matrix of characters, right padded with 0
+    '''
+    max_len=max([1]+[len(seq) for seq in aligned_seqs])
+    return np.array(aligned_seqs,dtype='S%d' % max_len).view(np.uint8).reshape(len(aligned_seqs),max_len)
+
+def decode_alignments(aln_codes):
+    '''
+    Inverse of encode_alignments, the padding is removed
+    '''
+    return aln_codes.view('S%d' % aln_codes.shape[1]).ravel().tolist()
+
+def compute_ref_positions(aln_ref):
+    '''
+    Position of each column of the encoded reference alignments on the amplicon,
+    insertions get the (negative) position of the previous bp and -1 before the first bp
+    '''
+    is_ref_bp=(aln_ref!=_ALN_GAP) & (aln_ref!=0)
+    n_bp_before=np.cumsum(is_ref_bp,axis=1)-is_ref_bp
+    return np.where(is_ref_bp,n_bp_before,np.where(n_bp_before==0,-1,-n_bp_before))
+
+class AlignmentStore(object):
+    '''
+    Alignments of the reads as fixed width matrices of character codes (one row for each read, right padded with 0),
+    the reads are identified by their row and the other values of each read are kept in numpy arrays
+    '''
+    CODE_COLUMNS=['ref_seq','align_str','align_seq']
+
+    def __init__(self,codes,columns):
+        self.codes=codes
+        self.columns=columns
+
+    @classmethod
+    def from_dataframe(cls,df_alignment):
+        codes=dict([(name,encode_alignments(list(df_alignment[name].values))) for name in cls.CODE_COLUMNS])
+        width=max([aln_codes.shape[1] for aln_codes in codes.values()])
+        for name,aln_codes in codes.items():
+            codes[name]=np.pad(aln_codes,((0,0),(0,width-aln_codes.shape[1])),'constant')
+
+        columns=OrderedDict([(name,df_alignment[name].values) for name in df_alignment.columns if name not in cls.CODE_COLUMNS])
+        return cls(codes,columns)
+
+    def __len__(self):
+        return self.codes['ref_seq'].shape[0]
+
+    @property
+    def width(self):
+        return self.codes['ref_seq'].shape[1]
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def __setitem__(self,name,values):
+        values=np.asarray(values)
+        self.columns[name]=np.repeat(values,len(self)) if values.ndim==0 else values
+
+    def take(self,rows):
+        #rows can be a slice, a boolean mask or the ordinals of the reads
+        return AlignmentStore(dict([(name,aln_codes[rows]) for name,aln_codes in self.codes.items()]),
+                              OrderedDict([(name,values[rows]) for name,values in self.columns.items()]))
+
+    def alignment_lengths(self,rows=slice(None)):
+        return (self.codes['ref_seq'][rows]!=0).sum(axis=1)
+
+    def ref_positions(self,rows=slice(None)):
+        return compute_ref_positions(self.codes['ref_seq'][rows])
+
+    def decode(self,name,rows=slice(None)):
+        return decode_alignments(self.codes[name][rows])
+
+    def to_dataframe(self,names=None):
+        if names is None:
+            names=self.CODE_COLUMNS+self.columns.keys()
+        return pd.DataFrame(OrderedDict([(name,self.decode(name) if name in self.CODE_COLUMNS else self.columns[name]) for name in names]),
+                            columns=names)
+
+    def row_keys(self,names):
+        #one fixed width binary key for each read, the reads with the same values of the columns have the same key
+        blocks=[self.codes[name] if name in self.CODE_COLUMNS else
+                np.ascontiguousarray(self.columns[name]).view(np.uint8).reshape(len(self),self.columns[name].dtype.itemsize) for name in names]
+        keys=np.ascontiguousarray(np.hstack(blocks))
+        return keys.view('V%d' % keys.shape[1]).ravel()
+
+    def save_shared(self,prefix):
+        #the codes and the numeric columns are saved as .npy files that the processes of the pool map in memory
+        names=[name for name,values in self.columns.items() if values.dtype!=object]
+        filenames=[]
+        for name,values in [('codes_'+name,aln_codes) for name,aln_codes in self.codes.items()]+[('column_'+name,self.columns[name]) for name in names]:
+            filenames.append('%s_%s.npy' % (prefix,name))
+            np.save(filenames[-1],values)
+        return names,filenames
+
+    @classmethod
+    def load_shared(cls,prefix,names,rows=slice(None)):
+        return cls(dict([(name,np.load('%s_codes_%s.npy' % (prefix,name),mmap_mode='r')[rows]) for name in cls.CODE_COLUMNS]),
+                   OrderedDict([(name,np.load('%s_column_%s.npy' % (prefix,name),mmap_mode='r')[rows]) for name in names]))
+
+    def save(self,filename):
+        arrays=dict([('codes_'+name,aln_codes) for name,aln_codes in self.codes.items()])
+        arrays.update([('column_'+name,values) for name,values in self.columns.items()])
+        np.savez(filename,column_names=np.array(self.columns.keys()),**arrays)
+
+class AlleleCounter(object):
+    '''
+    Number of reads of each allele (the values of the allele columns), the reads of a store are grouped on the
+    binary keys of their encoded alignments and only one representative of each allele is decoded
+    '''
+    def __init__(self,names):
+        self.names=names
+        self.counts=dict()
+        self.n_reads=0
+
+    def count_alleles(self,store,weights):
+        #list of (allele,number of reads) for the alleles of the store
+        if not len(store):
+            return []
+        _,rows,allele_idxs=np.unique(store.row_keys(self.names),return_index=True,return_inverse=True)
+        n_reads=np.bincount(allele_idxs,weights=weights)
+        values=[store.decode(name,rows) if name in store.CODE_COLUMNS else store[name][rows].tolist() for name in self.names]
+        return zip(zip(*values),[int(round(n)) for n in n_reads])
+
+    def add(self,store,weights):
+        for allele,n in self.count_alleles(store,weights):
+            self.counts[allele]=self.counts.get(allele,0)+n
+            self.n_reads+=n
+        return self
+
+    def to_dataframe(self,count_name='n_reads'):
+        #sorted as the alleles grouped by pandas
+        return pd.DataFrame([allele+(n,) for allele,n in sorted(self.counts.items())],columns=self.names+[count_name])
+
+class TopAlleleCounter(AlleleCounter):
+    '''
+    Space-Saving summary that keeps in memory at most max_alleles alleles, the most frequent ones. The exact counts of the
+    alleles of each batch are spilled to a tab separated file, read again at the end to report exact counts for the tracked alleles.
+    min_count is 0 while all the alleles are tracked, otherwise the alleles with at most min_count reads can be missing
+    '''
+    def __init__(self,names,max_alleles,spill_filename):
+        AlleleCounter.__init__(self,names)
+        self.max_alleles=max_alleles
+        self.spill_filename=spill_filename
+        self.n_batches=0
+        self.min_count=0
+
+    def add(self,store,weights):
+        allele_counts=self.count_alleles(store,weights)
+        if not allele_counts:
+            return self
+
+        with open(self.spill_filename,'w' if self.n_batches==0 else 'a') as handle:
+            pd.DataFrame([(self.n_batches,)+allele+(n,) for allele,n in allele_counts],columns=['batch']+self.names+['n_reads'])\
+                .to_csv(handle,sep='\t',header=self.n_batches==0,index=None)
+        self.n_batches+=1
+
+        #an allele not tracked could have been seen up to min_count times in the previous batches, so its count is overestimated
+        for allele,n in allele_counts:
+            self.counts[allele]=self.counts.get(allele,self.min_count)+n
+            self.n_reads+=n
+
+        #the least frequent alleles are evicted, from the first eviction the summary is always full
+        if len(self.counts)>self.max_alleles:
+            self.counts=dict(heapq.nlargest(self.max_alleles,self.counts.items(),key=lambda allele_count: allele_count[1]))
+            self.min_count=min(self.counts.values())
+        elif self.min_count:
+            self.min_count=min(self.counts.values())
+        return self
+
+    def to_dataframe(self,count_name='n_reads'):
+        #exact counts of the tracked alleles from the spilled counts of each batch
+        exact_counts=dict([(allele,0) for allele in self.counts])
+        if self.n_batches:
+            for df_spill in pd.read_csv(self.spill_filename,sep='\t',keep_default_na=False,chunksize=100000,
+                                       dtype=dict([(name,str) for name in self.names if name in AlignmentStore.CODE_COLUMNS])):
+                for row in df_spill[self.names+['n_reads']].itertuples(index=False):
+                    allele=tuple(row[:-1])
+                    if allele in exact_counts:
+                        exact_counts[allele]+=row[-1]
+        return pd.DataFrame([tracked_allele+(int(n),) for tracked_allele,n in sorted(exact_counts.items())],columns=self.names+[count_name])
+
+def find_runs(mask):
+    '''
+    Find the runs of True in each row of a boolean matrix, returns the row, the start and the end (excluded) of each run
+    '''
+    padded=np.zeros((mask.shape[0],mask.shape[1]+2),dtype=np.int8)
+    padded[:,1:-1]=mask
+    transitions=np.diff(padded,axis=1)
+    rows,starts=np.nonzero(transitions==1)
+    ends=np.nonzero(transitions==-1)[1]
+    return rows,starts,ends
+
+def positions_in_mask(positions,mask):
+    #negative positions (gaps before the first bp of the reference) are never in the mask
+    return (positions>=0) & mask[np.clip(positions,0,len(mask)-1)]
+
+def add_positions(vector,rows,positions,weights):
+    #like vector[positions]+=weight, negative positions wrap around as for numpy indexing
+    if len(rows):
+        vector+=np.bincount(positions % len(vector),weights=weights[rows],minlength=len(vector))
+
+def unique_row_positions(rows,positions,len_vector):
+    #remove the duplicated positions (after wrapping) of each read
+    keys=np.unique(rows*len_vector+positions % len_vector)
+    return keys // len_vector, keys % len_vector
+
+#name of the file with the quantification saved in the output folder
+QUANTIFICATION_FILENAME='CRISPResso_quantification.npz'
+
+class QuantificationAccumulator(object):
+    '''
+    Sums of the quantification of a set of reads: vectors over the amplicon positions, histograms (value -> number of reads) and counters.
+    The accumulators of disjoint sets of reads (chunks, batches, runs) can be merged in any order
+    '''
+    VECTOR_NAMES=['effect_vector_insertion','effect_vector_deletion','effect_vector_mutation','effect_vector_any',
+                  'effect_vector_insertion_mixed','effect_vector_deletion_mixed','effect_vector_mutation_mixed',
+                  'effect_vector_insertion_hdr','effect_vector_deletion_hdr','effect_vector_mutation_hdr',
+                  'effect_vector_insertion_noncoding','effect_vector_deletion_noncoding','effect_vector_mutation_noncoding',
+                  'avg_vector_del_all','avg_vector_ins_all']
+
+    #histograms of the effective length in the exons, of the number of substituted, inserted and deleted bp and of the indel size
+    HIST_NAMES=['hist_inframe','hist_frameshift','hist_mutated','hist_inserted','hist_deleted','hist_indel_size']
+
+    COUNTER_NAMES=['MODIFIED_FRAMESHIFT','MODIFIED_NON_FRAMESHIFT','NON_MODIFIED_NON_FRAMESHIFT','SPLICING_SITES_MODIFIED',
+                   'N_TOTAL','N_UNMODIFIED','N_MODIFIED','N_REPAIRED','N_MIXED_HDR_NHEJ',
+                   'nhej_inserted','nhej_deleted','nhej_mutated','hdr_inserted','hdr_deleted','hdr_mutated',
+                   'mixed_inserted','mixed_deleted','mixed_mutated']
+
+    def __init__(self,len_amplicon):
+        self.vectors=OrderedDict([(name,np.zeros(len_amplicon)) for name in self.VECTOR_NAMES])
+        self.hists=OrderedDict([(name,dict()) for name in self.HIST_NAMES])
+        self.counters=OrderedDict([(name,0) for name in self.COUNTER_NAMES])
+
+    def merge(self,other):
+        for name,vector in self.vectors.items():
+            if vector.shape!=other.vectors[name].shape:
+                raise Exception('Cannot merge the quantification of amplicons of different length!')
+            vector+=other.vectors[name]
+        for name,hist in self.hists.items():
+            add_hist(other.hists[name],hist)
+        for name in self.counters:
+            self.counters[name]+=other.counters[name]
+        return self
+
+    def save(self,filename):
+        arrays=dict([('vector_'+name,vector) for name,vector in self.vectors.items()])
+        for name,hist in self.hists.items():
+            keys=sorted(hist.keys())
+            arrays['hist_keys_'+name]=np.array(keys)
+            arrays['hist_values_'+name]=np.array([hist[key] for key in keys])
+        arrays.update([('counter_'+name,np.array(value)) for name,value in self.counters.items()])
+        np.savez(filename,**arrays)
+
+    @classmethod
+    def load(cls,filename):
+        data=np.load(filename)
+        quantification=cls(len(data['vector_'+cls.VECTOR_NAMES[0]]))
+        for name in cls.VECTOR_NAMES:
+            quantification.vectors[name]=data['vector_'+name]
+        for name in cls.HIST_NAMES:
+            add_hist(dict(zip(data['hist_keys_'+name].tolist(),data['hist_values_'+name].tolist())),quantification.hists[name])
+        for name in cls.COUNTER_NAMES:
+            quantification.counters[name]=data['counter_'+name].item()
+        return quantification
+
+    @classmethod
+    def load_from_folder(cls,output_folder):
+        return cls.load(os.path.join(output_folder,QUANTIFICATION_FILENAME))
+
+    def save_to_folder(self,output_folder):
+        self.save(os.path.join(output_folder,QUANTIFICATION_FILENAME))
+
+def process_df_chunk(alignment_store_chunk):
 
 
      MODIFIED_FRAMESHIFT=0
@@ -282,261 +711,284 @@ def process_df_chunk(df_needle_alignment_chunk):
      else:
          PERFORM_FRAMESHIFT_ANALYSIS=False
 
-     effect_vector_insertion=np.zeros(len_amplicon)
-     effect_vector_deletion=np.zeros(len_amplicon)
-     effect_vector_mutation=np.zeros(len_amplicon)
-     effect_vector_any=np.zeros(len_amplicon)
-
-     effect_vector_insertion_mixed=np.zeros(len_amplicon)
-     effect_vector_deletion_mixed=np.zeros(len_amplicon)
-     effect_vector_mutation_mixed=np.zeros(len_amplicon)
-
-     effect_vector_insertion_hdr=np.zeros(len_amplicon)
-     effect_vector_deletion_hdr=np.zeros(len_amplicon)
-     effect_vector_mutation_hdr=np.zeros(len_amplicon)
-
-     effect_vector_insertion_noncoding=np.zeros(len_amplicon)
-     effect_vector_deletion_noncoding=np.zeros(len_amplicon)
-     effect_vector_mutation_noncoding=np.zeros(len_amplicon)
-
-     hist_inframe=defaultdict(lambda :0)
-     hist_frameshift=defaultdict(lambda :0)
-
-     avg_vector_del_all=np.zeros(len_amplicon)
-     avg_vector_ins_all=np.zeros(len_amplicon)
-
-     re_find_indels=re.compile("(-*-)")
-     re_find_substitutions=re.compile("(\.*\.)")
-
-
-     for idx_row,row in df_needle_alignment_chunk.iterrows():
-
-                 #GET THE MUTATIONS POSITIONS
-                 if row.UNMODIFIED:
-                     continue
-
-                 if PERFORM_FRAMESHIFT_ANALYSIS:
-                    lenght_modified_positions_exons=[]
-                    current_read_exons_modified=False
-                    current_read_spliced_modified=False
-
-                 #quantify substitution
-                 substitution_positions=[]
-                 if not args.ignore_substitutions:
-                     for p in re_find_substitutions.finditer(row.align_str):
-                         st,en=p.span()
-                         substitution_positions.append(row.ref_positions[st:en])
-
-                     if substitution_positions:
-                         substitution_positions=list(np.hstack(substitution_positions))
-
-                 #quantify deletion
-                 deletion_positions=[]
-                 deletion_positions_flat=[]
-                 deletion_sizes=[]
-
-                 if not args.ignore_deletions:
-                     for p in re_find_indels.finditer(row.align_seq):
-                         st,en=p.span()
-                         deletion_positions.append(row.ref_positions[st:en])
-                         deletion_sizes.append(en-st)
-
-                     if deletion_positions:
-                         deletion_positions_flat=np.hstack(deletion_positions)
-
-                 #quantify insertion
-                 insertion_positions=[]
-                 insertion_sizes=[]
-                 insertion_positions_flat=[]
-
-                 if not args.ignore_insertions:
-                     for p in re_find_indels.finditer(row.ref_seq):
-                         st,en=p.span()
-                         #ref_st=row.ref_positions[st-1] # we report the base preceding the insertion
-
-                         #insertion_positions.append(ref_st)
-                         insertion_positions.append([row['ref_positions'][max(0,st-1)],row['ref_positions'][min(len(row['ref_positions'])-1,en)]])
-                         insertion_sizes.append(en-st)
-
-                     if insertion_positions:
-                         insertion_positions_flat=np.hstack(insertion_positions)
-
-
-                 ########CLASSIFY READ
-                 #WE HAVE THE DONOR SEQUENCE
-                 if args.expected_hdr_amplicon_seq:
-
-                    #HDR
-                    if (row.score_diff<0) & (row.score_repaired>=args.hdr_perfect_alignment_threshold):
-                        df_needle_alignment_chunk.ix[idx_row,'HDR']=True
-
-                    #MIXED
-                    elif (row.score_diff<0) & (row.score_repaired<args.hdr_perfect_alignment_threshold):
-                        df_needle_alignment_chunk.ix[idx_row,'MIXED']=True
-
-                    else:
-                        #NHEJ
-                        if include_idxs.intersection(substitution_positions) \
-                        or include_idxs.intersection(insertion_positions_flat) or \
-                        include_idxs.intersection(deletion_positions_flat):
-                            df_needle_alignment_chunk.ix[idx_row,'NHEJ']=True
-
-                        #UNMODIFIED
-                        else:
-                            df_needle_alignment_chunk.ix[idx_row,'UNMODIFIED']=True
-
-                 #NO DONOR SEQUENCE PROVIDED
-                 else:
-                    #NHEJ
-                    if include_idxs.intersection(substitution_positions) \
-                        or include_idxs.intersection(insertion_positions_flat) or \
-                        include_idxs.intersection(deletion_positions_flat):
-                        df_needle_alignment_chunk.ix[idx_row,'NHEJ']=True
-
-                    #UNMODIFIED
-                    else:
-                        df_needle_alignment_chunk.ix[idx_row,'UNMODIFIED']=True
-
-
-                 ###CREATE AVERAGE SIGNALS, HERE WE SHOW EVERYTHING...
-                 if df_needle_alignment_chunk.ix[idx_row,'MIXED']:
-                    effect_vector_mutation_mixed[substitution_positions]+=1
-                    effect_vector_deletion_mixed[deletion_positions_flat]+=1
-                    effect_vector_insertion_mixed[insertion_positions_flat]+=1
-
-                 elif df_needle_alignment_chunk.ix[idx_row,'HDR']:
-                    effect_vector_mutation_hdr[substitution_positions]+=1
-                    effect_vector_deletion_hdr[deletion_positions_flat]+=1
-                    effect_vector_insertion_hdr[insertion_positions_flat]+=1
-
-                 elif df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and not args.hide_mutations_outside_window_NHEJ:
-                    effect_vector_mutation[substitution_positions]+=1
-                    effect_vector_deletion[deletion_positions_flat]+=1
-                    effect_vector_insertion[insertion_positions_flat]+=1
-
-                 any_positions=np.unique(np.hstack([deletion_positions_flat,insertion_positions_flat,substitution_positions])).astype(int)
-                 effect_vector_any[any_positions]+=1
-
-                 #For NHEJ we count only the events that overlap the window specified around
-                 #the cut site (1bp by default)...
-                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and args.window_around_sgrna:
-
-                    substitution_positions=list(include_idxs.intersection(substitution_positions))
-
-                    insertion_positions_window=[]
-                    insertion_sizes_window=[]
-
-                    #count insertions overlapping
-                    for idx_ins,ins_pos_set in enumerate(insertion_positions):
-                        #print ref_st, insertion_positions
-                        if include_idxs.intersection(ins_pos_set):
-                            insertion_positions_window.append(ins_pos_set)
-                            insertion_sizes_window.append(insertion_sizes[idx_ins])
-
-                    insertion_positions=insertion_positions_window
-                    insertion_sizes=insertion_sizes_window
-
-                    deletion_positions_window=[]
-                    deletion_sizes_window=[]
-                    for idx_del,del_pos_set in enumerate(deletion_positions):
-                        if include_idxs.intersection(del_pos_set):
-                            deletion_positions_window.append(del_pos_set)
-                            deletion_sizes_window.append(deletion_sizes[idx_del])
-
-                    deletion_positions=deletion_positions_window
-                    deletion_sizes=deletion_sizes_window
-
-                    if deletion_positions:
-                        deletion_positions_flat=np.hstack(deletion_positions)
-
-                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and args.hide_mutations_outside_window_NHEJ:
-                    effect_vector_mutation[substitution_positions]+=1
-                    effect_vector_deletion[deletion_positions_flat]+=1
-                    effect_vector_insertion[insertion_positions_flat]+=1
-
-
-                 ####QUANTIFICATION AND FRAMESHIFT ANALYSIS
-                 if not df_needle_alignment_chunk.ix[idx_row,'UNMODIFIED']:
-
-                    df_needle_alignment_chunk.ix[idx_row,'n_mutated']=len(substitution_positions)
-                    df_needle_alignment_chunk.ix[idx_row,'n_inserted']=np.sum(insertion_sizes)
-                    df_needle_alignment_chunk.ix[idx_row,'n_deleted']=np.sum(deletion_sizes)
-
-                    for idx_ins,ins_pos_set in enumerate(insertion_positions):
-                        avg_vector_ins_all[ins_pos_set]+=insertion_sizes[idx_ins]
-
-                        if PERFORM_FRAMESHIFT_ANALYSIS:
-                            if set(exon_positions).intersection(ins_pos_set): # check that we are inserting in one exon
-                                lenght_modified_positions_exons.append(insertion_sizes[idx_ins])
-                                current_read_exons_modified=True
-
-                    for idx_del,del_pos_set in enumerate(deletion_positions):
-                        avg_vector_del_all[del_pos_set]+=deletion_sizes[idx_del]
-
-
-                    if PERFORM_FRAMESHIFT_ANALYSIS:
-                        del_positions_to_append=sorted(set(exon_positions).intersection(set(deletion_positions_flat)))
-                        if del_positions_to_append:
-                                #Always use the low include upper not
-                                current_read_exons_modified=True
-                                lenght_modified_positions_exons.append(-len(del_positions_to_append))
-
-                        if set(exon_positions).intersection(substitution_positions):
-                                current_read_exons_modified=True
-
-                        if set(splicing_positions).intersection(substitution_positions):
-                                current_read_spliced_modified=True
-
-                        if set(splicing_positions).intersection(deletion_positions_flat):
-                                current_read_spliced_modified=True
-
-                        if set(splicing_positions).intersection(insertion_positions_flat):
-                                current_read_spliced_modified=True
-
-                        if current_read_spliced_modified:
-                            SPLICING_SITES_MODIFIED+=1
-
-                        #if modified check if frameshift
-                        if current_read_exons_modified:
-
-                            if not lenght_modified_positions_exons:
-                                #there are no indels
-                                MODIFIED_NON_FRAMESHIFT+=1
-                                hist_inframe[0]+=1
-                            else:
-
-                                effetive_length=sum(lenght_modified_positions_exons)
-
-                                if (effetive_length % 3 )==0:
-                                    MODIFIED_NON_FRAMESHIFT+=1
-                                    hist_inframe[effetive_length]+=1
-                                else:
-                                    MODIFIED_FRAMESHIFT+=1
-                                    hist_frameshift[effetive_length]+=1
-
-                        #the indels and subtitutions are outside the exon/s  so we don't care!
-                        else:
-                            NON_MODIFIED_NON_FRAMESHIFT+=1
-                            effect_vector_insertion_noncoding[insertion_positions_flat]+=1
-                            effect_vector_deletion_noncoding[deletion_positions_flat]+=1
-                            effect_vector_mutation_noncoding[substitution_positions]+=1
-
-     hist_inframe=dict(hist_inframe)
-     hist_frameshift=dict(hist_frameshift)
-
-     return      df_needle_alignment_chunk, effect_vector_insertion,effect_vector_deletion,\
-     effect_vector_mutation,effect_vector_any,effect_vector_insertion_mixed,effect_vector_deletion_mixed,\
-     effect_vector_mutation_mixed,effect_vector_insertion_hdr,effect_vector_deletion_hdr,effect_vector_mutation_hdr,\
-     effect_vector_insertion_noncoding,effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,hist_inframe,\
-     hist_frameshift,avg_vector_del_all,avg_vector_ins_all,MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,NON_MODIFIED_NON_FRAMESHIFT,\
-     SPLICING_SITES_MODIFIED
-
-
-
+     #the vectors and the histograms are updated in place
+     quantification=QuantificationAccumulator(len_amplicon)
+
+     effect_vector_insertion=quantification.vectors['effect_vector_insertion']
+     effect_vector_deletion=quantification.vectors['effect_vector_deletion']
+     effect_vector_mutation=quantification.vectors['effect_vector_mutation']
+     effect_vector_any=quantification.vectors['effect_vector_any']
+
+     effect_vector_insertion_mixed=quantification.vectors['effect_vector_insertion_mixed']
+     effect_vector_deletion_mixed=quantification.vectors['effect_vector_deletion_mixed']
+     effect_vector_mutation_mixed=quantification.vectors['effect_vector_mutation_mixed']
+
+     effect_vector_insertion_hdr=quantification.vectors['effect_vector_insertion_hdr']
+     effect_vector_deletion_hdr=quantification.vectors['effect_vector_deletion_hdr']
+     effect_vector_mutation_hdr=quantification.vectors['effect_vector_mutation_hdr']
+
+     effect_vector_insertion_noncoding=quantification.vectors['effect_vector_insertion_noncoding']
+     effect_vector_deletion_noncoding=quantification.vectors['effect_vector_deletion_noncoding']
+     effect_vector_mutation_noncoding=quantification.vectors['effect_vector_mutation_noncoding']
+
+     hist_inframe=quantification.hists['hist_inframe']
+     hist_frameshift=quantification.hists['hist_frameshift']
+
+     avg_vector_del_all=quantification.vectors['avg_vector_del_all']
+     avg_vector_ins_all=quantification.vectors['avg_vector_ins_all']
+
+     no_positions=np.array([],dtype=int)
+
+     n_rows_chunk=len(alignment_store_chunk)
+     unmodified_all=alignment_store_chunk['UNMODIFIED'].copy()
+     nhej_all=np.zeros(n_rows_chunk,dtype=bool)
+     hdr_all=np.zeros(n_rows_chunk,dtype=bool)
+     mixed_all=np.zeros(n_rows_chunk,dtype=bool)
+     n_mutated_all=np.zeros(n_rows_chunk,dtype=int)
+     n_inserted_all=np.zeros(n_rows_chunk)
+     n_deleted_all=np.zeros(n_rows_chunk)
+
+     #the perfect alignments don't need to be quantified
+     idxs_to_quantify=np.nonzero(~unmodified_all)[0]
+
+     for block_st in range(0,len(idxs_to_quantify),QUANTIFICATION_BLOCK_SIZE):
+
+         idxs_block=idxs_to_quantify[block_st:block_st+QUANTIFICATION_BLOCK_SIZE]
+         n_rows=len(idxs_block)
+         n_reads=alignment_store_chunk['n_reads'][idxs_block].astype(int)
+
+         #one row per read, the position of each column on the amplicon is derived from the reference row
+         aln_ref=alignment_store_chunk.codes['ref_seq'][idxs_block]
+         aln_lens=alignment_store_chunk.alignment_lengths(idxs_block)
+         ref_positions=compute_ref_positions(aln_ref)
+
+         #quantify substitution
+         if not args.ignore_substitutions:
+             sub_rows,sub_cols=np.nonzero(alignment_store_chunk.codes['align_str'][idxs_block]==_ALN_SUBSTITUTION)
+             sub_pos=ref_positions[sub_rows,sub_cols]
+         else:
+             sub_rows,sub_pos=no_positions,no_positions
+
+         #quantify deletion, one entry for each deleted bp and one for each deletion event
+         if not args.ignore_deletions:
+             del_mask=alignment_store_chunk.codes['align_seq'][idxs_block]==_ALN_GAP
+             del_rows,del_cols=np.nonzero(del_mask)
+             del_pos=ref_positions[del_rows,del_cols]
+             del_event_rows,del_event_st,del_event_en=find_runs(del_mask)
+             del_sizes=del_event_en-del_event_st
+             is_event_start=np.ones(len(del_cols),dtype=bool)
+             is_event_start[1:]=(del_rows[1:]!=del_rows[:-1]) | (del_cols[1:]!=del_cols[:-1]+1)
+             del_event=np.cumsum(is_event_start)-1
+         else:
+             del_rows,del_pos,del_event,del_event_rows,del_sizes=no_positions,no_positions,no_positions,no_positions,no_positions
+
+         #quantify insertion, each event is flanked by the bp before and after it
+         if not args.ignore_insertions:
+             ins_rows,ins_st,ins_en=find_runs(aln_ref==_ALN_GAP)
+             ins_sizes=ins_en-ins_st
+             ins_pos_before=ref_positions[ins_rows,np.maximum(0,ins_st-1)]
+             ins_pos_after=ref_positions[ins_rows,np.minimum(aln_lens[ins_rows]-1,ins_en)]
+         else:
+             ins_rows,ins_sizes,ins_pos_before,ins_pos_after=no_positions,no_positions,no_positions,no_positions
+
+         ins_flat_rows,ins_flat_pos=unique_row_positions(np.hstack([ins_rows,ins_rows]),np.hstack([ins_pos_before,ins_pos_after]),len_amplicon)
+
+
+         ########CLASSIFY READS
+         sub_in_window=positions_in_mask(sub_pos,include_mask)
+         del_in_window=positions_in_mask(del_pos,include_mask)
+         ins_in_window=positions_in_mask(ins_pos_before,include_mask) | positions_in_mask(ins_pos_after,include_mask)
+
+         modified_in_window=np.zeros(n_rows,dtype=bool)
+         modified_in_window[sub_rows[sub_in_window]]=True
+         modified_in_window[del_rows[del_in_window]]=True
+         modified_in_window[ins_rows[ins_in_window]]=True
+
+         #WE HAVE THE DONOR SEQUENCE
+         if args.expected_hdr_amplicon_seq:
+            score_diff=alignment_store_chunk['score_diff'][idxs_block]
+            score_repaired=alignment_store_chunk['score_repaired'][idxs_block]
+            hdr=(score_diff<0) & (score_repaired>=args.hdr_perfect_alignment_threshold)
+            mixed=(score_diff<0) & (score_repaired<args.hdr_perfect_alignment_threshold)
+         #NO DONOR SEQUENCE PROVIDED
+         else:
+            hdr=np.zeros(n_rows,dtype=bool)
+            mixed=np.zeros(n_rows,dtype=bool)
+
+         nhej=~hdr & ~mixed & modified_in_window
+         unmodified=~hdr & ~mixed & ~modified_in_window
+         modified=~unmodified
+
+
+         ###CREATE AVERAGE SIGNALS, HERE WE SHOW EVERYTHING...
+         for rows_selected,vector_mutation,vector_deletion,vector_insertion in \
+             [(mixed,effect_vector_mutation_mixed,effect_vector_deletion_mixed,effect_vector_insertion_mixed),
+              (hdr,effect_vector_mutation_hdr,effect_vector_deletion_hdr,effect_vector_insertion_hdr),
+              (nhej & (not args.hide_mutations_outside_window_NHEJ),effect_vector_mutation,effect_vector_deletion,effect_vector_insertion)]:
+
+             selected=rows_selected[sub_rows]
+             add_positions(vector_mutation,sub_rows[selected],sub_pos[selected],n_reads)
+             selected=rows_selected[del_rows]
+             add_positions(vector_deletion,del_rows[selected],del_pos[selected],n_reads)
+             selected=rows_selected[ins_flat_rows]
+             add_positions(vector_insertion,ins_flat_rows[selected],ins_flat_pos[selected],n_reads)
+
+         any_rows,any_pos=unique_row_positions(np.hstack([sub_rows,del_rows,ins_flat_rows]),np.hstack([sub_pos,del_pos,ins_flat_pos]),len_amplicon)
+         add_positions(effect_vector_any,any_rows,any_pos,n_reads)
+
+         #For NHEJ we count only the events that overlap the window specified around
+         #the cut site (1bp by default)...
+         if args.window_around_sgrna:
+            rows_in_window=nhej
+         else:
+            rows_in_window=np.zeros(n_rows,dtype=bool)
+
+         sub_kept=~rows_in_window[sub_rows] | sub_in_window
+         ins_kept=~rows_in_window[ins_rows] | ins_in_window
+         del_event_in_window=np.bincount(del_event,weights=del_in_window.astype(float),minlength=len(del_event_rows))>0
+         del_event_kept=~rows_in_window[del_event_rows] | del_event_in_window
+
+         #when none of the deletions overlaps the window all the deleted bp are kept
+         row_has_del_kept=np.zeros(n_rows,dtype=bool)
+         row_has_del_kept[del_event_rows[del_event_kept]]=True
+         del_kept=del_event_kept[del_event] | ~row_has_del_kept[del_rows]
+
+         if args.hide_mutations_outside_window_NHEJ:
+             selected=nhej[sub_rows] & sub_kept
+             add_positions(effect_vector_mutation,sub_rows[selected],sub_pos[selected],n_reads)
+             selected=nhej[del_rows] & del_kept
+             add_positions(effect_vector_deletion,del_rows[selected],del_pos[selected],n_reads)
+             selected=nhej[ins_flat_rows]
+             add_positions(effect_vector_insertion,ins_flat_rows[selected],ins_flat_pos[selected],n_reads)
+
+
+         ####QUANTIFICATION AND FRAMESHIFT ANALYSIS
+         n_mutated=np.bincount(sub_rows[sub_kept],minlength=n_rows)
+         n_inserted=np.bincount(ins_rows[ins_kept],weights=ins_sizes[ins_kept],minlength=n_rows)
+         n_deleted=np.bincount(del_event_rows[del_event_kept],weights=del_sizes[del_event_kept],minlength=n_rows)
+
+         n_mutated_all[idxs_block]=np.where(modified,n_mutated,0)
+         n_inserted_all[idxs_block]=np.where(modified,n_inserted,0)
+         n_deleted_all[idxs_block]=np.where(modified,n_deleted,0)
+
+         selected=ins_kept & modified[ins_rows]
+         ins_weights=ins_sizes*n_reads[ins_rows]
+         add_positions(avg_vector_ins_all,np.arange(selected.sum()),ins_pos_before[selected],ins_weights[selected])
+         selected&=(ins_pos_before % len_amplicon)!=(ins_pos_after % len_amplicon)
+         add_positions(avg_vector_ins_all,np.arange(selected.sum()),ins_pos_after[selected],ins_weights[selected])
+
+         selected=del_event_kept[del_event] & modified[del_rows]
+         add_positions(avg_vector_del_all,del_event[selected],del_pos[selected],del_sizes*n_reads[del_event_rows])
+
+         if PERFORM_FRAMESHIFT_ANALYSIS:
+            #insertions in one exon
+            ins_in_exons=ins_kept & (positions_in_mask(ins_pos_before,exon_mask) | positions_in_mask(ins_pos_after,exon_mask))
+            del_in_exons=del_kept & positions_in_mask(del_pos,exon_mask)
+            sub_in_exons=sub_kept & positions_in_mask(sub_pos,exon_mask)
+
+            exons_modified=np.zeros(n_rows,dtype=bool)
+            exons_modified[ins_rows[ins_in_exons]]=True
+            exons_modified[del_rows[del_in_exons]]=True
+            exons_modified[sub_rows[sub_in_exons]]=True
+
+            effective_length=np.bincount(ins_rows[ins_in_exons],weights=ins_sizes[ins_in_exons],minlength=n_rows).astype(int)\
+                             -np.bincount(del_rows[del_in_exons],minlength=n_rows)
+
+            spliced_modified=np.zeros(n_rows,dtype=bool)
+            spliced_modified[sub_rows[sub_kept & positions_in_mask(sub_pos,splicing_mask)]]=True
+            spliced_modified[del_rows[del_kept & positions_in_mask(del_pos,splicing_mask)]]=True
+            spliced_modified[ins_rows[positions_in_mask(ins_pos_before,splicing_mask) | positions_in_mask(ins_pos_after,splicing_mask)]]=True
+
+            SPLICING_SITES_MODIFIED+=n_reads[modified & spliced_modified].sum()
+
+            #if modified check if frameshift
+            inframe=modified & exons_modified & (effective_length % 3==0)
+            frameshift=modified & exons_modified & (effective_length % 3!=0)
+
+            MODIFIED_NON_FRAMESHIFT+=n_reads[inframe].sum()
+            MODIFIED_FRAMESHIFT+=n_reads[frameshift].sum()
+
+            for rows_selected,hist in [(inframe,hist_inframe),(frameshift,hist_frameshift)]:
+                for length,count in zip(effective_length[rows_selected],n_reads[rows_selected]):
+                    hist[int(length)]=hist.get(int(length),0)+count
+
+            #the indels and subtitutions are outside the exon/s  so we don't care!
+            noncoding=modified & ~exons_modified
+            NON_MODIFIED_NON_FRAMESHIFT+=n_reads[noncoding].sum()
+
+            selected=noncoding[ins_flat_rows]
+            add_positions(effect_vector_insertion_noncoding,ins_flat_rows[selected],ins_flat_pos[selected],n_reads)
+            selected=noncoding[del_rows] & del_kept
+            add_positions(effect_vector_deletion_noncoding,del_rows[selected],del_pos[selected],n_reads)
+            selected=noncoding[sub_rows] & sub_kept
+            add_positions(effect_vector_mutation_noncoding,sub_rows[selected],sub_pos[selected],n_reads)
+
+         unmodified_all[idxs_block]=unmodified
+         nhej_all[idxs_block]=nhej
+         hdr_all[idxs_block]=hdr
+         mixed_all[idxs_block]=mixed
+
+     #class and number of modified bp of each read
+     read_classes=OrderedDict([('UNMODIFIED',unmodified_all),('MIXED',mixed_all),('HDR',hdr_all),('NHEJ',nhej_all),
+                               ('n_mutated',n_mutated_all),('n_inserted',n_inserted_all),('n_deleted',n_deleted_all)])
+
+     quantification.counters['MODIFIED_FRAMESHIFT']=MODIFIED_FRAMESHIFT
+     quantification.counters['MODIFIED_NON_FRAMESHIFT']=MODIFIED_NON_FRAMESHIFT
+     quantification.counters['NON_MODIFIED_NON_FRAMESHIFT']=NON_MODIFIED_NON_FRAMESHIFT
+     quantification.counters['SPLICING_SITES_MODIFIED']=SPLICING_SITES_MODIFIED
+
+     #number of reads of each class and with each kind of modification
+     n_reads_all=alignment_store_chunk['n_reads']
+     quantification.counters['N_TOTAL']=n_reads_all.sum()
+     for name,rows_selected in [('N_UNMODIFIED',unmodified_all),('N_MODIFIED',nhej_all),('N_REPAIRED',hdr_all),('N_MIXED_HDR_NHEJ',mixed_all)]:
+         quantification.counters[name]=n_reads_all[rows_selected].sum()
+
+     for read_class,rows_selected in [('nhej',nhej_all),('hdr',hdr_all),('mixed',mixed_all)]:
+         for modification,n_modified_all in [('inserted',n_inserted_all),('deleted',n_deleted_all),('mutated',n_mutated_all)]:
+             quantification.counters['%s_%s' % (read_class,modification)]=n_reads_all[rows_selected & (n_modified_all>0)].sum()
+
+     for name,values in [('hist_mutated',n_mutated_all),('hist_inserted',n_inserted_all),('hist_deleted',n_deleted_all),('hist_indel_size',n_inserted_all-n_deleted_all)]:
+         unique_values,unique_idxs=np.unique(values,return_inverse=True)
+         add_hist(dict(zip(unique_values.tolist(),np.bincount(unique_idxs,weights=n_reads_all).astype(int).tolist())),quantification.hists[name])
+
+     return read_classes,quantification
+
+#number of chunks of similar cost for each process, the chunks are given to the processes as soon as they are free
+QUANTIFICATION_CHUNKS_PER_PROCESS=8
+
+def estimate_quantification_costs(alignment_store):
+    '''
+    Estimated cost of the quantification of each read: the unmodified reads are skipped, the cost of the others
+    grows with the length of the alignment and the number of mismatches and gaps
+    '''
+    aln_str=alignment_store.codes['align_str']
+    n_differences=((aln_str!=ord('|')) & (aln_str!=0)).sum(axis=1)
+    return np.where(alignment_store['UNMODIFIED'],1,1+alignment_store.alignment_lengths()+n_differences)
+
+def get_balanced_chunks(costs,n_chunks):
+    '''
+    Split the rows in at most n_chunks ranges of consecutive rows with similar total cost
+    '''
+    cumulative_costs=np.cumsum(costs)
+    boundaries=np.searchsorted(cumulative_costs,cumulative_costs[-1]*np.arange(1,n_chunks)/float(n_chunks),side='right')
+    boundaries=np.unique(np.hstack([0,boundaries,len(costs)]))
+    return zip(boundaries[:-1],boundaries[1:])
+
+def process_shared_rows(shared_rows):
+    #used by the processes of the pool: the alignments of the batch are mapped in memory from the files saved by the parent process,
+    #only the files and the range of rows are sent to the process and only the classes of the reads are sent back
+    prefix,names,row_st,row_en=shared_rows
+    return process_df_chunk(AlignmentStore.load_shared(prefix,names,slice(row_st,row_en)))
+
+
+def histogram_from_counts(hist,bins):
+    #like np.histogram of the values weighted by the number of reads, from the number of reads of each value
+    values=sorted(hist.keys())
+    return np.histogram(values,bins=bins,weights=[hist[value] for value in values])
 
 def add_hist(hist_to_add,hist_global):
     for key,value in hist_to_add.iteritems():
-        hist_global[key]+=value
+        hist_global[key]=hist_global.get(key,0)+value
     return hist_global
 
 
@@ -548,37 +1000,94 @@ def slugify(value): #adapted from the Django project
 
     return str(value)
 
-def split_paired_end_reads_single_file(fastq_filename,output_filename_r1,output_filename_r2):
+def split_paired_end_reads_single_file(fastq_filename,output_filename_r1,output_filename_r2,fastq_stats=None):
 
     if fastq_filename.endswith('.gz'):
             fastq_handle=gzip.open(fastq_filename)
     else:
             fastq_handle=open(fastq_filename)
 
+    stats_r1,stats_r2=FastqStats(),FastqStats()
+
     #we cannot use with on gzip with python 2.6 :(
     try:
         fastq_splitted_outfile_r1=gzip.open(output_filename_r1,'w+')
         fastq_splitted_outfile_r2=gzip.open(output_filename_r2,'w+')
-        [fastq_splitted_outfile_r1.write(line) if (i % 8 < 4) else fastq_splitted_outfile_r2.write(line) for i, line in enumerate(fastq_handle)]
-    except:
-        raise Exception('Error handling the splitting operation')
 
-    return output_filename_r1,output_filename_r2
+        #the batches have an even number of records, so the reads of the pairs alternate in each batch
+        for batch in get_fastq_records_batches(fastq_handle):
+            fastq_splitted_outfile_r1.write(''.join([''.join(record) for record in batch[0::2]]))
+            fastq_splitted_outfile_r2.write(''.join([''.join(record) for record in batch[1::2]]))
+            stats_r1.add_records(batch[0::2])
+            stats_r2.add_records(batch[1::2])
 
+        fastq_splitted_outfile_r1.close()
+        fastq_splitted_outfile_r2.close()
+    except:
+        raise Exception('Error handling the splitting operation')
 
-def get_row_around_cut(row,cut_point,offset):
-    cut_idx=row['ref_positions'].index(cut_point)
-    return  row['Aligned_Sequence'][cut_idx-offset+1:cut_idx+offset+1],row['Reference_Sequence'][cut_idx-offset+1:cut_idx+offset+1],row['UNMODIFIED'],row['%Reads'], row['#Reads']
+    if fastq_stats is not None:
+        fastq_stats.set(output_filename_r1,stats_r1)
+        fastq_stats.set(output_filename_r2,stats_r2)
 
+    return output_filename_r1,output_filename_r2
 
-def get_dataframe_around_cut(df_alleles, cut_point,offset):
-    df_alleles_around_cut=pd.DataFrame(list(df_alleles.apply(lambda row: get_row_around_cut(row,cut_point,offset),axis=1).values),
-                        columns=['Aligned_Sequence','Reference_Sequence','Unedited','%Reads','#Reads'])
-    df_alleles_around_cut=df_alleles_around_cut.groupby(['Aligned_Sequence','Reference_Sequence']).sum().reset_index().set_index('Aligned_Sequence')
 
-    df_alleles_around_cut.sort_values(by='%Reads',inplace=True,ascending=False)
-    df_alleles_around_cut['Unedited']=df_alleles_around_cut['Unedited']>0
-    return df_alleles_around_cut
+def get_dataframes_around_cuts(df_alleles,cut_points,offset):
+    '''
+    Alleles summarized around each cut point (the 2*offset bp of the alignment around the cut), one dataframe for each cut point.
+    The windows of all the alleles and all the cut points are sliced together on the encoded alignments
+    '''
+    cut_points=np.asarray(cut_points,dtype=int)
+    aln_ref=encode_alignments(list(df_alleles['Reference_Sequence'].values))
+    aln_seq=encode_alignments(list(df_alleles['Aligned_Sequence'].values))
+    aln_lens=(aln_ref!=0).sum(axis=1)
+
+    #column of each cut point in the alignment of each allele, found in one pass over the bp of the references
+    unique_cut_points,cut_point_idxs=np.unique(cut_points,return_inverse=True)
+    cut_point_lookup=-np.ones(max(aln_ref.shape[1],unique_cut_points.max()+1),dtype=int)
+    cut_point_lookup[unique_cut_points]=np.arange(len(unique_cut_points))
+    ref_positions=compute_ref_positions(aln_ref)
+    bp_rows,bp_cols=np.nonzero(ref_positions>=0)
+    bp_cut_point_idxs=cut_point_lookup[ref_positions[bp_rows,bp_cols]]
+    is_cut=bp_cut_point_idxs>=0
+    cut_cols=-np.ones((len(aln_ref),len(unique_cut_points)),dtype=int)
+    cut_cols[bp_rows[is_cut],bp_cut_point_idxs[is_cut]]=bp_cols[is_cut]
+    if (cut_cols<0).any():
+        raise Exception('The cut points are not contained in the reference sequences of all the alleles!')
+    cut_cols=cut_cols[:,cut_point_idxs]
+
+    #window [cut-offset+1,cut+offset+1) with the same rules of the slicing of python strings
+    starts=cut_cols-offset+1
+    ends=cut_cols+offset+1
+    lens=aln_lens[:,np.newaxis]
+    starts=np.clip(np.where(starts<0,starts+lens,starts),0,lens)
+    ends=np.clip(np.where(ends<0,ends+lens,ends),0,lens)
+    window=np.arange(max(1,2*offset))
+    cols=starts[:,:,np.newaxis]+window
+    in_window=window<(ends-starts)[:,:,np.newaxis]
+    cols=np.minimum(cols,aln_ref.shape[1]-1)
+    rows=np.arange(len(aln_ref))[:,np.newaxis,np.newaxis]
+    seq_windows=np.where(in_window,aln_seq[rows,cols],0).astype(np.uint8)
+    ref_windows=np.where(in_window,aln_ref[rows,cols],0).astype(np.uint8)
+
+    n_reads=df_alleles['#Reads'].values
+    perc_reads=df_alleles['%Reads'].values
+    unedited=df_alleles['UNMODIFIED'].values.astype(int)
+
+    dfs_alleles_around_cut=[]
+    for idx_cut in range(len(cut_points)):
+        #the alleles with the same window are grouped on binary keys, sorted as the strings
+        keys=np.ascontiguousarray(np.hstack([seq_windows[:,idx_cut],ref_windows[:,idx_cut]]))
+        _,allele_rows,allele_idxs=np.unique(keys.view('V%d' % keys.shape[1]).ravel(),return_index=True,return_inverse=True)
+        df_alleles_around_cut=pd.DataFrame(OrderedDict([('Reference_Sequence',decode_alignments(ref_windows[allele_rows,idx_cut])),
+                                                        ('Unedited',np.bincount(allele_idxs,weights=unedited)>0),
+                                                        ('%Reads',np.bincount(allele_idxs,weights=perc_reads)),
+                                                        ('#Reads',np.round(np.bincount(allele_idxs,weights=n_reads)).astype(int))]),
+                                           index=pd.Index(decode_alignments(seq_windows[allele_rows,idx_cut]),name='Aligned_Sequence'))
+        df_alleles_around_cut.sort_values(by='%Reads',inplace=True,ascending=False)
+        dfs_alleles_around_cut.append(df_alleles_around_cut)
+    return dfs_alleles_around_cut
 
 #We need to customize the seaborn heatmap class and function
 class Custom_HeatMapper(sns.matrix._HeatMapper):
@@ -681,7 +1190,7 @@ def custom_heatmap(data, vmin=None, vmax=None, cmap=None, center=None, robust=Fa
     plotter.plot(ax, cbar_ax, kwargs)
     return ax
 
-def plot_alleles_table(reference_seq,cut_point,df_alleles,sgRNA_name,OUTPUT_DIRECTORY,MIN_FREQUENCY=0.5,MAX_N_ROWS=100):
+def plot_alleles_table(reference_seq,cut_point,df_alleles,sgRNA_name,OUTPUT_DIRECTORY,MIN_FREQUENCY=0.5,MAX_N_ROWS=100,save_also_png=False):
     #bp we are plotting on each side
     offset_around_cut_to_plot=len(df_alleles.index[0])/2
 
@@ -749,7 +1258,7 @@ def plot_alleles_table(reference_seq,cut_point,df_alleles,sgRNA_name,OUTPUT_DIRE
     N_ROWS=len(X)
     N_COLUMNS=offset_around_cut_to_plot*2
 
-    fig=plt.figure(figsize=(offset_around_cut_to_plot*0.6,(N_ROWS+1)*0.6))
+    plt.figure(figsize=(offset_around_cut_to_plot*0.6,(N_ROWS+1)*0.6))
     gs1 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
     gs2 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
 
@@ -799,10 +1308,609 @@ def plot_alleles_table(reference_seq,cut_point,df_alleles,sgRNA_name,OUTPUT_DIRE
     _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
 
     plt.savefig(_jp('9.Alleles_around_cut_site_for_%s.pdf' % sgRNA_name),bbox_inches='tight')
-    if args.save_also_png:
+    if save_also_png:
         plt.savefig(_jp('9.Alleles_around_cut_site_for_%s.png' % sgRNA_name),bbox_inches='tight',pad=1)
 
 
+def plot_indel_size_distribution_n_sequences(hlengths,hdensity,center_index,xmin,xmax,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(8.3,8))
+
+    plt.bar(0,hdensity[center_index],color='red',linewidth=0)
+    #plt.hold(True)
+    barlist=plt.bar(hlengths,hdensity,align='center',linewidth=0)
+    barlist[center_index].set_color('r')
+    plt.xlim([xmin,xmax])
+    plt.ylabel('Sequences (no.)')
+    plt.xlabel('Indel size (bp)')
+    plt.ylim([0,hdensity.max()*1.2])
+    plt.title('Indel size distribution')
+    lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
+    #lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(3)
+    lgd.legendHandles[1].set_height(3)
+    plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.pdf'),bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.png'),bbox_inches='tight')
+
+def plot_indel_size_distribution_percentage(hlengths,hdensity,center_index,xmin,xmax,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(8.3,8))
+    plt.bar(0,hdensity[center_index]/(float(hdensity.sum()))*100.0,color='red',linewidth=0)
+    #plt.hold(True)
+    barlist=plt.bar(hlengths,hdensity/(float(hdensity.sum()))*100.0,align='center',linewidth=0)
+    barlist[center_index].set_color('r')
+    plt.xlim([xmin,xmax])
+    plt.title('Indel size distribution')
+    plt.ylabel('Sequences (%)')
+    plt.xlabel('Indel size (bp)')
+    #lgd=plt.legend(['No indel','Indel'])
+    lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(3)
+    lgd.legendHandles[1].set_height(3)
+
+    plt.savefig(_jp('1b.Indel_size_distribution_percentage.pdf'),bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('1b.Indel_size_distribution_percentage.png'),bbox_inches='tight')
+
+def plot_unmodified_nhej_hdr_pie_chart(N_UNMODIFIED,N_MIXED_HDR_NHEJ,N_MODIFIED,N_REPAIRED,len_amplicon,cut_points,offset_plots,sgRNA_intervals,core_donor_seq_st_en,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(12*1.5,14.5*1.5))
+    ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
+    patches, texts, autotexts =ax1.pie([N_UNMODIFIED,N_MIXED_HDR_NHEJ,N_MODIFIED,N_REPAIRED],\
+                                                      labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
+                                                              'Mixed HDR-NHEJ\n(%d reads)' %N_MIXED_HDR_NHEJ,
+                                                              'NHEJ\n(%d reads)' % N_MODIFIED, \
+                                                              'HDR\n(%d reads)' %N_REPAIRED,
+                                                              ],\
+                                                      explode=(0,0,0,0),\
+                                                      colors=[(1,0,0,0.2),(0,1,1,0.2),(0,0,1,0.2),(0,1,0,0.2)],autopct='%1.1f%%')
+
+    if cut_points or core_donor_seq_st_en:
+       ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+       ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+       #plt.hold(True)
+
+       if core_donor_seq_st_en:
+           ax2.plot(core_donor_seq_st_en,[0,0],'-',lw=10,c=(0,1,0,0.5),label='Donor Sequence')
+
+       if cut_points:
+           ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=24,label='Predicted Cas9 cleavage site/s')
+
+       for idx,sgRNA_int in enumerate(sgRNA_intervals):
+            if idx==0:
+               ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA')
+            else:
+               ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_')
+
+       plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
+       plt.xlim(0,len_amplicon)
+       plt.axis('off')
+
+
+
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+    plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.png'),pad_inches=1,bbox_inches='tight')
+
+def plot_unmodified_nhej_pie_chart(N_UNMODIFIED,N_MODIFIED,N_TOTAL,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(12*1.5,14.5*1.5))
+    ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
+    patches, texts, autotexts =ax1.pie([N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100],\
+                                      labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
+                                              'NHEJ\n(%d reads)' % N_MODIFIED],\
+                                      explode=(0,0),colors=[(1,0,0,0.2),(0,0,1,0.2)],autopct='%1.1f%%')
+
+    if cut_points:
+       ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+       ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+       #plt.hold(True)
+
+
+       for idx,sgRNA_int in enumerate(sgRNA_intervals):
+            if idx==0:
+               ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+            else:
+               ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+       ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=12,label='Predicted Cas9 cleavage site/s')
+       plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1,prop={'size':'large'})
+       plt.xlim(0,len_amplicon)
+       plt.axis('off')
+
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+    plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.png'),pad_inches=1,bbox_inches='tight')
+
+def plot_indel_substitution_size_hist(x_bins_ins,y_values_ins,x_bins_del,y_values_del,x_bins_mut,y_values_mut,N_TOTAL,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    fig=plt.figure(figsize=(26,6.5))
+
+
+    ax=fig.add_subplot(1,3,1)
+    ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
+    barlist=ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
+    barlist[0].set_color('r')
+
+    plt.title('Insertions')
+    plt.xlabel('Size (bp)')
+    plt.ylabel('Sequences % (no.)')
+    lgd=plt.legend(['Non-insertion','Insertion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(6)
+    lgd.legendHandles[1].set_height(6)
+    plt.xlim(xmin=-1)
+    y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
+
+    ax=fig.add_subplot(1,3,2)
+    ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
+    barlist=ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
+    barlist[0].set_color('r')
+    plt.title('Deletions')
+    plt.xlabel('Size (bp)')
+    plt.ylabel('Sequences % (no.)')
+    lgd=plt.legend(['Non-deletion','Deletion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(6)
+    lgd.legendHandles[1].set_height(6)
+    plt.xlim(xmax=1)
+    y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
+
+
+
+    ax=fig.add_subplot(1,3,3)
+    ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
+    barlist=ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
+    barlist[0].set_color('r')
+    plt.title('Substitutions')
+    plt.xlabel('Positions substituted (number)')
+    plt.ylabel('Sequences % (no.)')
+    lgd=plt.legend(['Non-substitution','Substitution'][::-1] ,bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(6)
+    lgd.legendHandles[1].set_height(6)
+    plt.xlim(xmin=-1)
+    y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
+
+
+    plt.tight_layout()
+
+    plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.pdf'),bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.png'),bbox_inches='tight')
+
+def plot_combined_mutation_locations(effect_vector_any,N_TOTAL,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(10,10))
+
+    y_max=max(effect_vector_any)*1.2
+
+    plt.plot(effect_vector_any,'r',lw=3,label='Combined Insertions/Deletions/Substitutions')
+    #plt.hold(True)
+
+    if cut_points:
+
+        for idx,cut_point in enumerate(cut_points):
+            if idx==0:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+            else:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+
+        for idx,sgRNA_int in enumerate(sgRNA_intervals):
+            if idx==0:
+               plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+            else:
+               plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.23),ncol=1, fancybox=True, shadow=True)
+    y_label_values=np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/float(N_TOTAL)*100, n_reads) for n_reads in y_label_values])
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+
+    plt.title('Mutation position distribution')
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences % (no.)')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
+
+def plot_nhej_mutation_locations(effect_vector_insertion,effect_vector_deletion,effect_vector_mutation,N_TOTAL,N_MODIFIED,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(10,10))
+    plt.plot(effect_vector_insertion,'r',lw=3,label='Insertions')
+    #plt.hold(True)
+    plt.plot(effect_vector_deletion,'m',lw=3,label='Deletions')
+    plt.plot(effect_vector_mutation,'g',lw=3,label='Substitutions')
+
+    y_max=max(max(effect_vector_insertion),max(effect_vector_deletion),max(effect_vector_mutation))*1.2
+
+
+    if cut_points:
+
+        for idx,cut_point in enumerate(cut_points):
+            if idx==0:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+            else:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+
+        for idx,sgRNA_int in enumerate(sgRNA_intervals):
+            if idx==0:
+               plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+            else:
+               plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+    y_label_values=np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MODIFIED)*100, n_reads) for n_reads in y_label_values])
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences: % Total ( % NHEJ, no. )')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+
+    plt.title('Mutation position distribution of NHEJ')
+    plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
+
+def plot_hdr_mutation_locations(effect_vector_insertion_hdr,effect_vector_deletion_hdr,effect_vector_mutation_hdr,N_TOTAL,N_REPAIRED,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(10,10))
+    plt.plot(effect_vector_insertion_hdr,'r',lw=3,label='Insertions')
+    #plt.hold(True)
+    plt.plot(effect_vector_deletion_hdr,'m',lw=3,label='Deletions')
+    plt.plot(effect_vector_mutation_hdr,'g',lw=3,label='Substitutions')
+
+    y_max=max(max(effect_vector_insertion_hdr),max(effect_vector_deletion_hdr),max(effect_vector_mutation_hdr))*1.2
+
+    if cut_points:
+
+            for idx,cut_point in enumerate(cut_points):
+                if idx==0:
+                        plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+                else:
+                        plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+
+            for idx,sgRNA_int in enumerate(sgRNA_intervals):
+                if idx==0:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+                else:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+    y_label_values=np.arange(0,y_max,y_max/6).astype(int)
+    plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_REPAIRED)*100, n_reads) for n_reads in y_label_values])
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences: % Total ( % HDR, no. )')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    plt.title('Mutation position distribution of HDR')
+    plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+    if save_also_png:
+        plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
+
+def plot_mixed_hdr_nhej_mutation_locations(effect_vector_insertion_mixed,effect_vector_deletion_mixed,effect_vector_mutation_mixed,N_TOTAL,N_MIXED_HDR_NHEJ,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(10,10))
+    plt.plot(effect_vector_insertion_mixed,'r',lw=3,label='Insertions')
+    #plt.hold(True)
+    plt.plot(effect_vector_deletion_mixed,'m',lw=3,label='Deletions')
+    plt.plot(effect_vector_mutation_mixed,'g',lw=3,label='Substitutions')
+
+    y_max=max(max(effect_vector_insertion_mixed),max(effect_vector_deletion_mixed),max(effect_vector_mutation_mixed))*1.2
+
+    if cut_points:
+
+            for idx,cut_point in enumerate(cut_points):
+                if idx==0:
+                        plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+                else:
+                        plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+            for idx,sgRNA_int in enumerate(sgRNA_intervals):
+                if idx==0:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+                else:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+    y_label_values=np.arange(0,y_max,y_max/6).astype(int)
+    plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MIXED_HDR_NHEJ)*100, n_reads) for n_reads in y_label_values])
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences: % Total ( % mixed HDR-NHEJ, no. )')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    plt.title('Mutation position distribution of mixed HDR-NHEJ')
+    plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
+
+def plot_position_dependent_indel_size(avg_vector_ins_all,avg_vector_del_all,len_amplicon,cut_points,offset_plots,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    fig=plt.figure(figsize=(24,10))
+    ax1=fig.add_subplot(1,2,1)
+    markerline, stemlines, baseline=ax1.stem(avg_vector_ins_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
+    plt.setp(markerline, 'markerfacecolor', 'r', 'markersize', 8)
+    plt.setp(baseline, 'linewidth', 0)
+    plt.setp(stemlines, 'color', 'r','linewidth',3)
+    #plt.hold(True)
+    y_max=max(avg_vector_ins_all)*1.2
+    if cut_points:
+
+        for idx,cut_point in enumerate(cut_points):
+            if idx==0:
+                    ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+            else:
+                    ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Average insertion length')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    ax1.set_title('Position dependent insertion size')
+    plt.tight_layout()
+
+    ax2=fig.add_subplot(1,2,2)
+    markerline, stemlines, baseline=ax2.stem(avg_vector_del_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
+    plt.setp(markerline, 'markerfacecolor', 'm', 'markersize', 8)
+    plt.setp(baseline, 'linewidth', 0)
+    plt.setp(stemlines, 'color', 'm','linewidth',3)
+    #plt.hold(True)
+    y_max=max(avg_vector_del_all)*1.2
+    if cut_points:
+
+        for idx,cut_point in enumerate(cut_points):
+            if idx==0:
+                    ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+            else:
+                    ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Average deletion length')
+
+    plt.ylim(ymin=0,ymax=max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    ax2.set_title('Position dependent deletion size')
+
+    plt.tight_layout()
+
+
+    plt.savefig(_jp('4e.Position_dependent_average_indel_size.pdf'),bbox_inches='tight')
+    if save_also_png:
+        plt.savefig(_jp('4e.Position_dependent_average_indel_size.png'),bbox_inches='tight')
+
+def plot_frameshift_pie_chart(MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,NON_MODIFIED_NON_FRAMESHIFT,len_amplicon,exon_intervals,cut_points,offset_plots,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(12*1.5,14.5*1.5))
+    ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
+    patches, texts, autotexts =ax1.pie([MODIFIED_FRAMESHIFT,\
+                                       MODIFIED_NON_FRAMESHIFT,\
+                                       NON_MODIFIED_NON_FRAMESHIFT],\
+                                       labels=['Frameshift mutation\n(%d reads)' %MODIFIED_FRAMESHIFT,\
+                                              'In-frame mutation\n(%d reads)' % MODIFIED_NON_FRAMESHIFT,\
+                                              'Noncoding mutation\n(%d reads)' %NON_MODIFIED_NON_FRAMESHIFT],\
+                                       explode=(0.0,0.0,0.0),\
+                                       colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99215686,  0.73333333,  0.51764706,0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
+                                       autopct='%1.1f%%')
+
+    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+    #plt.hold(True)
+
+    for idx,exon_interval in enumerate(exon_intervals):
+        if idx==0:
+            ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='Coding sequence/s',solid_capstyle='butt')
+        else:
+            ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='_nolegend_',solid_capstyle='butt')
+
+    if cut_points:
+       ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=25,label='Predicted Cas9 cleavage site/s')
+
+    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
+    plt.xlim(0,len_amplicon)
+    plt.axis('off')
+
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+    plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.png'),pad_inches=1,bbox_inches='tight')
+
+def plot_frameshift_profiles(hist_frameshift,hist_inframe,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    fig=plt.figure(figsize=(22,10))
+    ax1=fig.add_subplot(2,1,1)
+    x,y=map(np.array,zip(*[a for a in hist_frameshift.iteritems()]))
+    y=y/float(sum(hist_frameshift.values()))*100
+    ax1.bar(x-0.5,y)
+    ax1.set_xlim(-30.5,30.5)
+    ax1.set_frame_on(False)
+    ax1.set_xticks([idx for idx in range(-30,31) if idx % 3])
+    ax1.tick_params(which='both',      # both major and minor ticks are affected
+       bottom='off',      # ticks along the bottom edge are off
+       top='off',         # ticks along the top edge are off
+       labelbottom='on') # labels along the bottom edge are off)
+    ax1.yaxis.tick_left()
+    xmin, xmax = ax1.get_xaxis().get_view_interval()
+    ymin, ymax = ax1.get_yaxis().get_view_interval()
+    ax1.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if idx % 3]],rotation='vertical')
+    plt.title('Frameshift profile')
+    ax1.tick_params(axis='both', which='major', labelsize=32)
+    ax1.tick_params(axis='both', which='minor', labelsize=32)
+    plt.tight_layout()
+    plt.ylabel('%')
+
+    ax2=fig.add_subplot(2,1,2)
+    x,y=map(np.array,zip(*[a for a in hist_inframe.iteritems()]))
+    y=y/float(sum(hist_inframe.values()))*100
+    ax2.bar(x-0.5,y,color=(0,1,1,0.2))
+    ax2.set_xlim(-30.5,30.5)
+    ax2.set_frame_on(False)
+    ax2.set_xticks([idx for idx in range(-30,31) if (idx % 3 ==0) ])
+    ax2.tick_params(which='both',      # both major and minor ticks are affected
+       bottom='off',      # ticks along the bottom edge are off
+       top='off',         # ticks along the top edge are off
+       labelbottom='on') # labels along the bottom edge are off)
+    ax2.yaxis.tick_left()
+    xmin, xmax = ax2.xaxis.get_view_interval()
+    ymin, ymax = ax2.yaxis.get_view_interval()
+    ax2.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if (idx % 3==0)]],rotation='vertical')
+    plt.title('In-frame profile')
+    plt.tight_layout()
+    plt.ylabel('%')
+    ax2.tick_params(axis='both', which='major', labelsize=32)
+    ax2.tick_params(axis='both', which='minor', labelsize=32)
+    plt.tight_layout()
+
+    plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.pdf'),pad_inches=1,bbox_inches='tight')
+    if save_also_png:
+        plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.png'),pad_inches=1,bbox_inches='tight')
+
+def plot_splice_sites_pie_chart(SPLICING_SITES_MODIFIED,N_TOTAL,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    fig=plt.figure(figsize=(12*1.5,12*1.5))
+    ax=fig.add_subplot(1,1,1)
+    patches, texts, autotexts =ax.pie([SPLICING_SITES_MODIFIED,\
+                                      (N_TOTAL - SPLICING_SITES_MODIFIED)],\
+                                      labels=['Potential splice sites modified\n(%d reads)' %SPLICING_SITES_MODIFIED,\
+                                              'Unmodified\n(%d reads)' % (N_TOTAL- SPLICING_SITES_MODIFIED)],\
+                                      explode=(0.0,0),\
+                                      colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
+                                      autopct='%1.1f%%')
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+    plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
+    if save_also_png:
+        plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.png'),pad_inches=1,bbox_inches='tight')
+
+def plot_noncoding_mutation_locations(effect_vector_insertion_noncoding,effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,len_amplicon,cut_points,offset_plots,sgRNA_intervals,OUTPUT_DIRECTORY,save_also_png=False):
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+
+    plt.figure(figsize=(10,10))
+    plt.plot(effect_vector_insertion_noncoding,'r',lw=3,label='Insertions')
+    #plt.hold(True)
+    plt.plot(effect_vector_deletion_noncoding,'m',lw=3,label='Deletions')
+    plt.plot(effect_vector_mutation_noncoding,'g',lw=3,label='Substitutions')
+
+    y_max=max(max(effect_vector_insertion_noncoding),max(effect_vector_deletion_noncoding),max(effect_vector_mutation_noncoding))*1.2
+
+
+    if cut_points:
+
+        for idx,cut_point in enumerate(cut_points):
+            if idx==0:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
+            else:
+                    plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
+
+            for idx,sgRNA_int in enumerate(sgRNA_intervals):
+                if idx==0:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
+                else:
+                   plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+    plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
+
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences (no.)')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    plt.title('Noncoding mutation position distribution')
+    plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+    if save_also_png:
+            plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.png'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+
+def render_plot(plot_task):
+    #a task is a plot function with its arguments and keyword arguments, each figure is closed once saved
+    plot_function,plot_args,plot_kwargs=plot_task
+    plot_function(*plot_args,**plot_kwargs)
+    plt.close('all')
+
+def render_plots(plot_tasks,OUTPUT_DIRECTORY,save_also_png=False,n_processes=1,pool=None):
+    '''
+    Render the plot tasks in the output folder, with more processes the figures are rendered in background by a pool
+    (the pool given, that is left open, or a new one). Returns the function that waits for the figures and raises the errors of the plots
+    '''
+    plot_tasks=[(plot_function,plot_args,dict(plot_kwargs,OUTPUT_DIRECTORY=OUTPUT_DIRECTORY,save_also_png=save_also_png))
+                for plot_function,plot_args,plot_kwargs in plot_tasks]
+
+    if pool is not None:
+        return pool.map_async(render_plot,plot_tasks).get
+
+    if n_processes>1 and len(plot_tasks)>1:
+        pool=mp.Pool(processes=min(len(plot_tasks),n_processes))
+        results=pool.map_async(render_plot,plot_tasks)
+
+        def wait_plots():
+            results.get()
+            pool.close()
+            pool.join()
+        return wait_plots
+
+    map(render_plot,plot_tasks)
+    return lambda: None
+
+#name of the file with the data of the plots saved in the output folder
+PLOT_DATA_FILENAME='CRISPResso_plot_data.pickle'
+
+def save_plot_data(plot_tasks,output_folder):
+    #the plot functions are saved by name
+    plot_data={'version':__version__,'plot_tasks':[(plot_function.__name__,plot_args,plot_kwargs) for plot_function,plot_args,plot_kwargs in plot_tasks]}
+    with open(os.path.join(output_folder,PLOT_DATA_FILENAME),'wb') as outfile:
+        cp.dump(plot_data,outfile,protocol=cp.HIGHEST_PROTOCOL)
+
+def load_plot_data(output_folder):
+    with open(os.path.join(output_folder,PLOT_DATA_FILENAME),'rb') as infile:
+        plot_data=cp.load(infile)
+
+    #the plot functions are resolved by name, their arguments may change between versions
+    if plot_data.get('version')!=__version__:
+        raise PlotDataVersionException('The plot data in %s were saved by CRISPResso %s and can be plotted only with the same version (this is CRISPResso %s)' \
+                                       % (output_folder,plot_data.get('version','unknown'),__version__))
+
+    return [(globals()[plot_function_name],plot_args,plot_kwargs) for plot_function_name,plot_args,plot_kwargs in plot_data['plot_tasks']]
+
 def main():
     try:
              print '  \n~~~CRISPResso~~~'
@@ -823,10 +1931,10 @@ def main():
 
              #global variables for the multiprocessing
              global args
-             global include_idxs
+             global include_mask
              global len_amplicon
-             global exon_positions
-             global splicing_positions
+             global exon_mask
+             global splicing_mask
 
              parser = argparse.ArgumentParser(description='CRISPResso Parameters',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
              parser.add_argument('-r1','--fastq_r1', type=str,  help='First fastq file', required=True,default='Fastq filename' )
@@ -841,6 +1949,8 @@ def main():
              parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
              parser.add_argument('-s','--min_single_bp_quality', type=int, help='Minimum single bp score (phred33) to keep a read', default=0)
              parser.add_argument('--min_identity_score', type=float, help='Minimum identity score for the alignment', default=60.0)
+             parser.add_argument('--kmer_size', type=int, help='Size of the k-mers used to find the orientation of the reads and to discard the reads unrelated to the amplicon before the alignment (4-13)', default=KMER_SIZE)
+             parser.add_argument('--no_kmer_prefilter',help='Align also the reads sharing too few k-mers with the amplicon to pass the --min_identity_score threshold. The minimum fraction of shared k-mers, (min_identity_score/100)^kmer_size, is about 0.6%% with the default values, so only the reads almost unrelated to the amplicon are discarded',action='store_true')
              parser.add_argument('-n','--name',  help='Output name', default='')
              parser.add_argument('-o','--output_folder',  help='', default='')
              parser.add_argument('--split_paired_end',help='Splits a single fastq file contating paired end reads in two files before running CRISPResso',action='store_true')
@@ -857,10 +1967,17 @@ def main():
              parser.add_argument('--ignore_insertions',help='Ignore insertions events for the quantification and visualization',action='store_true')
              parser.add_argument('--ignore_deletions',help='Ignore deletions events for the quantification and visualization',action='store_true')
              parser.add_argument('--needle_options_string',type=str,help='Override options for the Needle aligner',default='-gapopen=10 -gapextend=0.5  -awidth3=5000')
+             parser.add_argument('--aligner',type=str,choices=['needle','native'],help='Aligner to use: needle from the EMBOSS suite or the native in-process aligner (same gap open and gap extend penalties of --needle_options_string)',default='needle')
+             parser.add_argument('--banded_alignment',help='Compute only a band of the alignment matrix with the native aligner, reads that could have a better alignment outside the band are aligned again without the band',action='store_true')
+             parser.add_argument('--band_width', type=int, help='Number of bp added on each side of the band of the banded alignment, that covers the length differences between the reads and the amplicon', default=25)
+             parser.add_argument('--batch_size', type=int, help='Number of unique sequences aligned and quantified at once, the memory used for the alignments is proportional to it', default=100000)
+             parser.add_argument('--max_alleles_in_memory', type=int, help='Maximum number of distinct alleles kept in memory, only the most frequent alleles are reported with exact counts and the exact counts of all the alleles of each batch are saved to file. With 0 all the alleles are kept in memory', default=0)
              parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
              parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
+             parser.add_argument('--fastq_stats_cache_dir',type=str,help='Directory where to save the statistics (number of reads, read lengths, quality) of the input fastq files, reused by the next runs on the same files. By default the statistics are not saved',default=None)
              parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
-             parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
+             parser.add_argument('--no_plots',help='Do not make the plots, the data to make them later with CRISPRessoPlot are saved in %s' % PLOT_DATA_FILENAME,action='store_true')
+             parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the alignment, the quantification and the plots.\
              Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)
              parser.add_argument('--offset_around_cut_to_plot',  type=int, help='Offset to use to summarize alleles around the cut site in the alleles table plot.', default=20)
              parser.add_argument('--min_frequency_alleles_around_cut_to_plot', type=float, help='Minimum %% reads required to report an allele in the alleles table plot.', default=0.2)
@@ -868,6 +1985,29 @@ def main():
 
              args = parser.parse_args()
 
+             check_program('java')
+             check_program('flash')
+
+             if args.aligner=='needle':
+                 check_program('needle')
+                 if args.banded_alignment:
+                     warn('The banded alignment is available only with --aligner native, the option --banded_alignment will be ignored.')
+             else:
+                 gap_open,gap_extend=parse_needle_options(args.needle_options_string)
+
+             #margin around the diagonals of the reads, the band is computed for each batch of reads
+             band_width=args.band_width if args.banded_alignment else None
+
+             if args.batch_size<1:
+                 raise Exception('The batch size should be at least 1!')
+
+             if args.max_alleles_in_memory<0:
+                 raise Exception('The maximum number of alleles in memory should be positive or 0!')
+
+             #the k-mer table has 4^k entries
+             if args.kmer_size<4 or args.kmer_size>13:
+                 raise Exception('The k-mer size should be between 4 and 13!')
+
              #check files
              check_file(args.fastq_r1)
              if args.fastq_r2:
@@ -969,9 +2109,9 @@ def main():
 
                     PERFORM_FRAMESHIFT_ANALYSIS=True
 
-                    exon_positions=set()
+                    exon_mask=np.zeros(len_amplicon,dtype=bool)
                     exon_intervals=[]
-                    splicing_positions=[]
+                    splicing_mask=np.zeros(len_amplicon,dtype=bool)
 
                     for exon_seq in args.coding_seq.strip().upper().split(','):
 
@@ -985,35 +2125,18 @@ def main():
                             raise ExonSequenceException('The coding subsequence/s provided:%s is(are) not contained in the amplicon sequence.' % exon_seq)
                         en_exon=st_exon+len(exon_seq ) #this do not include the upper bound as usual in python
                         exon_intervals.append((st_exon,en_exon))
-                        exon_positions=exon_positions.union(set(range(st_exon,en_exon)))
+                        exon_mask[st_exon:en_exon]=True
 
                         #consider 2 base pairs before and after each exon
-                        splicing_positions+=[max(0,st_exon-2),max(0,st_exon-1),min(len_amplicon-1, en_exon),min(len_amplicon-1, en_exon+1)]
-
-                    exon_positions=sorted(exon_positions)
+                        splicing_mask[[max(0,st_exon-2),max(0,st_exon-1),min(len_amplicon-1, en_exon),min(len_amplicon-1, en_exon+1)]]=True
 
                     #protect from the wrong splitting of exons by the users to avoid false splicing sites
-                    splicing_positions=set(splicing_positions).difference(exon_positions)
+                    splicing_mask&=~exon_mask
 
              else:
                     PERFORM_FRAMESHIFT_ANALYSIS=False
 
 
-             #we have insertions/deletions that change the concatenated exon sequence lenght and the difference between the final sequence
-             #and the original sequence lenght is not a multiple of 3
-             MODIFIED_FRAMESHIFT=0
-
-             #we have insertions/deletions that change the concatenated exon sequence lenght and the difference between the final sequence
-             #and the original sequence lenght is a multiple of 3. We are in this case also when no indels are present but we have
-             #substitutions
-             MODIFIED_NON_FRAMESHIFT=0
-
-             #we don't touch the exons at all, the read can be still modified tough..
-             NON_MODIFIED_NON_FRAMESHIFT=0
-
-             SPLICING_SITES_MODIFIED=0
-
-
 
              ################
 
@@ -1053,6 +2176,12 @@ def main():
 
 
 
+             #number of reads and read length of the files, recorded while they are processed
+             fastq_stats=RunFastqStats(args.fastq_stats_cache_dir)
+             fastq_stats.use_cache(args.fastq_r1)
+             if args.fastq_r2:
+                 fastq_stats.use_cache(args.fastq_r2)
+
              if args.split_paired_end:
 
                 if args.fastq_r2!='':
@@ -1061,7 +2190,8 @@ def main():
                         info('Splitting paired end single fastq file in two files...')
                         args.fastq_r1,args.fastq_r2=split_paired_end_reads_single_file(args.fastq_r1,
                                                                                     output_filename_r1=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r1.fastq.gz'),
-                                                                                    output_filename_r2=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r2.fastq.gz'),)
+                                                                                    output_filename_r2=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r2.fastq.gz'),
+                                                                                    fastq_stats=fastq_stats)
                         splitted_files_to_remove=[args.fastq_r1,args.fastq_r2]
 
                         info('Done!')
@@ -1075,12 +2205,14 @@ def main():
                                                                          output_filename_r2=_jp(os.path.basename(args.fastq_r2.replace('.fastq','')).replace('.gz','')+'_filtered.fastq.gz'),
                                                                          min_bp_quality=args.min_average_read_quality,
                                                                          min_single_bp_quality=args.min_single_bp_quality,
+                                                                         fastq_stats=fastq_stats,
                                                                          )
                 else:
                         args.fastq_r1=filter_se_fastq_by_qual(args.fastq_r1,
                                                                    output_filename=_jp(os.path.basename(args.fastq_r1).replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'),
                                                                    min_bp_quality=args.min_average_read_quality,
                                                                    min_single_bp_quality=args.min_single_bp_quality,
+                                                                   fastq_stats=fastq_stats,
                                                                    )
 
 
@@ -1137,8 +2269,8 @@ def main():
 
 
                  info('Estimating average read length...')
-                 if get_n_reads_fastq(output_forward_paired_filename):
-                     avg_read_length=get_avg_read_lenght_fastq(output_forward_paired_filename)
+                 if fastq_stats.get_n_reads(output_forward_paired_filename):
+                     avg_read_length=fastq_stats.get_avg_read_length(output_forward_paired_filename)
                      std_fragment_length=int(len_amplicon*0.1)
                  else:
                     raise NoReadsAfterQualityFiltering('No reads survived the average or single bp quality filtering.')
@@ -1166,9 +2298,13 @@ def main():
 
                  processed_output_filename=_jp('out.extendedFrags.fastq.gz')
 
+             info('Collapsing identical reads...')
+             collapsed_ids,collapsed_seqs,collapsed_counts=collapse_reads(get_reads_from_fastq(processed_output_filename,fastq_stats))
+             info('%d unique sequences from %d reads' % (len(collapsed_seqs),sum(collapsed_counts)))
+
              #count reads
-             N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
-             N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
+             N_READS_INPUT=fastq_stats.get_n_reads(args.fastq_r1)
+             N_READS_AFTER_PREPROCESSING=fastq_stats.get_n_reads(processed_output_filename)
              if N_READS_AFTER_PREPROCESSING == 0:
                  raise NoReadsAfterQualityFiltering('No reads in input or no reads survived the average or single bp quality filtering.')
 
@@ -1193,402 +2329,350 @@ def main():
                              outfile.write('>%s\n%s\n' % (database_id,args.expected_hdr_amplicon_seq))
              info('Done!')
 
-             def parse_needle_output(needle_filename,name='seq',just_score=False):
-                     needle_data=[]
-
+             def parse_needle_output(needle_infile,name='seq',just_score=False):
                      try:
-                         needle_infile=gzip.open(needle_filename)
-
-                         line=needle_infile.readline()
-                         while line:
-
-                                 while line and ('# Aligned_sequences' not  in line):
-                                         line=needle_infile.readline()
-
-                                 if line:
-                                         #print line
-                                         needle_infile.readline() #skip another line
-
-                                         line=needle_infile.readline()
-                                         id_seq=line.split()[-1].replace('_',':')
-
-                                         for _ in range(5):
-                                                 needle_infile.readline()
-
-                                         line=needle_infile.readline()
-
-                                         identity_seq=eval(line.strip().split(' ')[-1].replace('%','').replace(')','').replace('(',''))
-
-                                         if just_score:
-                                                 needle_data.append([id_seq,identity_seq])
-                                         else:
-                                                 for _ in range(7):
-                                                         needle_infile.readline()
-
-                                                 line=needle_infile.readline()
-                                                 aln_ref_seq=line.split()[2]
-
-
-                                                 aln_str=needle_infile.readline()[21:].rstrip('\n')
-                                                 line=needle_infile.readline()
-                                                 aln_query_seq=line.split()[2]
-                                                 aln_query_len=line.split()[3]
-                                                 needle_data.append([id_seq,identity_seq,aln_query_len,aln_ref_seq,aln_str,aln_query_seq])
-
-                         if just_score:
-                                 needle_infile.close()
-                                 return pd.DataFrame(needle_data,columns=['ID','score_'+name]).set_index('ID')
-                         else:
-                                 needle_infile.close()
-                                 return pd.DataFrame(needle_data,columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']).set_index('ID')
+                         return needle_records_to_dataframe(parse_needle_records(needle_infile,just_score),name,just_score)
                      except:
                          raise NeedleException('Failed to parse the output of needle!')
 
+             def parse_needle_shard(needle_process,shard_output_filename,name,just_score,df_shards,idx_shard):
+                     #needle writes to a pipe, the text output is saved only if requested
+                     needle_lines=needle_process.stdout
+                     try:
+                         if args.keep_intermediate or args.dump:
+                             outfile=gzip.open(shard_output_filename,'w+')
+                             df_shards[idx_shard]=parse_needle_output(tee_lines(needle_lines,outfile),name,just_score)
+                             outfile.close()
+                         else:
+                             df_shards[idx_shard]=parse_needle_output(needle_lines,name,just_score)
+                     except Exception as e:
+                         #closing the pipe stops needle
+                         needle_lines.close()
+                         df_shards[idx_shard]=e
+
+             def align_reads(reads,references):
+                     #each read is aligned in the same pass against all the references (name,sequence,fasta filename,needle output filename,just score),
+                     #the reads identical to a reference get a synthetic alignment for it and go to the aligner only for the other references
+                     groups=defaultdict(list)
+                     for idx,(id_seq,seq) in enumerate(reads):
+                         groups[tuple([idx_ref for idx_ref,reference in enumerate(references) if seq!=reference[1]])].append(idx)
+
+                     for idx_ref,(name,reference_seq,_,_,_) in enumerate(references):
+                         n_exact=sum([len(positions) for idxs_ref,positions in groups.items() if idx_ref not in idxs_ref])
+                         if n_exact:
+                             info('%d sequences identical to the %s amplicon, skipping their alignment to it' % (n_exact,'expected HDR' if name=='repaired' else 'reference'))
+
+                     #the needle output of each group is appended to the one of the reference
+                     positions=[]
+                     df_alignments=[]
+                     for idxs_ref,group_positions in groups.items():
+                         group_reads=[reads[idx] for idx in group_positions]
+                         df_aligned=dict(zip(idxs_ref,run_aligner(group_reads,[references[idx_ref] for idx_ref in idxs_ref]))) if idxs_ref else dict()
+
+                         df_alignments.append(combine_alignments([df_aligned[idx_ref] if idx_ref in df_aligned else get_exact_match_alignments(group_reads,name,just_score)
+                                                                  for idx_ref,(name,_,_,_,just_score) in enumerate(references)]))
+                         positions+=group_positions
+
+                     return pd.concat(df_alignments).iloc[np.argsort(positions)]
+
+             def run_aligner(reads,references):
+                     #the reads are split in interleaved shards aligned in parallel, the results are merged back in the original order
+                     n_shards=max(1,min(args.n_processes,len(reads)))
+                     shards=get_interleaved_shards(reads,n_shards)
+                     shard_sizes=[len(shard) for shard in shards]
+
+                     if args.aligner=='native':
+                         native_references=[(name,reference_seq,just_score) for name,reference_seq,_,_,just_score in references]
+                         if n_shards>1:
+                             df_shards=pool.map(align_reads_native_shard,
+                                                [(shard,native_references,gap_open,gap_extend,band_width) for shard in shards])
+                         else:
+                             df_shards=[align_reads_native_shard((reads,native_references,gap_open,gap_extend,band_width))]
 
+                     else:
+                         #the fasta of each shard is written once and read by a needle process for each reference
+                         shard_fasta_filenames=[]
+                         needle_jobs=[]
+                         for idx_shard,shard in enumerate(shards):
+                             shard_fasta_filename=references[0][3].replace('.txt.gz','_shard_%d.fa.gz' % idx_shard)
+                             shard_fasta_filenames.append(shard_fasta_filename)
+
+                             outfile=gzip.open(shard_fasta_filename,'w+')
+                             for id_seq,seq in shard:
+                                 outfile.write('>%s\n%s\n' % (id_seq,seq))
+                             outfile.close()
+
+                             for idx_ref,(name,reference_seq,reference_fasta_filename,needle_output_filename,just_score) in enumerate(references):
+                                 cmd="zcat < %s | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s"\
+                                 %(shard_fasta_filename,reference_fasta_filename,args.needle_options_string,log_filename)
+                                 needle_jobs.append((idx_shard,idx_ref,needle_output_filename.replace('.txt.gz','_shard_%d.txt.gz' % idx_shard),
+                                                     sb.Popen(cmd,shell=True,stdout=sb.PIPE)))
+
+                         #the outputs are parsed while needle is running, one thread for each pipe
+                         df_jobs=[None]*len(needle_jobs)
+                         parsing_threads=[threading.Thread(target=parse_needle_shard,
+                                                           args=(needle_process,shard_output_filename,references[idx_ref][0],references[idx_ref][4],df_jobs,idx_job))
+                                          for idx_job,(idx_shard,idx_ref,shard_output_filename,needle_process) in enumerate(needle_jobs)]
+                         for parsing_thread in parsing_threads:
+                             parsing_thread.start()
+                         for parsing_thread in parsing_threads:
+                             parsing_thread.join()
+
+                         NEEDLE_OUTPUT=[needle_process.wait() for _,_,_,needle_process in needle_jobs]
+
+                         for df_job in df_jobs:
+                             if isinstance(df_job,Exception):
+                                 raise df_job
+
+                         if any(NEEDLE_OUTPUT):
+                                 raise NeedleException('Needle failed to run, please check the log file.')
+
+                         #the shards are merged by position, needle must return one alignment for each read in the same order
+                         for (idx_shard,idx_ref,_,_),df_job in zip(needle_jobs,df_jobs):
+                             if len(df_job)!=shard_sizes[idx_shard] or \
+                             [id_seq.replace(':','_') for id_seq in df_job.index]!=[id_seq.replace(':','_') for id_seq,_ in shards[idx_shard]]:
+                                 raise NeedleException('The output of needle for the %s amplicon does not match the reads (%d alignments for %d reads), please check the log file.'\
+                                                       % ('expected HDR' if references[idx_ref][0]=='repaired' else 'reference',len(df_job),shard_sizes[idx_shard]))
+
+                         for shard_fasta_filename in shard_fasta_filenames:
+                             os.remove(shard_fasta_filename)
+
+                         if args.keep_intermediate or args.dump:
+                             #gzip files can be concatenated
+                             for idx_ref,(_,_,_,needle_output_filename,_) in enumerate(references):
+                                 shard_output_filenames=[shard_output_filename for _,idx_job_ref,shard_output_filename,_ in needle_jobs if idx_job_ref==idx_ref]
+                                 sb.call('cat %s >> %s' % (' '.join(shard_output_filenames),needle_output_filename),shell=True)
+                                 for shard_output_filename in shard_output_filenames:
+                                     os.remove(shard_output_filename)
+
+                         df_shards=[[df_job for (idx_shard,_,_,_),df_job in zip(needle_jobs,df_jobs) if idx_shard==idx] for idx in range(n_shards)]
+
+                     return [merge_interleaved_shards(pd.concat([df_shard[idx_ref] for df_shard in df_shards]),shard_sizes) for idx_ref in range(len(references))]
+
+
+             #the orientation of each read is decided before the alignment with the k-mers of the amplicon(s), the reads
+             #in the reverse complement orientation are reverse complemented so every read is aligned only once
+             #in case of ties the read is considered in the forward orientation
+             kmer_table=build_kmer_table([args.amplicon_seq]+([args.expected_hdr_amplicon_seq] if args.expected_hdr_amplicon_seq else []),args.kmer_size)
+             n_forward_kmers,n_rc_kmers,n_kmers=count_shared_kmers(collapsed_seqs,kmer_table,args.kmer_size)
+             collapsed_is_rc=n_rc_kmers>n_forward_kmers
+             info('%d sequences in the reverse complement orientation of the amplicon' % collapsed_is_rc.sum())
+
+             #the reads sharing too few k-mers with the amplicon(s) would not pass --min_identity_score, they are discarded
+             #without being aligned but are still counted in the total number of reads
+             if not args.no_kmer_prefilter:
+                 min_shared_kmers_fraction=get_min_shared_kmers_fraction(args.min_identity_score,args.kmer_size)
+                 collapsed_is_off_target=np.maximum(n_forward_kmers,n_rc_kmers)<min_shared_kmers_fraction*np.maximum(n_kmers,1)
+             else:
+                 collapsed_is_off_target=np.zeros(len(collapsed_seqs),dtype=bool)
+
+             N_READS_OFF_TARGET=int(np.array(collapsed_counts)[collapsed_is_off_target].sum())
+             if collapsed_is_off_target.any():
+                 info('Discarding %d reads (%d sequences) sharing less than %.2f%% of their %d-mers with the amplicon' \
+                      % (N_READS_OFF_TARGET,collapsed_is_off_target.sum(),min_shared_kmers_fraction*100,args.kmer_size))
+                 collapsed_ids=[id_seq for id_seq,is_off_target in zip(collapsed_ids,collapsed_is_off_target) if not is_off_target]
+                 collapsed_seqs=[seq for seq,is_off_target in zip(collapsed_seqs,collapsed_is_off_target) if not is_off_target]
+                 collapsed_counts=[count for count,is_off_target in zip(collapsed_counts,collapsed_is_off_target) if not is_off_target]
+                 collapsed_is_rc=collapsed_is_rc[~collapsed_is_off_target]
+
+             collapsed_reads=[(id_seq,reverse_complement(seq) if is_rc else seq) for id_seq,seq,is_rc in zip(collapsed_ids,collapsed_seqs,collapsed_is_rc)]
+
+             #check for duplicates, fix for duplicates when rc alignment
+             collapsed_ids=[ '_'.join([id_seq,'RC']) if is_rc else id_seq for id_seq,is_rc in zip(collapsed_ids,collapsed_is_rc)]
+             if len(set(collapsed_ids))!=len(collapsed_ids):
+                raise DuplicateSequenceIdException('The .fastq file/s contain/s duplicate sequence IDs')
 
-             info('Aligning sequences...')
-             #Alignment here
-
-             cmd=(('cat %s |'% processed_output_filename )+\
-             (' gunzip |' if processed_output_filename.endswith('.gz') else ' '))+\
-             r''' awk 'NR % 4 == 1 {print ">" $0} NR % 4 ==2 {print $0}' '''+\
-             " | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-             %(database_fasta_filename,args.needle_options_string,log_filename,needle_output_filename)
-
-             NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-             if NEEDLE_OUTPUT:
-                     raise NeedleException('Needle failed to run, please check the log file.')
-
+             del collapsed_ids,collapsed_seqs,collapsed_is_rc
+             del n_forward_kmers,n_rc_kmers,n_kmers,collapsed_is_off_target
 
              #If we have a donor sequence we just compare the fq in the two cases and see which one alignes better
+             references=[('ref',args.amplicon_seq,database_fasta_filename,needle_output_filename,False)]
              if args.expected_hdr_amplicon_seq:
+                     references.append(('repaired',args.expected_hdr_amplicon_seq,database_repair_fasta_filename,needle_output_repair_filename,True))
 
-                     cmd_repair=(('cat %s |'% processed_output_filename )+\
-                     (' gunzip |' if processed_output_filename.endswith('.gz') else ' '))+\
-                     r''' awk 'NR % 4 == 1 {print ">" $0} NR % 4 ==2 {print $0}' '''+\
-                     " | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                     %(database_repair_fasta_filename,args.needle_options_string,log_filename,needle_output_repair_filename)
-                     NEEDLE_OUTPUT=sb.call(cmd_repair,shell=True)
-
-                     if NEEDLE_OUTPUT:
-                             raise NeedleException('Needle failed to run, please check the log file.')
-                     info('Done!')
-
-             #merge the flow
-             if args.expected_hdr_amplicon_seq:
-                    df_database=parse_needle_output(needle_output_filename,'ref')
-                    df_database_repair=parse_needle_output(needle_output_repair_filename,'repaired',just_score=True)
-
-                    df_database_and_repair=df_database.join(df_database_repair)
-
-                    del df_database
-                    del df_database_repair
-
-                    #filter bad alignments
-
-                    N_TOTAL_ALSO_UNALIGNED=df_database_and_repair.shape[0]*1.0
-
-                    #find reads that failed to align and try on the reverse complement
-                    sr_not_aligned=df_database_and_repair.ix[(df_database_and_repair.score_ref <args.min_identity_score)\
-                                      & (df_database_and_repair.score_ref< args.min_identity_score)]\
-                                     .align_seq.apply(lambda x: x.replace('_',''))
-
-                    #filter out not aligned reads
-                    df_database_and_repair=\
-                    df_database_and_repair.ix[\
-                        (df_database_and_repair.score_ref>args.min_identity_score)\
-                        |(df_database_and_repair.score_repaired>args.min_identity_score)]
-
-                    df_database_and_repair['score_diff']=df_database_and_repair.score_ref-df_database_and_repair.score_repaired
+             #the needle output of each batch is appended to the one of the reference
+             for _,_,_,needle_output_filename,_ in references:
+                 if os.path.exists(needle_output_filename):
+                     os.remove(needle_output_filename)
 
-                    df_needle_alignment=df_database_and_repair
+             #remove the mutations in bp equal to 'N'
+             if 'N' in args.amplicon_seq:
+                 info('Your amplicon sequence contains one or more N, excluding these bp for the indel quantification...')
 
-                    del df_database_and_repair
+             #INITIALIZATIONS
 
+             #look around the sgRNA(s) only? the positions considered for the quantification are compiled once in a
+             #boolean mask over the amplicon shared by all the chunks
+             if cut_points and args.window_around_sgrna>0:
+                include_mask=np.zeros(len_amplicon,dtype=bool)
+                half_window=max(1,args.window_around_sgrna/2)
+                for cut_p in cut_points:
+                    st=max(0,cut_p-half_window+1)
+                    en=min(len(args.amplicon_seq)-1,cut_p+half_window+1)
+                    include_mask[st:en]=True
              else:
-                    df_needle_alignment=parse_needle_output(needle_output_filename,'ref')
-                    N_TOTAL_ALSO_UNALIGNED=df_needle_alignment.shape[0]*1.0
+                include_mask=np.ones(len_amplicon,dtype=bool)
 
-                    sr_not_aligned=df_needle_alignment.ix[(df_needle_alignment.score_ref <args.min_identity_score)]\
-                                     .align_seq.apply(lambda x: x.replace('_',''))
-                    #filter out not aligned reads
-                    df_needle_alignment=df_needle_alignment.ix[df_needle_alignment.score_ref>args.min_identity_score]
+             if args.exclude_bp_from_left:
+                include_mask[:args.exclude_bp_from_left]=False
 
+             if args.exclude_bp_from_right:
+                include_mask[-args.exclude_bp_from_right:]=False
 
 
-             #check if the not aligned reads are in the reverse complement
-             if sr_not_aligned.count():
-                 #write fastq_not_aligned
-                 fasta_not_aligned_filename=_jp('not_aligned_amplicon_forward.fa.gz')
+             #the alignment store is split in many chunks of consecutive reads with similar estimated cost (the modified reads
+             #are much slower than the unmodified ones), only the ranges of rows are generated
+             def get_chunk(alignment_store,n_processes=args.n_processes):
+                return get_balanced_chunks(estimate_quantification_costs(alignment_store),n_processes*QUANTIFICATION_CHUNKS_PER_PROCESS)
 
-                 outfile=gzip.open(fasta_not_aligned_filename,'w+')
-                 for x in sr_not_aligned.iteritems():
-                    outfile.write('>%s\n%s\n' % (x[0],x[1]))
 
-                 #write reverse complement of ampl and expected amplicon
-                 database_rc_fasta_filename=_jp('%s_database_rc.fa' % database_id)
-                 needle_output_rc_filename=_jp('needle_output_rc_%s.txt.gz' % database_id)
+             #range of the indel sizes in the histogram of the effective lengths
+             if args.guide_seq:
+                 min_cut=min(cut_points)
+                 max_cut=max(cut_points)
+                 xmin,xmax=-min_cut,len_amplicon-max_cut
+             else:
+                 min_cut=len_amplicon/2
+                 max_cut=len_amplicon/2
+                 xmin,xmax=-min_cut,+max_cut
 
-                 info('Align sequences to reverse complement of the amplicon...')
+             #the values needed for the reports are accumulated batch by batch, only the alignments of one batch are kept in memory
+             N_TOTAL_ALSO_UNALIGNED=N_READS_OFF_TARGET*1.0
+             quantification=QuantificationAccumulator(len_amplicon)
 
-                 with open(database_rc_fasta_filename,'w+') as outfile:
-                         outfile.write('>%s\n%s\n' % (database_id,reverse_complement(args.amplicon_seq)))
+             allele_columns=['align_seq','ref_seq','NHEJ','UNMODIFIED','HDR','n_deleted','n_inserted','n_mutated',]
+             if args.max_alleles_in_memory:
+                 allele_counter=TopAlleleCounter(allele_columns,args.max_alleles_in_memory,_jp('Alleles_frequency_table_by_batch.txt'))
+             else:
+                 allele_counter=AlleleCounter(allele_columns)
 
-                 if args.expected_hdr_amplicon_seq:
-                         database_repair_rc_fasta_filename=_jp('%s_database_repair_rc.fa' % database_id)
-                         needle_output_repair_rc_filename=_jp('needle_output_repair_rc_%s.txt.gz' % database_id)
-
-                         with open(database_repair_rc_fasta_filename,'w+') as outfile:
-                                 outfile.write('>%s\n%s\n' % (database_id,reverse_complement(args.expected_hdr_amplicon_seq)))
-                 info('Done!')
+             n_batches=(len(collapsed_reads)+args.batch_size-1)/args.batch_size
 
+             info('Aligning and quantifying sequences...')
+             if args.n_processes>1:
+                 info('[CRISPResso alignment and quantification are running in parallel mode with %d processes]' % args.n_processes)
+                 #the same pool is used for all the batches and for the plots, the processes are forked once the
+                 #masks used by the quantification are ready
+                 pool=mp.Pool(processes=args.n_processes)
+                 shared_prefix=_jp('shared_alignments')
+             else:
+                 pool=None
 
-                 #Now we do the alignment
-                 cmd="zcat < %s | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                 %(fasta_not_aligned_filename,database_rc_fasta_filename,args.needle_options_string,log_filename,needle_output_rc_filename)
+             for batch_st in range(0,len(collapsed_reads),args.batch_size):
 
-                 NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-                 if NEEDLE_OUTPUT:
-                         raise NeedleException('Needle failed to run, please check the log file.')
+                 if n_batches>1:
+                     info('Processing the sequences %d-%d of %d...' % (batch_st+1,min(batch_st+args.batch_size,len(collapsed_reads)),len(collapsed_reads)))
 
-                 if args.expected_hdr_amplicon_seq:
-                    cmd="zcat < %s | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                    %(fasta_not_aligned_filename,database_repair_rc_fasta_filename,args.needle_options_string,log_filename,needle_output_repair_rc_filename)
+                 #Alignment here
+                 df_database=align_reads(collapsed_reads[batch_st:batch_st+args.batch_size],references)
 
-                    NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-                    if NEEDLE_OUTPUT:
-                         raise NeedleException('Needle failed to run, please check the log file.')
+                 #the alignments are in the same order of the collapsed sequences
+                 df_database['n_reads']=collapsed_counts[batch_st:batch_st+args.batch_size]
 
+                 N_TOTAL_ALSO_UNALIGNED+=df_database.n_reads.sum()
 
-                 #merge the flow rev
+                 #filter out not aligned reads
                  if args.expected_hdr_amplicon_seq:
-                            df_database_rc=parse_needle_output(needle_output_rc_filename,'ref')
-                            df_database_repair_rc=parse_needle_output(needle_output_repair_rc_filename,'repaired',just_score=True)
+                        df_database=\
+                        df_database.ix[\
+                            (df_database.score_ref>args.min_identity_score)\
+                            |(df_database.score_repaired>args.min_identity_score)]
 
-                            df_database_and_repair_rc=df_database_rc.join(df_database_repair_rc)
+                        df_database['score_diff']=df_database.score_ref-df_database.score_repaired
+                 else:
+                        df_database=df_database.ix[df_database.score_ref>args.min_identity_score]
 
-                            del df_database_rc
-                            del df_database_repair_rc
+                 if df_database.shape[0]==0:
+                     continue
 
-                            #filter bad alignments also to rc
+                 #from here the reads are identified by their row in the alignment store, the IDs are not needed anymore
+                 alignment_store=AlignmentStore.from_dataframe(df_database)
+                 del df_database
 
+                 #the rest we have to look one by one to potentially exclude regions
+                 alignment_store['UNMODIFIED']=(alignment_store['score_ref']==100)
 
-                            df_database_and_repair_rc=\
-                            df_database_and_repair_rc.ix[\
-                                (df_database_and_repair_rc.score_ref>args.min_identity_score)\
-                                |(df_database_and_repair_rc.score_repaired>args.min_identity_score)]
+                 if 'N' in args.amplicon_seq:
+                     aln_str=alignment_store.codes['align_str']
+                     aln_str[alignment_store.codes['ref_seq']==ord('N')]=ord('|')
+                     #the alignments left with only one kind of character are unmodified
+                     alignment_store['UNMODIFIED']|=((aln_str==aln_str[:,:1]) | (aln_str==0)).all(axis=1)
 
-                            df_database_and_repair_rc['score_diff']=df_database_and_repair_rc.score_ref-df_database_and_repair_rc.score_repaired
+                 #####QUANTIFICATION START
 
-                            df_needle_alignment_rc=df_database_and_repair_rc
+                 #Use a Pool of processes, or just a single process
+                 if args.n_processes > 1:
+                    #the processes of the pool map in memory the alignments of the batch saved by this process
+                    shared_names,shared_filenames=alignment_store.save_shared(shared_prefix)
+                    chunk_results=pool.imap(process_shared_rows,[(shared_prefix,shared_names,row_st,row_en) for row_st,row_en in get_chunk(alignment_store)])
+                 else:
+                    chunk_results=[process_df_chunk(alignment_store)]
 
-                            del df_database_and_repair_rc
+                 read_classes_chunks=[]
+                 for read_classes_chunk,quantification_chunk in chunk_results:
+                      read_classes_chunks.append(read_classes_chunk)
+                      quantification.merge(quantification_chunk)
 
-                 else:
-                            df_needle_alignment_rc=parse_needle_output(needle_output_rc_filename,'ref')
+                 if args.n_processes > 1:
+                    for shared_filename in shared_filenames:
+                        os.remove(shared_filename)
 
-                            #filter out not aligned reads
-                            df_needle_alignment_rc=df_needle_alignment_rc.ix[df_needle_alignment_rc.score_ref>args.min_identity_score]
+                 #the chunks are in the same order of the reads
+                 for name in read_classes_chunks[0]:
+                     alignment_store[name]=np.concatenate([read_classes_chunk[name] for read_classes_chunk in read_classes_chunks])
+                 del read_classes_chunks
 
-                 #reverse complement and invert the align string so we have everything in the positive strand
-                 df_needle_alignment_rc['ref_seq']=df_needle_alignment_rc['ref_seq'].apply(reverse_complement)
-                 df_needle_alignment_rc['align_seq']=df_needle_alignment_rc['align_seq'].apply(reverse_complement)
-                 df_needle_alignment_rc['align_str']=df_needle_alignment_rc['align_str'].apply(lambda x: x[::-1])
+                 #alleles frequencies, the alleles of each batch are merged with the ones of the previous batches
+                 allele_counter.add(alignment_store,alignment_store['n_reads'])
 
+                 #the alignments are saved as soon as each batch is processed, with more batches the files are numbered like the batches
+                 if args.dump:
+                     dump_suffix='_batch_%d' % (batch_st/args.batch_size) if n_batches>1 else ''
+                     alignment_store.save(_jp('processed_reads_alignments%s' % dump_suffix))
+                     alignment_store.to_dataframe().to_pickle(_jp('processed_reads_dataframe%s.pickle' % dump_suffix))
+                 del alignment_store
 
-                 #fix for duplicates when rc alignment
-                 df_needle_alignment_rc.index=map(lambda x:'_'.join([x,'RC']),df_needle_alignment_rc.index)
+             info('Done!')
 
+             del collapsed_reads,collapsed_counts
 
-                 #append the RC reads to the aligned reads in the original orientation
-                 df_needle_alignment=df_needle_alignment.append(df_needle_alignment_rc)
+             quantification.save_to_folder(OUTPUT_DIRECTORY)
 
-                 del df_needle_alignment_rc
+             effect_vector_insertion,effect_vector_deletion,effect_vector_mutation,effect_vector_any,\
+             effect_vector_insertion_mixed,effect_vector_deletion_mixed,effect_vector_mutation_mixed,\
+             effect_vector_insertion_hdr,effect_vector_deletion_hdr,effect_vector_mutation_hdr,\
+             effect_vector_insertion_noncoding,effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,\
+             avg_vector_del_all,avg_vector_ins_all=[vector.copy() for vector in quantification.vectors.values()]
 
+             hist_inframe,hist_frameshift,hist_mutated,hist_inserted,hist_deleted,hist_indel_size=quantification.hists.values()
 
-             #check for duplicates
-             try:
-                assert df_needle_alignment.shape[0]== df_needle_alignment.index.unique().shape[0]
-             except:
-                raise DuplicateSequenceIdException('The .fastq file/s contain/s duplicate sequence IDs')
+             #we have insertions/deletions that change the concatenated exon sequence lenght and the difference between the final sequence
+             #and the original sequence lenght is not a multiple of 3
+             MODIFIED_FRAMESHIFT=quantification.counters['MODIFIED_FRAMESHIFT']
 
+             #we have insertions/deletions that change the concatenated exon sequence lenght and the difference between the final sequence
+             #and the original sequence lenght is a multiple of 3. We are in this case also when no indels are present but we have
+             #substitutions
+             MODIFIED_NON_FRAMESHIFT=quantification.counters['MODIFIED_NON_FRAMESHIFT']
 
-             #Initializations
-             info('Quantifying indels/substitutions...')
-             df_needle_alignment['UNMODIFIED']=(df_needle_alignment.score_ref==100)
+             #we don't touch the exons at all, the read can be still modified tough..
+             NON_MODIFIED_NON_FRAMESHIFT=quantification.counters['NON_MODIFIED_NON_FRAMESHIFT']
 
-             #the rest we have to look one by one to potentially exclude regions
-             df_needle_alignment['MIXED']=False
-             df_needle_alignment['HDR']=False
-             df_needle_alignment['NHEJ']=False
+             SPLICING_SITES_MODIFIED=quantification.counters['SPLICING_SITES_MODIFIED']
 
-             df_needle_alignment['n_mutated']=0
-             df_needle_alignment['n_inserted']=0
-             df_needle_alignment['n_deleted']=0
+             N_TOTAL=quantification.counters['N_TOTAL']*1.0
+             N_UNMODIFIED=quantification.counters['N_UNMODIFIED']
+             N_MODIFIED=quantification.counters['N_MODIFIED']
+             N_REPAIRED=quantification.counters['N_REPAIRED']
+             N_MIXED_HDR_NHEJ=quantification.counters['N_MIXED_HDR_NHEJ']
 
-             N_TOTAL=df_needle_alignment.shape[0]*1.0
+             #indel distribution based on the length of the reads
+             hdensity=histogram_from_counts(hist_indel_size,np.arange(xmin,xmax))[0]
 
              if N_TOTAL==0:
                  raise NoReadsAlignedException('Zero sequences aligned, please check your amplicon sequence')
                  error('Zero sequences aligned')
 
-             #remove the mutations in bp equal to 'N'
-             if 'N' in args.amplicon_seq:
-
-                 info('Your amplicon sequence contains one or more N, excluding these bp for the indel quantification...')
-
-                 def ignore_N_in_alignment(row):
-                     row['align_str']=''.join([('|' if  (row['ref_seq'][idx]=='N') else c ) for idx,c in enumerate(row['align_str'])])
-                     if len(set(row['align_str']))==1:
-                         row['UNMODIFIED']=True
-
-                     return row
-
-                 df_needle_alignment=df_needle_alignment.apply(ignore_N_in_alignment,axis=1)
-
-
-
-             #####QUANTIFICATION START
-             def compute_ref_positions(ref_seq):
-                     pos_idxs=[]
-                     idx=0
-                     for c in ref_seq:
-                             if c in set(['A','T','C','G','N']):
-                                     pos_idxs.append(idx)
-                                     idx+=1
-                             else:
-                                     if idx==0:
-                                             pos_idxs.append(-1)
-                                     else:
-                                             pos_idxs.append(-idx)
-                     return np.array(pos_idxs)
-
-             #compute positions relative to alignmnet
-             df_needle_alignment['ref_positions']=df_needle_alignment['ref_seq'].apply(compute_ref_positions)
-
-
-             #INITIALIZATIONS
-             re_find_indels=re.compile("(-*-)")
-             re_find_substitutions=re.compile("(\.*\.)")
-
-             effect_vector_insertion=np.zeros(len_amplicon)
-             effect_vector_deletion=np.zeros(len_amplicon)
-             effect_vector_mutation=np.zeros(len_amplicon)
-             effect_vector_any=np.zeros(len_amplicon)
-
-             effect_vector_insertion_mixed=np.zeros(len_amplicon)
-             effect_vector_deletion_mixed=np.zeros(len_amplicon)
-             effect_vector_mutation_mixed=np.zeros(len_amplicon)
-
-             effect_vector_insertion_hdr=np.zeros(len_amplicon)
-             effect_vector_deletion_hdr=np.zeros(len_amplicon)
-             effect_vector_mutation_hdr=np.zeros(len_amplicon)
-
-             effect_vector_insertion_noncoding=np.zeros(len_amplicon)
-             effect_vector_deletion_noncoding=np.zeros(len_amplicon)
-             effect_vector_mutation_noncoding=np.zeros(len_amplicon)
-
-             hist_inframe=defaultdict(lambda :0)
-             hist_frameshift=defaultdict(lambda :0)
-
-             avg_vector_del_all=np.zeros(len_amplicon)
-             avg_vector_ins_all=np.zeros(len_amplicon)
-
-             #look around the sgRNA(s) only?
-             if cut_points and args.window_around_sgrna>0:
-                include_idxs=[]
-                half_window=max(1,args.window_around_sgrna/2)
-                for cut_p in cut_points:
-                    st=max(0,cut_p-half_window+1)
-                    en=min(len(args.amplicon_seq)-1,cut_p+half_window+1)
-                    include_idxs.append(range(st,en))
-             else:
-                include_idxs=range(len(args.amplicon_seq))
-
-             exclude_idxs=[]
-
-             if args.exclude_bp_from_left:
-                exclude_idxs+=range(args.exclude_bp_from_left)
-
-             if args.exclude_bp_from_right:
-                exclude_idxs+=range(len_amplicon)[-args.exclude_bp_from_right:]
-
-
-
-
-             #flatten the arrays to avoid errors with old numpy library
-             include_idxs=np.ravel(include_idxs)
-             exclude_idxs=np.ravel(exclude_idxs)
-
-             include_idxs=set(np.setdiff1d(include_idxs,exclude_idxs))
-
-
-             #handy generator to split in chunks the dataframe, np.split_array is slow!
-             def get_chunk(df_needle_alignment,n_processes=args.n_processes):
-				for g,df in df_needle_alignment.groupby(np.arange(len(df_needle_alignment)) // (len(df_needle_alignment)/(args.n_processes-1))):
-					yield df
-
-
-
-             #Use a Pool of processes, or just a single process
-             if args.n_processes > 1:
-                info('[CRISPResso quantification is running in parallel mode with %d processes]' % min(df_needle_alignment.shape[0],args.n_processes) )
-                pool = mp.Pool(processes=min(df_needle_alignment.shape[0],args.n_processes))
-                chunks_computed=[]
-                for result in pool.imap(process_df_chunk,get_chunk(df_needle_alignment)):
-                     df_needle_alignment_chunk, effect_vector_insertion_chunk,effect_vector_deletion_chunk,\
-                     effect_vector_mutation_chunk,effect_vector_any_chunk,effect_vector_insertion_mixed_chunk,effect_vector_deletion_mixed_chunk,\
-                     effect_vector_mutation_mixed_chunk,effect_vector_insertion_hdr_chunk,effect_vector_deletion_hdr_chunk,effect_vector_mutation_hdr_chunk,\
-                     effect_vector_insertion_noncoding_chunk,effect_vector_deletion_noncoding_chunk,effect_vector_mutation_noncoding_chunk,hist_inframe_chunk,\
-                     hist_frameshift_chunk,avg_vector_del_all_chunk,avg_vector_ins_all_chunk,MODIFIED_FRAMESHIFT_chunk,MODIFIED_NON_FRAMESHIFT_chunk,NON_MODIFIED_NON_FRAMESHIFT_chunk,\
-                     SPLICING_SITES_MODIFIED_chunk=result
-
-                     chunks_computed.append(df_needle_alignment_chunk)
-                     effect_vector_insertion+=effect_vector_insertion_chunk
-                     effect_vector_deletion+=effect_vector_deletion_chunk
-                     effect_vector_mutation+=effect_vector_mutation_chunk
-                     effect_vector_any+=effect_vector_any_chunk
-                     effect_vector_insertion_mixed+=effect_vector_insertion_mixed_chunk
-                     effect_vector_deletion_mixed+=effect_vector_deletion_mixed_chunk
-                     effect_vector_mutation_mixed+=effect_vector_mutation_mixed_chunk
-                     effect_vector_insertion_hdr+=effect_vector_insertion_hdr_chunk
-                     effect_vector_deletion_hdr+=effect_vector_deletion_hdr_chunk
-                     effect_vector_mutation_hdr+=effect_vector_mutation_hdr_chunk
-                     effect_vector_insertion_noncoding+=effect_vector_insertion_noncoding_chunk
-                     effect_vector_deletion_noncoding+=effect_vector_deletion_noncoding_chunk
-                     effect_vector_mutation_noncoding+=effect_vector_mutation_noncoding_chunk
-                     add_hist(hist_inframe_chunk,hist_inframe)
-                     add_hist(hist_frameshift_chunk,hist_frameshift)
-                     avg_vector_del_all+=avg_vector_del_all_chunk
-                     avg_vector_ins_all+=avg_vector_ins_all_chunk
-                     MODIFIED_FRAMESHIFT+=MODIFIED_FRAMESHIFT_chunk
-                     MODIFIED_NON_FRAMESHIFT+=MODIFIED_NON_FRAMESHIFT_chunk
-                     NON_MODIFIED_NON_FRAMESHIFT+=NON_MODIFIED_NON_FRAMESHIFT_chunk
-                     SPLICING_SITES_MODIFIED+=SPLICING_SITES_MODIFIED_chunk
-
-                pool.close()
-                pool.join()
-                df_needle_alignment=pd.concat(chunks_computed)
-                del chunks_computed
-
-             else:
-                 df_needle_alignment, effect_vector_insertion,\
-                 effect_vector_deletion,effect_vector_mutation,\
-                 effect_vector_any,effect_vector_insertion_mixed,\
-                 effect_vector_deletion_mixed,effect_vector_mutation_mixed,\
-                 effect_vector_insertion_hdr,effect_vector_deletion_hdr,\
-                 effect_vector_mutation_hdr,effect_vector_insertion_noncoding,\
-                 effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,\
-                 hist_inframe,hist_frameshift,avg_vector_del_all,\
-                 avg_vector_ins_all,MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,\
-                 NON_MODIFIED_NON_FRAMESHIFT,SPLICING_SITES_MODIFIED= process_df_chunk(df_needle_alignment)
-
-
-             N_MODIFIED=df_needle_alignment['NHEJ'].sum()
-             N_UNMODIFIED=df_needle_alignment['UNMODIFIED'].sum()
-             N_MIXED_HDR_NHEJ=df_needle_alignment['MIXED'].sum()
-             N_REPAIRED=df_needle_alignment['HDR'].sum()
-
              #disable known division warning
              with np.errstate(divide='ignore',invalid='ignore'):
 
@@ -1609,630 +2693,116 @@ def main():
                  if not dict(hist_frameshift):
                     hist_frameshift={0:0}
 
-             info('Done!')
-
-             info('Calculating indel distribution based on the length of the reads...')
-
-             df_needle_alignment['effective_len']=df_needle_alignment.apply(lambda row:  len_amplicon+row.n_inserted-row.n_deleted,axis=1)
-
-             info('Done!')
-
              #write alleles table
              info('Calculating alleles frequencies...')
 
-             def get_ref_positions(row,df_alignment):
-                return list(df_alignment.ix[(row.Aligned_Sequence ,row.Reference_Sequence),'ref_positions'][0])
-
-             df_alleles=df_needle_alignment.groupby(['align_seq','ref_seq','NHEJ','UNMODIFIED','HDR','n_deleted','n_inserted','n_mutated',]).size()
-             df_alleles=df_alleles.reset_index()
-             df_alleles.rename(columns={0:'#Reads','align_seq':'Aligned_Sequence','ref_seq':'Reference_Sequence'},inplace=True)
+             df_alleles=allele_counter.to_dataframe()
+             df_alleles.rename(columns={'n_reads':'#Reads','align_seq':'Aligned_Sequence','ref_seq':'Reference_Sequence'},inplace=True)
              #df_alleles.set_index('Aligned_Sequence',inplace=True)
-             df_alleles['%Reads']=df_alleles['#Reads']/df_alleles['#Reads'].sum()*100
+             #the percentages are relative to all the reads, also when only the most frequent alleles are reported
+             df_alleles['%Reads']=df_alleles['#Reads']/float(allele_counter.n_reads)*100
+
+             if args.max_alleles_in_memory and allele_counter.min_count:
+                 warn('Only the %d most frequent alleles were kept in memory: the alleles with %d reads or less (%.2f%% of the reads) may be missing from the alleles tables, so their tails (also the counts around the cut sites) are approximate. The exact counts of all the alleles of each batch are in: %s' \
+                      % (args.max_alleles_in_memory,allele_counter.min_count,allele_counter.min_count*100.0/allele_counter.n_reads,allele_counter.spill_filename))
+             del allele_counter
 
              if np.sum(np.array(map(int,pd.__version__.split('.')))*(100,10,1))< 170:
                 df_alleles.sort('#Reads',ascending=False,inplace=True)
              else:
                 df_alleles.sort_values(by='#Reads',ascending=False,inplace=True)
 
-             #add ref positions for the plot around the cut sites
-             df_needle_alignment.set_index(['align_seq','ref_seq'],inplace=True)
-             df_needle_alignment.sort_index(inplace=True)
-             df_alleles['ref_positions']=df_alleles.apply(lambda x: get_ref_positions(x,df_needle_alignment),axis=1).values
-
              info('Done!')
 
 
              info('Making Plots...')
-             #plot effective length
-             if args.guide_seq:
-                 min_cut=min(cut_points)
-                 max_cut=max(cut_points)
-                 xmin,xmax=-min_cut,len_amplicon-max_cut
-             else:
-                 min_cut=len_amplicon/2
-                 max_cut=len_amplicon/2
-                 xmin,xmax=-min_cut,+max_cut
-
+             #each figure is an independent task that gets only the data it needs, with more processes the figures
+             #are rendered by a pool while the text outputs are written
+             plot_tasks=[]
 
-             hdensity,hlengths=np.histogram(df_needle_alignment.effective_len-len_amplicon,np.arange(xmin,xmax))
-             hlengths=hlengths[:-1]
+             #plot effective length
+             hlengths=np.arange(xmin,xmax)[:-1]
              center_index=np.nonzero(hlengths==0)[0][0]
 
-             fig=plt.figure(figsize=(8.3,8))
-
-             plt.bar(0,hdensity[center_index],color='red',linewidth=0)
-             #plt.hold(True)
-             barlist=plt.bar(hlengths,hdensity,align='center',linewidth=0)
-             barlist[center_index].set_color('r')
-             plt.xlim([xmin,xmax])
-             plt.ylabel('Sequences (no.)')
-             plt.xlabel('Indel size (bp)')
-             plt.ylim([0,hdensity.max()*1.2])
-             plt.title('Indel size distribution')
-             lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
-             #lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(3)
-             lgd.legendHandles[1].set_height(3)
-             plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.png'),bbox_inches='tight')
-
-
-             plt.figure(figsize=(8.3,8))
-             plt.bar(0,hdensity[center_index]/(float(hdensity.sum()))*100.0,color='red',linewidth=0)
-             #plt.hold(True)
-             barlist=plt.bar(hlengths,hdensity/(float(hdensity.sum()))*100.0,align='center',linewidth=0)
-             barlist[center_index].set_color('r')
-             plt.xlim([xmin,xmax])
-             plt.title('Indel size distribution')
-             plt.ylabel('Sequences (%)')
-             plt.xlabel('Indel size (bp)')
-             #lgd=plt.legend(['No indel','Indel'])
-             lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(3)
-             lgd.legendHandles[1].set_height(3)
-
-             plt.savefig(_jp('1b.Indel_size_distribution_percentage.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('1b.Indel_size_distribution_percentage.png'),bbox_inches='tight')
-
+             plot_tasks.append((plot_indel_size_distribution_n_sequences,(hlengths,hdensity,center_index,xmin,xmax),{}))
+             plot_tasks.append((plot_indel_size_distribution_percentage,(hlengths,hdensity,center_index,xmin,xmax),{}))
 
              ####PIE CHARTS FOR HDR/NHEJ/MIXED/EVENTS###
 
              if args.expected_hdr_amplicon_seq:
-
-
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([N_UNMODIFIED,N_MIXED_HDR_NHEJ,N_MODIFIED,N_REPAIRED],\
-                                                                   labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
-                                                                           'Mixed HDR-NHEJ\n(%d reads)' %N_MIXED_HDR_NHEJ,
-                                                                           'NHEJ\n(%d reads)' % N_MODIFIED, \
-                                                                           'HDR\n(%d reads)' %N_REPAIRED,
-                                                                           ],\
-                                                                   explode=(0,0,0,0),\
-                                                                   colors=[(1,0,0,0.2),(0,1,1,0.2),(0,0,1,0.2),(0,1,0,0.2)],autopct='%1.1f%%')
-
-                 if cut_points or args.donor_seq:
-                    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                    #plt.hold(True)
-
-                    if args.donor_seq:
-                        ax2.plot(core_donor_seq_st_en,[0,0],'-',lw=10,c=(0,1,0,0.5),label='Donor Sequence')
-
-                    if cut_points:
-                        ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=24,label='Predicted Cas9 cleavage site/s')
-
-                    for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                         if idx==0:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA')
-                         else:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_')
-
-                    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
-                    plt.xlim(0,len_amplicon)
-                    plt.axis('off')
-
-
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
+                 plot_tasks.append((plot_unmodified_nhej_hdr_pie_chart,(N_UNMODIFIED,N_MIXED_HDR_NHEJ,N_MODIFIED,N_REPAIRED,len_amplicon,cut_points,offset_plots,sgRNA_intervals,
+                                                                        core_donor_seq_st_en if args.donor_seq else None),{}))
              else:
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100],\
-                                                   labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
-                                                           'NHEJ\n(%d reads)' % N_MODIFIED],\
-                                                   explode=(0,0),colors=[(1,0,0,0.2),(0,0,1,0.2)],autopct='%1.1f%%')
-
-                 if cut_points:
-                    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                    #plt.hold(True)
-
-
-                    for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                         if idx==0:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                         else:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                    ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=12,label='Predicted Cas9 cleavage site/s')
-                    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1,prop={'size':'large'})
-                    plt.xlim(0,len_amplicon)
-                    plt.axis('off')
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
-
-             ###############################################################################################################################################
-
-
-             ###############################################################################################################################################
+                 plot_tasks.append((plot_unmodified_nhej_pie_chart,(N_UNMODIFIED,N_MODIFIED,N_TOTAL,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
 
              #(3) a graph of frequency of deletions and insertions of various sizes (deletions could be consider as negative numbers and insertions as positive);
 
-
-             def calculate_range(df,column_name):
-                df_not_zero=df.ix[df[column_name]>0,column_name]
+             def calculate_range(hist):
+                values_not_zero=np.array([value for value in sorted(hist.keys()) if value>0])
                 try:
-                    r=max(15,int(np.round(np.percentile(df_not_zero,99))))
+                    r=max(15,int(np.round(np.percentile(np.repeat(values_not_zero,[hist[value] for value in values_not_zero]),99))))
                 except:
                     r=15
                 return r
 
-             range_mut=calculate_range(df_needle_alignment,'n_mutated')
-             range_ins=calculate_range(df_needle_alignment,'n_inserted')
-             range_del=calculate_range(df_needle_alignment,'n_deleted')
-
-             y_values_mut,x_bins_mut=plt.histogram(df_needle_alignment['n_mutated'],bins=range(0,range_mut))
-             y_values_ins,x_bins_ins=plt.histogram(df_needle_alignment['n_inserted'],bins=range(0,range_ins))
-             y_values_del,x_bins_del=plt.histogram(df_needle_alignment['n_deleted'],bins=range(0,range_del))
-
-             fig=plt.figure(figsize=(26,6.5))
-
-
-             ax=fig.add_subplot(1,3,1)
-             ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-
-             plt.title('Insertions')
-             plt.xlabel('Size (bp)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-insertion','Insertion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmin=-1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-             ax=fig.add_subplot(1,3,2)
-             ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-             plt.title('Deletions')
-             plt.xlabel('Size (bp)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-deletion','Deletion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmax=1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-
-
-             ax=fig.add_subplot(1,3,3)
-             ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-             plt.title('Substitutions')
-             plt.xlabel('Positions substituted (number)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-substitution','Substitution'][::-1] ,bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmin=-1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-
-             plt.tight_layout()
-
-             plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.png'),bbox_inches='tight')
+             range_mut=calculate_range(hist_mutated)
+             range_ins=calculate_range(hist_inserted)
+             range_del=calculate_range(hist_deleted)
 
+             y_values_mut,x_bins_mut=histogram_from_counts(hist_mutated,range(0,range_mut))
+             y_values_ins,x_bins_ins=histogram_from_counts(hist_inserted,range(0,range_ins))
+             y_values_del,x_bins_del=histogram_from_counts(hist_deleted,range(0,range_del))
 
+             plot_tasks.append((plot_indel_substitution_size_hist,(x_bins_ins,y_values_ins,x_bins_del,y_values_del,x_bins_mut,y_values_mut,N_TOTAL),{}))
 
              #(4) another graph with the frequency that each nucleotide within the amplicon was modified in any way (perhaps would consider insertion as modification of the flanking nucleotides);
 
              #Indels location Plots
-
-             plt.figure(figsize=(10,10))
-
-             y_max=max(effect_vector_any)*1.2
-
-             plt.plot(effect_vector_any,'r',lw=3,label='Combined Insertions/Deletions/Substitutions')
-             #plt.hold(True)
-
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                 for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                     if idx==0:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                     else:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-
-             lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.23),ncol=1, fancybox=True, shadow=True)
-             y_label_values=np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/float(N_TOTAL)*100, n_reads) for n_reads in y_label_values])
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-             plt.title('Mutation position distribution')
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Sequences % (no.)')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len(args.amplicon_seq)-1)
-             plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
-
-             #NHEJ
-             plt.figure(figsize=(10,10))
-             plt.plot(effect_vector_insertion,'r',lw=3,label='Insertions')
-             #plt.hold(True)
-             plt.plot(effect_vector_deletion,'m',lw=3,label='Deletions')
-             plt.plot(effect_vector_mutation,'g',lw=3,label='Substitutions')
-
-             y_max=max(max(effect_vector_insertion),max(effect_vector_deletion),max(effect_vector_mutation))*1.2
-
-
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                 for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                     if idx==0:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                     else:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-             lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-             y_label_values=np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MODIFIED)*100, n_reads) for n_reads in y_label_values])
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Sequences: % Total ( % NHEJ, no. )')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len(args.amplicon_seq)-1)
-
-             plt.title('Mutation position distribution of NHEJ')
-             plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
+             plot_tasks.append((plot_combined_mutation_locations,(effect_vector_any,N_TOTAL,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
+             plot_tasks.append((plot_nhej_mutation_locations,(effect_vector_insertion,effect_vector_deletion,effect_vector_mutation,N_TOTAL,N_MODIFIED,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
 
              if args.expected_hdr_amplicon_seq:
+                 plot_tasks.append((plot_hdr_mutation_locations,(effect_vector_insertion_hdr,effect_vector_deletion_hdr,effect_vector_mutation_hdr,N_TOTAL,N_REPAIRED,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
+                 plot_tasks.append((plot_mixed_hdr_nhej_mutation_locations,(effect_vector_insertion_mixed,effect_vector_deletion_mixed,effect_vector_mutation_mixed,N_TOTAL,N_MIXED_HDR_NHEJ,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
 
-                 #HDR
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_hdr,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_hdr,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_hdr,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_hdr),max(effect_vector_deletion_hdr),max(effect_vector_mutation_hdr))*1.2
-
-                 if cut_points:
-
-                         for idx,cut_point in enumerate(cut_points):
-                             if idx==0:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                             else:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 y_label_values=np.arange(0,y_max,y_max/6).astype(int)
-                 plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_REPAIRED)*100, n_reads) for n_reads in y_label_values])
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences: % Total ( % HDR, no. )')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Mutation position distribution of HDR')
-                 plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
-
-                 #MIXED
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_mixed,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_mixed,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_mixed,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_mixed),max(effect_vector_deletion_mixed),max(effect_vector_mutation_mixed))*1.2
-
-                 if cut_points:
-
-                         for idx,cut_point in enumerate(cut_points):
-                             if idx==0:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                             else:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 y_label_values=np.arange(0,y_max,y_max/6).astype(int)
-                 plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MIXED_HDR_NHEJ)*100, n_reads) for n_reads in y_label_values])
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences: % Total ( % mixed HDR-NHEJ, no. )')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Mutation position distribution of mixed HDR-NHEJ')
-                 plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
-
-            #Position dependent indels plot
-             fig=plt.figure(figsize=(24,10))
-             ax1=fig.add_subplot(1,2,1)
-             markerline, stemlines, baseline=ax1.stem(avg_vector_ins_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
-             plt.setp(markerline, 'markerfacecolor', 'r', 'markersize', 8)
-             plt.setp(baseline, 'linewidth', 0)
-             plt.setp(stemlines, 'color', 'r','linewidth',3)
-             #plt.hold(True)
-             y_max=max(avg_vector_ins_all)*1.2
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Average insertion length')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len_amplicon-1)
-             ax1.set_title('Position dependent insertion size')
-             plt.tight_layout()
-
-             ax2=fig.add_subplot(1,2,2)
-             markerline, stemlines, baseline=ax2.stem(avg_vector_del_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
-             plt.setp(markerline, 'markerfacecolor', 'm', 'markersize', 8)
-             plt.setp(baseline, 'linewidth', 0)
-             plt.setp(stemlines, 'color', 'm','linewidth',3)
-             #plt.hold(True)
-             y_max=max(avg_vector_del_all)*1.2
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Average deletion length')
-
-             plt.ylim(ymin=0,ymax=max(1,y_max))
-             plt.xlim(xmax=len_amplicon-1)
-             ax2.set_title('Position dependent deletion size')
-
-             plt.tight_layout()
-
-
-             plt.savefig(_jp('4e.Position_dependent_average_indel_size.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                 plt.savefig(_jp('4e.Position_dependent_average_indel_size.png'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-
+             #Position dependent indels plot
+             plot_tasks.append((plot_position_dependent_indel_size,(avg_vector_ins_all,avg_vector_del_all,len_amplicon,cut_points,offset_plots),{}))
 
              if PERFORM_FRAMESHIFT_ANALYSIS:
                  #make frameshift plots
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([MODIFIED_FRAMESHIFT,\
-                                                    MODIFIED_NON_FRAMESHIFT,\
-                                                    NON_MODIFIED_NON_FRAMESHIFT],\
-                                                    labels=['Frameshift mutation\n(%d reads)' %MODIFIED_FRAMESHIFT,\
-                                                           'In-frame mutation\n(%d reads)' % MODIFIED_NON_FRAMESHIFT,\
-                                                           'Noncoding mutation\n(%d reads)' %NON_MODIFIED_NON_FRAMESHIFT],\
-                                                    explode=(0.0,0.0,0.0),\
-                                                    colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99215686,  0.73333333,  0.51764706,0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
-                                                    autopct='%1.1f%%')
-
-                 ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                 ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                 #plt.hold(True)
-
-                 for idx,exon_interval in enumerate(exon_intervals):
-                     if idx==0:
-                         ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='Coding sequence/s',solid_capstyle='butt')
-                     else:
-                         ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='_nolegend_',solid_capstyle='butt')
-
-                 if cut_points:
-                    ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=25,label='Predicted Cas9 cleavage site/s')
-
-                 plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
-                 plt.xlim(0,len_amplicon)
-                 plt.axis('off')
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
-
-                 #profiles-----------------------------------------------------------------------------------
-                 fig=plt.figure(figsize=(22,10))
-                 ax1=fig.add_subplot(2,1,1)
-                 x,y=map(np.array,zip(*[a for a in hist_frameshift.iteritems()]))
-                 y=y/float(sum(hist_frameshift.values()))*100
-                 ax1.bar(x-0.5,y)
-                 ax1.set_xlim(-30.5,30.5)
-                 ax1.set_frame_on(False)
-                 ax1.set_xticks([idx for idx in range(-30,31) if idx % 3])
-                 ax1.tick_params(which='both',      # both major and minor ticks are affected
-                    bottom='off',      # ticks along the bottom edge are off
-                    top='off',         # ticks along the top edge are off
-                    labelbottom='on') # labels along the bottom edge are off)
-                 ax1.yaxis.tick_left()
-                 xmin, xmax = ax1.get_xaxis().get_view_interval()
-                 ymin, ymax = ax1.get_yaxis().get_view_interval()
-                 ax1.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if idx % 3]],rotation='vertical')
-                 plt.title('Frameshift profile')
-                 ax1.tick_params(axis='both', which='major', labelsize=32)
-                 ax1.tick_params(axis='both', which='minor', labelsize=32)
-                 plt.tight_layout()
-                 plt.ylabel('%')
-
-                 ax2=fig.add_subplot(2,1,2)
-                 x,y=map(np.array,zip(*[a for a in hist_inframe.iteritems()]))
-                 y=y/float(sum(hist_inframe.values()))*100
-                 ax2.bar(x-0.5,y,color=(0,1,1,0.2))
-                 ax2.set_xlim(-30.5,30.5)
-                 ax2.set_frame_on(False)
-                 ax2.set_xticks([idx for idx in range(-30,31) if (idx % 3 ==0) ])
-                 ax2.tick_params(which='both',      # both major and minor ticks are affected
-                    bottom='off',      # ticks along the bottom edge are off
-                    top='off',         # ticks along the top edge are off
-                    labelbottom='on') # labels along the bottom edge are off)
-                 ax2.yaxis.tick_left()
-                 xmin, xmax = ax2.xaxis.get_view_interval()
-                 ymin, ymax = ax2.yaxis.get_view_interval()
-                 ax2.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if (idx % 3==0)]],rotation='vertical')
-                 plt.title('In-frame profile')
-                 plt.tight_layout()
-                 plt.ylabel('%')
-                 ax2.tick_params(axis='both', which='major', labelsize=32)
-                 ax2.tick_params(axis='both', which='minor', labelsize=32)
-                 plt.tight_layout()
-
-                 plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.png'),pad_inches=1,bbox_inches='tight')
-
-                 #-----------------------------------------------------------------------------------------------------------
-                 fig=plt.figure(figsize=(12*1.5,12*1.5))
-                 ax=fig.add_subplot(1,1,1)
-                 patches, texts, autotexts =ax.pie([SPLICING_SITES_MODIFIED,\
-                                                   (df_needle_alignment.shape[0] - SPLICING_SITES_MODIFIED)],\
-                                                   labels=['Potential splice sites modified\n(%d reads)' %SPLICING_SITES_MODIFIED,\
-                                                           'Unmodified\n(%d reads)' % (df_needle_alignment.shape[0]- SPLICING_SITES_MODIFIED)],\
-                                                   explode=(0.0,0),\
-                                                   colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
-                                                   autopct='%1.1f%%')
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
+                 plot_tasks.append((plot_frameshift_pie_chart,(MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,NON_MODIFIED_NON_FRAMESHIFT,len_amplicon,exon_intervals,cut_points,offset_plots),{}))
+                 plot_tasks.append((plot_frameshift_profiles,(hist_frameshift,hist_inframe),{}))
+                 plot_tasks.append((plot_splice_sites_pie_chart,(SPLICING_SITES_MODIFIED,N_TOTAL),{}))
                  #non coding
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_noncoding,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_noncoding,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_noncoding,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_noncoding),max(effect_vector_deletion_noncoding),max(effect_vector_mutation_noncoding))*1.2
-
-
-                 if cut_points:
-
-                     for idx,cut_point in enumerate(cut_points):
-                         if idx==0:
-                                 plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                         else:
-                                 plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences (no.)')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Noncoding mutation position distribution')
-                 plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.png'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+                 plot_tasks.append((plot_noncoding_mutation_locations,(effect_vector_insertion_noncoding,effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,len_amplicon,cut_points,offset_plots,sgRNA_intervals),{}))
 
              ##new plots alleles around cut_sites
 
-             for sgRNA,cut_point in zip(sgRNA_sequences,cut_points):
-                 #print sgRNA,cut_point
+             #the alleles around all the cut sites are computed together
+             dfs_alleles_around_cut=get_dataframes_around_cuts(df_alleles,cut_points,args.offset_around_cut_to_plot) if cut_points else []
 
-                 df_allele_around_cut=get_dataframe_around_cut(df_alleles, cut_point,args.offset_around_cut_to_plot)
+             for sgRNA,cut_point,df_allele_around_cut in zip(sgRNA_sequences,cut_points,dfs_alleles_around_cut):
+                 #print sgRNA,cut_point
 
                  #write alleles table to file
                  df_allele_around_cut.to_csv(_jp('Alleles_frequency_table_around_cut_site_for_%s.txt' % sgRNA),sep='\t',header=True)
-                 plot_alleles_table(args.amplicon_seq,cut_point, df_allele_around_cut,sgRNA,OUTPUT_DIRECTORY,MIN_FREQUENCY=args.min_frequency_alleles_around_cut_to_plot,MAX_N_ROWS=args.max_rows_alleles_around_cut_to_plot)
 
-             info('Done!')
+                 #only the most frequent alleles are shown in the plot, the others are not saved with the plot data
+                 n_alleles_to_plot=len(df_allele_around_cut.ix[df_allele_around_cut['%Reads']>=args.min_frequency_alleles_around_cut_to_plot][:args.max_rows_alleles_around_cut_to_plot])
+                 plot_tasks.append((plot_alleles_table,(args.amplicon_seq,cut_point,df_allele_around_cut[:max(1,n_alleles_to_plot)],sgRNA),
+                                    {'MIN_FREQUENCY':args.min_frequency_alleles_around_cut_to_plot,'MAX_N_ROWS':args.max_rows_alleles_around_cut_to_plot}))
+
+             #the data of the plots are saved to render them again (or later with --no_plots) with CRISPRessoPlot
+             save_plot_data(plot_tasks,OUTPUT_DIRECTORY)
+
+             if args.no_plots:
+                 info('Skipping the plots, the data to make them with CRISPRessoPlot are saved in: %s' % _jp(PLOT_DATA_FILENAME))
+             else:
+                 if args.n_processes>1:
+                     info('[CRISPResso plots are rendered in parallel mode with %d processes]' % args.n_processes)
+                 wait_plots=render_plots(plot_tasks,OUTPUT_DIRECTORY,args.save_also_png,args.n_processes,pool)
+                 if args.n_processes==1:
+                     info('Done!')
 
              if not args.keep_intermediate:
                  info('Removing Intermediate files...')
@@ -2248,11 +2818,6 @@ def main():
                      files_to_remove+=[output_forward_paired_filename,output_reverse_paired_filename,\
                                                        output_forward_unpaired_filename,output_reverse_unpaired_filename]
 
-                 if not args.dump:
-                     files_to_remove+=[needle_output_filename]
-                     if args.expected_hdr_amplicon_seq:
-                         files_to_remove+=[needle_output_repair_filename]
-
                  if args.expected_hdr_amplicon_seq:
                      files_to_remove+=[database_repair_fasta_filename,]
 
@@ -2266,12 +2831,6 @@ def main():
                     else:
                              files_to_remove+=[args.fastq_r1]
 
-                 if sr_not_aligned.count():
-                     files_to_remove+=[fasta_not_aligned_filename,database_rc_fasta_filename,needle_output_rc_filename]
-
-                     if args.expected_hdr_amplicon_seq:
-                            files_to_remove+=[database_repair_rc_fasta_filename,needle_output_repair_rc_filename]
-
 
                  for file_to_remove in files_to_remove:
                      try:
@@ -2288,25 +2847,25 @@ def main():
                      np.savetxt(_jp('%s.txt' %name), np.vstack([(np.arange(len(vector))+1),vector]).T, fmt=['%d','%.18e'],delimiter='\t', newline='\n', header='amplicon position\teffect',footer='', comments='# ')
 
 
-             nhej_inserted = np.sum(df_needle_alignment.ix[df_needle_alignment.NHEJ,'n_inserted']>0)
+             nhej_inserted = quantification.counters['nhej_inserted']
 	     if np.isnan(nhej_inserted): nhej_inserted = 0
-             nhej_deleted = np.sum(df_needle_alignment.ix[df_needle_alignment.NHEJ,'n_deleted']>0)
+             nhej_deleted = quantification.counters['nhej_deleted']
 	     if np.isnan(nhej_deleted): nhej_deleted = 0
-             nhej_mutated = np.sum(df_needle_alignment.ix[df_needle_alignment.NHEJ,'n_mutated']>0)
+             nhej_mutated = quantification.counters['nhej_mutated']
 	     if np.isnan(nhej_mutated): nhej_mutated = 0
 
-             hdr_inserted = np.sum(df_needle_alignment.ix[df_needle_alignment.HDR,'n_inserted']>0)
+             hdr_inserted = quantification.counters['hdr_inserted']
 	     if np.isnan(hdr_inserted): hdr_inserted = 0
-             hdr_deleted = np.sum(df_needle_alignment.ix[df_needle_alignment.HDR,'n_deleted']>0)
+             hdr_deleted = quantification.counters['hdr_deleted']
 	     if np.isnan(hdr_deleted): hdr_deleted = 0
-             hdr_mutated = np.sum(df_needle_alignment.ix[df_needle_alignment.HDR,'n_mutated']>0)
+             hdr_mutated = quantification.counters['hdr_mutated']
 	     if np.isnan(hdr_mutated): hdr_mutated = 0
 
-             mixed_inserted = np.sum(df_needle_alignment.ix[df_needle_alignment.MIXED,'n_inserted']>0)
+             mixed_inserted = quantification.counters['mixed_inserted']
 	     if np.isnan(mixed_inserted): mixed_inserted = 0
-             mixed_deleted = np.sum(df_needle_alignment.ix[df_needle_alignment.MIXED,'n_deleted']>0)
+             mixed_deleted = quantification.counters['mixed_deleted']
 	     if np.isnan(mixed_deleted): mixed_deleted = 0
-             mixed_mutated = np.sum(df_needle_alignment.ix[df_needle_alignment.MIXED,'n_mutated']>0)
+             mixed_mutated = quantification.counters['mixed_mutated']
 	     if np.isnan(mixed_mutated): mixed_mutated = 0
 
              with open(_jp('Quantification_of_editing_frequency.txt'),'w+') as outfile:
@@ -2330,7 +2889,7 @@ def main():
                          outfile.write('Frameshift analysis:\n\tNoncoding mutation:%d reads\n\tIn-frame mutation:%d reads\n\tFrameshift mutation:%d reads\n' %(NON_MODIFIED_NON_FRAMESHIFT, MODIFIED_NON_FRAMESHIFT ,MODIFIED_FRAMESHIFT))
 
                  with open(_jp('Splice_sites_analysis.txt'),'w+') as outfile:
-                         outfile.write('Splice sites analysis:\n\tUnmodified:%d reads\n\tPotential splice sites modified:%d reads\n' %(df_needle_alignment.shape[0]- SPLICING_SITES_MODIFIED, SPLICING_SITES_MODIFIED))
+                         outfile.write('Splice sites analysis:\n\tUnmodified:%d reads\n\tPotential splice sites modified:%d reads\n' %(N_TOTAL- SPLICING_SITES_MODIFIED, SPLICING_SITES_MODIFIED))
 
 
                  save_vector_to_file(effect_vector_insertion_noncoding,'effect_vector_insertion_noncoding')
@@ -2381,8 +2940,6 @@ def main():
                  np.savez(_jp('position_dependent_vector_avg_insertion_size'),avg_vector_ins_all)
                  np.savez(_jp('position_dependent_vector_avg_deletion_size'),avg_vector_del_all)
 
-                 df_needle_alignment.to_pickle(_jp('processed_reads_dataframe.pickle'))
-
 
 
 
@@ -2396,6 +2953,15 @@ def main():
                      np.savez(_jp('effect_vector_deletion_HDR'),effect_vector_deletion_hdr)
                      np.savez(_jp('effect_vector_substitution_HDR'),effect_vector_mutation_hdr)
 
+             if not args.no_plots and args.n_processes>1:
+                 info('Waiting for the plots...')
+                 wait_plots()
+                 info('Done!')
+
+             if pool is not None:
+                 pool.close()
+                 pool.join()
+
              info('All Done!')
              print'''
                   )
@@ -9,8 +9,6 @@ import os
 import gzip
 import argparse
 import sys
-import gzip
-import subprocess as sb
 from collections import defaultdict
 import unicodedata
 import re
@@ -56,42 +54,15 @@ def slugify(value): #adapted from the Django project
     
     return str(value)
 
-def filter_se_fastq_by_qual(fastq_filename,output_filename=None,min_bp_quality=20,min_single_bp_quality=0):
-
-        if fastq_filename.endswith('.gz'):
-                fastq_handle=gzip.open(fastq_filename)
-        else:
-                fastq_handle=open(fastq_filename)
-
-        if not output_filename:
-                output_filename=fastq_filename.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
-
-        try: 
-            fastq_filtered_outfile=gzip.open(output_filename,'w+')
-
-            for record in SeqIO.parse(fastq_handle, "fastq"):
-                if np.array(record.letter_annotations["phred_quality"]).mean()>=min_bp_quality \
-                and np.array(record.letter_annotations["phred_quality"]).min()>=min_single_bp_quality:
-                    fastq_filtered_outfile.write(record.format('fastq'))
-        except:
-                raise Exception('Error handling the fastq_filtered_outfile')
-
- 
-        return output_filename
-
 def find_wrong_nt(sequence):
     return list(set(sequence.upper()).difference(set(['A','T','C','G','N'])))
 
 
-def get_n_reads_fastq(fastq_filename):
-     p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
-     return int(float(p.communicate()[0])/4.0)
-
-
 pd=check_library('pandas')
 np=check_library('numpy')
 Bio=check_library('Bio')
-from Bio import SeqIO
+
+from CRISPResso.CRISPRessoFastq import filter_se_fastq_by_qual,RunFastqStats
 
 
 ###EXCEPTIONS############################
@@ -131,6 +102,7 @@ def main():
         parser.add_argument('-o','--output_folder',  help='', default='')
         parser.add_argument('-l','--guide_length',  type=int,help='Lenght in bp to extract the sgRNA upstream of the tracrRNA sequence', default=20)
         parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
+        parser.add_argument('--fastq_stats_cache_dir',type=str,help='Directory where to save the statistics (number of reads, read lengths, quality) of the input fastq files, reused by the next runs on the same files. By default the statistics are not saved',default=None)
         
         args = parser.parse_args()
         
@@ -195,15 +167,18 @@ def main():
         #filter reads by quality
         if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
             info('Filtering reads with average bp quality < %d and single bp quality < %d ...' % (args.min_average_read_quality,args.min_single_bp_quality))
+            fastq_stats=RunFastqStats(args.fastq_stats_cache_dir)
+            fastq_stats.use_cache(args.fastq)
             processed_output_filename=filter_se_fastq_by_qual(args.fastq,
                         output_filename=_jp(os.path.basename(args.fastq).replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'),
                         min_bp_quality=args.min_average_read_quality,
-                        min_single_bp_quality=args.min_single_bp_quality)
+                        min_single_bp_quality=args.min_single_bp_quality,
+                        fastq_stats=fastq_stats)
             info('Done!')
             
             #count reads 
-            N_READS_INPUT=get_n_reads_fastq(args.fastq)
-            N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
+            N_READS_INPUT=fastq_stats.get_n_reads(args.fastq)
+            N_READS_AFTER_PREPROCESSING=fastq_stats.get_n_reads(processed_output_filename)
             if N_READS_AFTER_PREPROCESSING == 0:             
                 raise NoReadsAfterQualityFiltering('No reads in input or no reads survived the average or single bp quality filtering.')
             else:
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+'''
+CRISPResso - Luca Pinello 2015
+Reading, quality filtering and statistics of fastq files, shared by CRISPResso,
+CRISPRessoPooled and CRISPRessoCount.
+https://github.com/lucapinello/CRISPResso
+'''
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import subprocess as sb
+from itertools import izip,izip_longest
+
+import numpy as np
+
+info = logging.info
+
+
+#number of fastq records read at once
+FASTQ_RECORDS_BATCH_SIZE=10000
+
+def get_fastq_records_batches(fastq_handle,batch_size=FASTQ_RECORDS_BATCH_SIZE):
+    '''
+    Read a fastq file as batches of raw records (tuples with the 4 lines of each read)
+    '''
+    batch=[]
+    for record in izip(fastq_handle,fastq_handle,fastq_handle,fastq_handle):
+        batch.append(record)
+        if len(batch)==batch_size:
+            yield batch
+            batch=[]
+    if batch:
+        yield batch
+
+def get_records_passing_quality_filter(records,min_bp_quality=20,min_single_bp_quality=0):
+    '''
+    Boolean mask of the records with average and minimum quality (phred33) above the thresholds
+    '''
+    qualities=[record[3].rstrip('\r\n') for record in records]
+    lengths=np.array([len(quality) for quality in qualities],dtype=int)
+    scores=np.fromstring(''.join(qualities),dtype=np.uint8).astype(int)-33
+
+    #reads without bases are always removed
+    passing=np.zeros(len(records),dtype=bool)
+    not_empty=lengths>0
+    if not_empty.any():
+        starts=(np.cumsum(lengths)-lengths)[not_empty]
+        avg_quality=np.add.reduceat(scores,starts)/lengths[not_empty].astype(float)
+        min_quality=np.minimum.reduceat(scores,starts)
+        passing[not_empty]=(avg_quality>=min_bp_quality) & (min_quality>=min_single_bp_quality)
+
+    return passing
+
+def filter_pe_fastq_by_qual(fastq_r1,fastq_r2,output_filename_r1=None,output_filename_r2=None,min_bp_quality=20,min_single_bp_quality=0,fastq_stats=None):
+
+    if fastq_r1.endswith('.gz'):
+        fastq_handle_r1=gzip.open(fastq_r1)
+    else:
+        fastq_handle_r1=open(fastq_r1)
+
+    if fastq_r2.endswith('.gz'):
+        fastq_handle_r2=gzip.open(fastq_r2)
+    else:
+        fastq_handle_r2=open(fastq_r2)
+
+    if not output_filename_r1:
+        output_filename_r1=fastq_r1.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
+
+    if not output_filename_r2:
+        output_filename_r2=fastq_r2.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
+
+    stats_r1,stats_r2,stats_filtered_r1,stats_filtered_r2=FastqStats(),FastqStats(),FastqStats(),FastqStats()
+
+    #the two files are read in lockstep, a pair is removed if one of the two reads doesn't pass the filter
+    try:
+        fastq_filtered_outfile_r1=gzip.open(output_filename_r1,'w+')
+        fastq_filtered_outfile_r2=gzip.open(output_filename_r2,'w+')
+
+        for batch_r1,batch_r2 in izip_longest(get_fastq_records_batches(fastq_handle_r1),get_fastq_records_batches(fastq_handle_r2)):
+            if batch_r1 is None or batch_r2 is None or len(batch_r1)!=len(batch_r2):
+                raise Exception('The files %s and %s contain a different number of reads' % (fastq_r1,fastq_r2))
+
+            passing=get_records_passing_quality_filter(batch_r1,min_bp_quality,min_single_bp_quality) \
+                    & get_records_passing_quality_filter(batch_r2,min_bp_quality,min_single_bp_quality)
+
+            filtered_r1=[record for record,keep in izip(batch_r1,passing) if keep]
+            filtered_r2=[record for record,keep in izip(batch_r2,passing) if keep]
+            fastq_filtered_outfile_r1.write(''.join([''.join(record) for record in filtered_r1]))
+            fastq_filtered_outfile_r2.write(''.join([''.join(record) for record in filtered_r2]))
+
+            stats_r1.add_records(batch_r1)
+            stats_r2.add_records(batch_r2)
+            stats_filtered_r1.add_records(filtered_r1)
+            stats_filtered_r2.add_records(filtered_r2)
+
+        fastq_filtered_outfile_r1.close()
+        fastq_filtered_outfile_r2.close()
+    except (IOError,OSError) as e:
+        raise Exception('Error handling the fastq_filtered_outfile_r1 and fastq_filtered_outfile_r2: %s' % e)
+
+    if fastq_stats is not None:
+        fastq_stats.set(fastq_r1,stats_r1)
+        fastq_stats.set(fastq_r2,stats_r2)
+        fastq_stats.set(output_filename_r1,stats_filtered_r1)
+        fastq_stats.set(output_filename_r2,stats_filtered_r2)
+
+    return output_filename_r1,output_filename_r2
+
+
+def filter_se_fastq_by_qual(fastq_filename,output_filename=None,min_bp_quality=20,min_single_bp_quality=0,fastq_stats=None):
+
+    if fastq_filename.endswith('.gz'):
+        fastq_handle=gzip.open(fastq_filename)
+    else:
+        fastq_handle=open(fastq_filename)
+
+    if not output_filename:
+        output_filename=fastq_filename.replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'
+
+    stats_input,stats_filtered=FastqStats(),FastqStats()
+
+    try:
+        fastq_filtered_outfile=gzip.open(output_filename,'w+')
+
+        for batch in get_fastq_records_batches(fastq_handle):
+            passing=get_records_passing_quality_filter(batch,min_bp_quality,min_single_bp_quality)
+            filtered=[record for record,keep in izip(batch,passing) if keep]
+            fastq_filtered_outfile.write(''.join([''.join(record) for record in filtered]))
+
+            stats_input.add_records(batch)
+            stats_filtered.add_records(filtered)
+
+        fastq_filtered_outfile.close()
+    except (IOError,OSError) as e:
+        raise Exception('Error handling the fastq_filtered_outfile: %s' % e)
+
+    if fastq_stats is not None:
+        fastq_stats.set(fastq_filename,stats_input)
+        fastq_stats.set(output_filename,stats_filtered)
+
+    return output_filename
+
+class FastqStats(object):
+    '''
+    Number of reads, read length distribution and quality of a fastq file,
+    n_bp is None if only the number of reads is known
+    '''
+    def __init__(self,n_reads=0,n_bp=0,length_counts=None,sum_quality=0):
+        self.n_reads=n_reads
+        self.n_bp=n_bp
+        self.length_counts=length_counts if length_counts is not None else dict()
+        self.sum_quality=sum_quality
+
+    def add_records(self,records):
+        lengths=np.array([len(record[1].rstrip('\r\n')) for record in records],dtype=int)
+        self.n_reads+=len(records)
+        self.n_bp+=int(lengths.sum())
+
+        for length,count in enumerate(np.bincount(lengths)):
+            if count:
+                self.length_counts[length]=self.length_counts.get(length,0)+int(count)
+
+        qualities=''.join([record[3].rstrip('\r\n') for record in records])
+        self.sum_quality+=int(np.fromstring(qualities,dtype=np.uint8).sum(dtype=np.int64))-33*len(qualities)
+
+    def has_lengths(self):
+        return self.n_bp is not None
+
+    def avg_read_length(self):
+        return self.n_bp/self.n_reads if self.n_reads else 0
+
+    def avg_quality(self):
+        return self.sum_quality/float(self.n_bp) if self.n_bp else 0.0
+
+    def to_dict(self):
+        if not self.has_lengths():
+            return {'n_reads':self.n_reads,'n_bp':None}
+
+        return {'n_reads':self.n_reads,'n_bp':self.n_bp,'sum_quality':self.sum_quality,
+                'length_counts':dict([(str(length),count) for length,count in self.length_counts.items()])}
+
+    @classmethod
+    def from_dict(cls,stats_dict):
+        if stats_dict['n_bp'] is None:
+            return cls(stats_dict['n_reads'],None)
+
+        return cls(stats_dict['n_reads'],stats_dict['n_bp'],
+                   dict([(int(length),count) for length,count in stats_dict['length_counts'].items()]),
+                   stats_dict['sum_quality'])
+
+#suffix of the persistent stats files of the input fastq files
+FASTQ_STATS_CACHE_SUFFIX='.crispresso_stats.json'
+
+def get_fastq_stats_cache_filename(fastq_filename,cache_dir):
+    '''
+    The stats are saved in cache_dir, named after the hash of the full path of the fastq file
+    '''
+    fastq_filename=os.path.realpath(fastq_filename)
+    return os.path.join(cache_dir,hashlib.md5(fastq_filename).hexdigest()+FASTQ_STATS_CACHE_SUFFIX)
+
+def get_fastq_file_identity(fastq_filename):
+    fastq_filename=os.path.realpath(fastq_filename)
+    file_stat=os.stat(fastq_filename)
+    return {'path':fastq_filename,'size':file_stat.st_size,'mtime':file_stat.st_mtime}
+
+def load_fastq_stats_cache(fastq_filename,cache_dir):
+    '''
+    Stats saved by a previous run, None if missing or if the file has changed since then
+    '''
+    try:
+        with open(get_fastq_stats_cache_filename(fastq_filename,cache_dir)) as infile:
+            cached=json.load(infile)
+        if cached['file']==get_fastq_file_identity(fastq_filename):
+            return FastqStats.from_dict(cached['stats'])
+    except (IOError,OSError,ValueError,KeyError,TypeError,AttributeError):
+        pass
+    return None
+
+def save_fastq_stats_cache(fastq_filename,fastq_stats,cache_dir):
+    cache_filename=get_fastq_stats_cache_filename(fastq_filename,cache_dir)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        #write to a temp file first, concurrent runs on the same input may read the cache
+        tmp_filename='%s.%d.tmp' % (cache_filename,os.getpid())
+        with open(tmp_filename,'w+') as outfile:
+            json.dump({'file':get_fastq_file_identity(fastq_filename),'stats':fastq_stats.to_dict()},outfile)
+        os.rename(tmp_filename,cache_filename)
+    except (IOError,OSError):
+        info('Cannot save the statistics of %s in %s' % (fastq_filename,cache_filename))
+
+class RunFastqStats(object):
+    '''
+    Statistics of the fastq files used in a run, recorded by the steps that stream the files
+    (e.g. splitting, filtering, collapsing, demultiplexing) so the files don't need to be read again just to count the reads.
+    If cache_dir is specified, the stats of the input files are also kept in a persistent cache and reused by the next runs.
+    '''
+    def __init__(self,cache_dir=None):
+        self.stats=dict()
+        self.cache_dir=cache_dir
+        self.cached_filenames=set()
+
+    def use_cache(self,fastq_filename):
+        if not self.cache_dir:
+            return
+
+        self.cached_filenames.add(os.path.realpath(fastq_filename))
+        if os.path.realpath(fastq_filename) not in self.stats:
+            cached_stats=load_fastq_stats_cache(fastq_filename,self.cache_dir)
+            if cached_stats is not None:
+                self.stats[os.path.realpath(fastq_filename)]=cached_stats
+
+    def set(self,fastq_filename,fastq_stats):
+        self.stats[os.path.realpath(fastq_filename)]=fastq_stats
+        if os.path.realpath(fastq_filename) in self.cached_filenames:
+            save_fastq_stats_cache(fastq_filename,fastq_stats,self.cache_dir)
+
+    def get_n_reads(self,fastq_filename):
+        #files not streamed by the run are counted with zcat | wc -l, the read lengths are not needed
+        if os.path.realpath(fastq_filename) not in self.stats:
+            self.set(fastq_filename,FastqStats(get_n_reads_fastq(fastq_filename),None))
+        return self.stats[os.path.realpath(fastq_filename)].n_reads
+
+    def get_avg_read_length(self,fastq_filename):
+        if os.path.realpath(fastq_filename) in self.stats and self.stats[os.path.realpath(fastq_filename)].has_lengths():
+            return self.stats[os.path.realpath(fastq_filename)].avg_read_length()
+        return get_avg_read_length_fastq(fastq_filename)
+
+    def load(self,stats_filename):
+        #tab separated file with filename, number of reads and number of bp
+        with open(stats_filename) as infile:
+            for line in infile:
+                fastq_filename,n_reads,n_bp=line.rstrip('\n').split('\t')
+                self.set(fastq_filename,FastqStats(int(n_reads),int(n_bp)))
+
+def get_n_reads_fastq(fastq_filename):
+    p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
+    return int(float(p.communicate()[0])/4.0)
+
+def get_avg_read_length_fastq(fastq_filename):
+    cmd=('z' if fastq_filename.endswith('.gz') else '' ) +('cat < %s' % fastq_filename)+\
+        r''' | awk 'BN {n=0;s=0;} NR%4 == 2 {s+=length($0);n++;} END { printf("%d\n",s/n)}' '''
+    p = sb.Popen(cmd, shell=True,stdout=sb.PIPE)
+    return int(p.communicate()[0].strip())
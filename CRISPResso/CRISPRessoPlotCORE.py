@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import argparse
+
+
+import logging
+logging.basicConfig(level=logging.INFO,
+                     format='%(levelname)-5s @ %(asctime)s:\n\t %(message)s \n',
+                     datefmt='%a, %d %b %Y %H:%M:%S',
+                     stream=sys.stderr,
+                     filemode="w"
+                     )
+error   = logging.critical
+warn    = logging.warning
+debug   = logging.debug
+info    = logging.info
+
+
+from CRISPResso.CRISPRessoCORE import __version__,PLOT_DATA_FILENAME,load_plot_data,render_plots
+
+
+def find_plot_data_folders(folder):
+    '''
+    A CRISPResso output folder with the data of the plots or a folder with many of them, as the output of CRISPRessoPooled and CRISPRessoWGS
+    '''
+    if os.path.exists(os.path.join(folder,PLOT_DATA_FILENAME)):
+        return [folder]
+    return sorted([os.path.join(folder,name) for name in os.listdir(folder) if os.path.exists(os.path.join(folder,name,PLOT_DATA_FILENAME))])
+
+get_name_from_folder=lambda x: os.path.basename(os.path.abspath(x)).replace('CRISPResso_on_','')
+
+###EXCEPTIONS############################
+class NoPlotDataException(Exception):
+    pass
+############################
+
+
+def main():
+
+    try:
+        print '  \n~~~CRISPRessoPlot~~~'
+        print '-Plots of CRISPResso analyses from the saved plot data-'
+
+        print'\n[Luca Pinello 2015, send bugs, suggestions or *green coffee* to lucapinello AT gmail DOT com]\n\n',
+
+        print 'Version %s\n' % __version__
+
+        parser = argparse.ArgumentParser(description='CRISPRessoPlot Parameters',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument('crispresso_output_folders', type=str, nargs='+', help='CRISPResso output folders (for example run with --no_plots) or folders containing them, as the output folders of CRISPRessoPooled and CRISPRessoWGS')
+
+        #OPTIONALS
+        parser.add_argument('-s','--samples', type=str, help='Comma separated names of the samples to plot (the name of their CRISPResso output folder without CRISPResso_on_), by default all the samples are plotted', default='')
+        parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+        parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the plots', default=1)
+
+        args = parser.parse_args()
+
+        plot_data_folders=[]
+        for folder in args.crispresso_output_folders:
+            plot_data_folders+=find_plot_data_folders(folder)
+
+        if args.samples:
+            samples=set(args.samples.split(','))
+            plot_data_folders=[folder for folder in plot_data_folders if get_name_from_folder(folder) in samples]
+
+        if not plot_data_folders:
+            raise NoPlotDataException('No CRISPResso output folder with the data of the plots (%s) was found.' % PLOT_DATA_FILENAME)
+
+        for folder in plot_data_folders:
+            info('Making the plots of %s...' % get_name_from_folder(folder))
+            wait_plots=render_plots(load_plot_data(folder),folder,args.save_also_png,args.n_processes)
+            wait_plots()
+            info('Done!')
+
+        info('All Done!')
+        print '''
+                      )
+                     (
+                    __)__
+                 C\|     \\
+                   \     /
+                    \___/
+             '''
+        sys.exit(0)
+
+    except Exception as e:
+        error('\n\nERROR: %s' % e)
+        sys.exit(-1)
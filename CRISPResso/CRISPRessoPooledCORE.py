@@ -143,10 +143,6 @@ def get_region_from_fa(chr_id,bpstart,bpend,uncompressed_reference):
     p = sb.Popen("samtools faidx %s %s |   grep -v ^\> | tr -d '\n'" %(uncompressed_reference,region), shell=True,stdout=sb.PIPE)
     return p.communicate()[0]
 
-def get_n_reads_fastq(fastq_filename):
-     p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
-     return int(float(p.communicate()[0])/4.0)
-
 def get_n_aligned_bam(bam_filename):
      p = sb.Popen("samtools view -F 0x904 -c %s" % bam_filename , shell=True,stdout=sb.PIPE)
      return int(p.communicate()[0])
@@ -158,11 +154,6 @@ def clean_filename(filename):
     cleanedFilename = unicodedata.normalize('NFKD', unicode(filename)).encode('ASCII', 'ignore')
     return ''.join(c for c in cleanedFilename if c in validFilenameChars)
 
-def get_avg_read_lenght_fastq(fastq_filename):
-     cmd=('z' if fastq_filename.endswith('.gz') else '' ) +('cat < %s' % fastq_filename)+\
-                  r''' | awk 'BN {n=0;s=0;} NR%4 == 2 {s+=length($0);n++;} END { printf("%d\n",s/n)}' '''
-     p = sb.Popen(cmd, shell=True,stdout=sb.PIPE)
-     return int(p.communicate()[0].strip())
     
     
 def find_overlapping_genes(row,df_genes):
@@ -182,6 +173,8 @@ def find_overlapping_genes(row,df_genes):
 pd=check_library('pandas')
 np=check_library('numpy')
 
+from CRISPResso.CRISPRessoFastq import FastqStats,RunFastqStats
+
 ###EXCEPTIONS############################
 class FlashException(Exception):
     pass
@@ -262,6 +255,8 @@ def main():
         parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
         parser.add_argument('-s','--min_single_bp_quality', type=int, help='Minimum single bp score (phred33) to keep a read', default=0)
         parser.add_argument('--min_identity_score', type=float, help='Min identity score for the alignment', default=60.0)
+        parser.add_argument('--kmer_size', type=int, help='Size of the k-mers used to find the orientation of the reads and to discard the reads unrelated to the amplicon before the alignment (4-13)', default=10)
+        parser.add_argument('--no_kmer_prefilter',help='Align also the reads sharing too few k-mers with the amplicon to pass the --min_identity_score threshold. The minimum fraction of shared k-mers, (min_identity_score/100)^kmer_size, is about 0.6%% with the default values, so only the reads almost unrelated to the amplicon are discarded',action='store_true')
         parser.add_argument('-n','--name',  help='Output name', default='')
         parser.add_argument('-o','--output_folder',  help='', default='')
         parser.add_argument('--trim_sequences',help='Enable the trimming of Illumina adapters with Trimmomatic',action='store_true')
@@ -278,9 +273,16 @@ def main():
         parser.add_argument('--ignore_insertions',help='Ignore insertions events for the quantification and visualization',action='store_true')  
         parser.add_argument('--ignore_deletions',help='Ignore deletions events for the quantification and visualization',action='store_true')  
         parser.add_argument('--needle_options_string',type=str,help='Override options for the Needle aligner',default=' -gapopen=10 -gapextend=0.5  -awidth3=5000')
+        parser.add_argument('--aligner',type=str,choices=['needle','native'],help='Aligner to use: needle from the EMBOSS suite or the native in-process aligner (same gap open and gap extend penalties of --needle_options_string)',default='needle')
+        parser.add_argument('--banded_alignment',help='Compute only a band of the alignment matrix with the native aligner, reads that could have a better alignment outside the band are aligned again without the band',action='store_true')
+        parser.add_argument('--band_width', type=int, help='Number of bp added on each side of the band of the banded alignment, that covers the length differences between the reads and the amplicon', default=25)
+        parser.add_argument('--batch_size', type=int, help='Number of unique sequences aligned and quantified at once, the memory used for the alignments is proportional to it', default=100000)
+        parser.add_argument('--max_alleles_in_memory', type=int, help='Maximum number of distinct alleles kept in memory, only the most frequent alleles are reported with exact counts and the exact counts of all the alleles of each batch are saved to file. With 0 all the alleles are kept in memory', default=0)
         parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
         parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
+        parser.add_argument('--fastq_stats_cache_dir',type=str,help='Directory where to save the statistics (number of reads, read lengths, quality) of the input fastq files, reused by the next runs on the same files. By default the statistics are not saved',default=None)
         parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+        parser.add_argument('--no_plots',help='Do not make the plots of each region, the data to make them later with CRISPRessoPlot are saved in the CRISPResso output folders',action='store_true')
         
          
     
@@ -289,13 +291,15 @@ def main():
      
     
         crispresso_options=['window_around_sgrna','cleavage_offset','min_average_read_quality','min_single_bp_quality','min_identity_score',
+                                   'kmer_size','no_kmer_prefilter',
                                    'min_single_bp_quality','exclude_bp_from_left',
                                    'exclude_bp_from_right',
                                    'hdr_perfect_alignment_threshold','ignore_substitutions','ignore_insertions','ignore_deletions',
                                   'needle_options_string',
+                                  'aligner','banded_alignment','band_width','batch_size','max_alleles_in_memory',
                                   'keep_intermediate',
                                   'dump',
-                                  'save_also_png','hide_mutations_outside_window_NHEJ','n_processes',]
+                                  'save_also_png','no_plots','hide_mutations_outside_window_NHEJ','n_processes',]
     
         
         def propagate_options(cmd,options,args):
@@ -459,9 +463,11 @@ def main():
              processed_output_filename=_jp('out.extendedFrags.fastq.gz')
     
     
-        #count reads 
-        N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
-        N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
+        #count reads, the demultiplexing steps record the number of reads of each file they create
+        fastq_stats=RunFastqStats(args.fastq_stats_cache_dir)
+        fastq_stats.use_cache(args.fastq_r1)
+        N_READS_INPUT=fastq_stats.get_n_reads(args.fastq_r1)
+        N_READS_AFTER_PREPROCESSING=fastq_stats.get_n_reads(processed_output_filename)
     
             
         #load gene annotation
@@ -541,6 +547,7 @@ def main():
                         #create place-holder fastq files
                         fastq_gz_amplicon_filenames.append(_jp('%s.fastq.gz' % clean_filename('AMPL_'+idx)))
                         open(fastq_gz_amplicon_filenames[-1], 'w+').close()
+                        fastq_stats.set(fastq_gz_amplicon_filenames[-1],FastqStats())
     
             df_template['Demultiplexed_fastq.gz_filename']=fastq_gz_amplicon_filenames
             info('Creating a custom index file with all the amplicons...')
@@ -557,18 +564,22 @@ def main():
     
             N_READS_ALIGNED=get_n_aligned_bam(bam_filename_amplicons)
             
+            demultiplexing_stats_filename=_jp('DEMULTIPLEXING_STATS.txt')
             s1=r"samtools view -F 4 %s 2>>%s | grep -v ^'@'" % (bam_filename_amplicons,log_filename)
             s2=r'''|awk '{ gzip_filename=sprintf("gzip >> OUTPUTPATH%s.fastq.gz",$3);\
-            print "@"$1"\n"$10"\n+\n"$11  | gzip_filename;}' '''
+            print "@"$1"\n"$10"\n+\n"$11  | gzip_filename; n_reads[$3]++; n_bp[$3]+=length($10);}\
+            END { for (ampl in n_reads) print "OUTPUTPATH"ampl".fastq.gz\t"n_reads[ampl]"\t"n_bp[ampl] > "STATSFILE";}' '''
     
-            cmd=s1+s2.replace('OUTPUTPATH',_jp(''))
+            cmd=s1+s2.replace('OUTPUTPATH',_jp('')).replace('STATSFILE',demultiplexing_stats_filename)
             sb.call(cmd,shell=True)
+            if os.path.exists(demultiplexing_stats_filename):
+                fastq_stats.load(demultiplexing_stats_filename)
             
             info('Demultiplex reads and run CRISPResso on each amplicon...')
             n_reads_aligned_amplicons=[]
             for idx,row in df_template.iterrows():
                 info('\n Processing:%s' %idx)
-                n_reads_aligned_amplicons.append(get_n_reads_fastq(row['Demultiplexed_fastq.gz_filename']))
+                n_reads_aligned_amplicons.append(fastq_stats.get_n_reads(row['Demultiplexed_fastq.gz_filename']))
                 crispresso_cmd='CRISPResso -r1 %s -a %s -o %s --name %s' % (row['Demultiplexed_fastq.gz_filename'],row['Amplicon_Sequence'],OUTPUT_DIRECTORY,idx)
     
                 if n_reads_aligned_amplicons[-1]>args.min_reads_to_use_region:
@@ -676,6 +687,7 @@ def main():
                 else\
                     print $3,bpstart,bpend,"+",$1,$10,$11;}' | ''' 
         
+            demultiplexing_stats_filename=_jp('DEMULTIPLEXING_STATS.txt')
             s2=r'''  sort -k1,1 -k2,2n  | awk \
             'BEGIN{chr_id="NA";bpstart=-1;bpend=-1; fastq_filename="NA"}\
             { if ( (chr_id!=$1) || (bpstart!=$2) || (bpend!=$3) )\
@@ -685,14 +697,18 @@ def main():
                 fastq_filename=sprintf("__OUTPUTPATH__REGION_%s_%s_%s.fastq",$1,$2,$3);\
                 }\
             print "@"$5"\n"$6"\n+\n"$7 >> fastq_filename;\
-            }' '''
-            cmd=s1+s2.replace('__OUTPUTPATH__',MAPPED_REGIONS)
+            n_reads[fastq_filename]++; n_bp[fastq_filename]+=length($6);\
+            }\
+            END { for (region in n_reads) print region".gz\t"n_reads[region]"\t"n_bp[region] > "__STATSFILE__";}' '''
+            cmd=s1+s2.replace('__OUTPUTPATH__',MAPPED_REGIONS).replace('__STATSFILE__',demultiplexing_stats_filename)
             
             info('Demultiplexing reads by location...')
             sb.call(cmd,shell=True)
             
             #gzip the missing ones 
             sb.call('gzip %s/*.fastq' % MAPPED_REGIONS,shell=True)
+            if os.path.exists(demultiplexing_stats_filename):
+                fastq_stats.load(demultiplexing_stats_filename)
     
         '''
         The most common use case, where many different target sites are pooled into a single 
@@ -721,7 +737,7 @@ def main():
         
                 if os.path.exists(fastq_filename_region):
                     
-                    N_READS=get_n_reads_fastq(fastq_filename_region)
+                    N_READS=fastq_stats.get_n_reads(fastq_filename_region)
                     n_reads_aligned_genome.append(N_READS)
                     fastq_region_filenames.append(fastq_filename_region)
                     files_to_match.remove(fastq_filename_region)
@@ -764,7 +780,7 @@ def main():
             info('Reporting problematic regions...')  
             coordinates=[]
             for region in files_to_match:
-                coordinates.append(os.path.basename(region).replace('.fastq.gz','').replace('.fastq','').split('_')[1:4]+[region,get_n_reads_fastq(region)])
+                coordinates.append(os.path.basename(region).replace('.fastq.gz','').replace('.fastq','').split('_')[1:4]+[region,fastq_stats.get_n_reads(region)])
         
             df_regions=pd.DataFrame(coordinates,columns=['chr_id','bpstart','bpend','fastq_file','n_reads'])
     
@@ -796,7 +812,7 @@ def main():
             info('Parsing the demultiplexed files and extracting locations and reference sequences...')
             coordinates=[]
             for region in glob.glob(os.path.join(MAPPED_REGIONS,'REGION*.fastq.gz')):
-                coordinates.append(os.path.basename(region).replace('.fastq.gz','').split('_')[1:4]+[region,get_n_reads_fastq(region)])
+                coordinates.append(os.path.basename(region).replace('.fastq.gz','').split('_')[1:4]+[region,fastq_stats.get_n_reads(region)])
             
             print 'C:',coordinates
             df_regions=pd.DataFrame(coordinates,columns=['chr_id','bpstart','bpend','fastq_file','n_reads'])
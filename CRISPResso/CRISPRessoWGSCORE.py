@@ -247,6 +247,8 @@ def main():
         parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
         parser.add_argument('-s','--min_single_bp_quality', type=int, help='Minimum single bp score (phred33) to keep a read', default=0)
         parser.add_argument('--min_identity_score', type=float, help='Min identity score for the alignment', default=60.0)
+        parser.add_argument('--kmer_size', type=int, help='Size of the k-mers used to find the orientation of the reads and to discard the reads unrelated to the amplicon before the alignment (4-13)', default=10)
+        parser.add_argument('--no_kmer_prefilter',help='Align also the reads sharing too few k-mers with the amplicon to pass the --min_identity_score threshold. The minimum fraction of shared k-mers, (min_identity_score/100)^kmer_size, is about 0.6%% with the default values, so only the reads almost unrelated to the amplicon are discarded',action='store_true')
         parser.add_argument('-n','--name',  help='Output name', default='')
         parser.add_argument('-o','--output_folder',  help='', default='')
         parser.add_argument('--trim_sequences',help='Enable the trimming of Illumina adapters with Trimmomatic',action='store_true')
@@ -262,9 +264,15 @@ def main():
         parser.add_argument('--ignore_insertions',help='Ignore insertions events for the quantification and visualization',action='store_true')  
         parser.add_argument('--ignore_deletions',help='Ignore deletions events for the quantification and visualization',action='store_true')  
         parser.add_argument('--needle_options_string',type=str,help='Override options for the Needle aligner',default=' -gapopen=10 -gapextend=0.5  -awidth3=5000')
+        parser.add_argument('--aligner',type=str,choices=['needle','native'],help='Aligner to use: needle from the EMBOSS suite or the native in-process aligner (same gap open and gap extend penalties of --needle_options_string)',default='needle')
+        parser.add_argument('--banded_alignment',help='Compute only a band of the alignment matrix with the native aligner, reads that could have a better alignment outside the band are aligned again without the band',action='store_true')
+        parser.add_argument('--band_width', type=int, help='Number of bp added on each side of the band of the banded alignment, that covers the length differences between the reads and the amplicon', default=25)
+        parser.add_argument('--batch_size', type=int, help='Number of unique sequences aligned and quantified at once, the memory used for the alignments is proportional to it', default=100000)
+        parser.add_argument('--max_alleles_in_memory', type=int, help='Maximum number of distinct alleles kept in memory, only the most frequent alleles are reported with exact counts and the exact counts of all the alleles of each batch are saved to file. With 0 all the alleles are kept in memory', default=0)
         parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
         parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
         parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+        parser.add_argument('--no_plots',help='Do not make the plots of each region, the data to make them later with CRISPRessoPlot are saved in the CRISPResso output folders',action='store_true')
         parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
         Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)
     
@@ -273,13 +281,15 @@ def main():
         args = parser.parse_args()
     
         crispresso_options=['window_around_sgrna','cleavage_offset','min_average_read_quality','min_single_bp_quality','min_identity_score',
+                                   'kmer_size','no_kmer_prefilter',
                                    'min_single_bp_quality','exclude_bp_from_left',
                                    'exclude_bp_from_right',
                                    'hdr_perfect_alignment_threshold','ignore_substitutions','ignore_insertions','ignore_deletions',
                                   'needle_options_string',
+                                  'aligner','banded_alignment','band_width','batch_size','max_alleles_in_memory',
                                   'keep_intermediate',
                                   'dump',
-                                  'save_also_png','hide_mutations_outside_window_NHEJ','n_processes',]
+                                  'save_also_png','no_plots','hide_mutations_outside_window_NHEJ','n_processes',]
         
            
         
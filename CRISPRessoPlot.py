@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from CRISPResso.CRISPRessoPlotCORE import main
+
+
+if __name__ == '__main__':
+    main()
@@ -59,7 +59,8 @@ def main():
           'CRISPRessoWGS = CRISPResso.CRISPRessoWGSCORE:main',
           'CRISPRessoCompare = CRISPResso.CRISPRessoCompareCORE:main',
           'CRISPRessoPooledWGSCompare = CRISPResso.CRISPRessoPooledWGSCompareCORE:main',
-          'CRISPRessoCount = CRISPResso.CRISPRessoCountCORE:main']
+          'CRISPRessoCount = CRISPResso.CRISPRessoCountCORE:main',
+          'CRISPRessoPlot = CRISPResso.CRISPRessoPlotCORE:main']
            },
           description="Software pipeline for the analysis of CRISPR-Cas9 genome editing outcomes from deep sequencing data",
           author='Luca Pinello',
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+from CRISPResso.CRISPRessoAlign import global_align
+
+
+class BandedAlignmentTest(unittest.TestCase):
+
+    def setUp(self):
+        rng=random.Random(1)
+        self.amplicon=''.join([rng.choice('ACGT') for _ in range(300)])
+        self.rng=rng
+
+    def get_read_with_insertion_and_deletion(self,indel_size):
+        insertion=''.join([self.rng.choice('ACGT') for _ in range(indel_size)])
+        return self.amplicon[:100]+insertion+self.amplicon[100:200]+self.amplicon[200+indel_size:]
+
+    def test_best_alignment_outside_the_band(self):
+        #the insertion and the deletion bring the best alignment outside the band, while the best
+        #alignment inside the band stays far from its edges
+        for indel_size in [30,40]:
+            read=self.get_read_with_insertion_and_deletion(indel_size)
+            unbanded=global_align(self.amplicon,[read])[0]
+            for band_width in [4,25]:
+                self.assertEqual(global_align(self.amplicon,[read],band_width=band_width)[0],unbanded)
+
+
+if __name__ == '__main__':
+    unittest.main()